@@ -1,12 +1,13 @@
 from typing import Optional
+import asyncio
 import re
 import json
 from ai.backend.util.write_log import logger
 import traceback
 import ast
-from ai.backend.util.token_util import num_tokens_from_messages
+from ai.backend.util.token_util import exceeds_token_limit
 from ai.backend.base_config import request_timeout, max_retry_times, language_chinese, \
-    language_english, \
+    language_english, report_task_concurrency, \
     local_base_postgresql_info, local_base_mysql_info, local_base_xls_info, \
     csv_file_path, python_base_dependency, default_language_mode
 from ai.agents.prompt import CSV_ECHART_TIPS_MESS, \
@@ -14,6 +15,7 @@ from ai.agents.prompt import CSV_ECHART_TIPS_MESS, \
 from ai.agents.agentchat import UserProxyAgent, GroupChat, AssistantAgent, GroupChatManager, \
     PythonProxyAgent, BIProxyAgent, HumanProxyAgent, TaskPlannerAgent, TaskSelectorAgent, CheckAgent
 from ai.backend.util import base_util
+from ai.backend.util.csv_profile import get_csv_profile
 
 
 class AgentInstanceUtil:
@@ -27,6 +29,7 @@ class AgentInstanceUtil:
         outgoing: Optional = None,
         incoming: Optional = None,
         db_id: Optional = None,
+        bi_router: Optional = None,
     ):
         self.base_message = base_message
         self.websocket = websocket
@@ -52,6 +55,9 @@ class AgentInstanceUtil:
         self.openai_proxy = None
         self.db_id = db_id
 
+        # Matches BI replies to the requests of the BI proxies, see BIProxyAgent.
+        self.bi_router = bi_router
+
     def set_api_key(self, api_key):
         self.api_key = api_key
 
@@ -414,7 +420,8 @@ class AgentInstanceUtil:
         )
         return base_postgresql_assistant
 
-    def get_agent_analyst(self):
+    def get_agent_analyst(self, stream_callback=None):
+        """ stream_callback: streams the analyst's reply, which is the answer sent to the user """
         analyst = AssistantAgent(
             name="Analyst",
             system_message='''Analyst. You are a report analysis, you have the knowledge and skills to turn raw data into information and insight, which can be used to make business decisions.
@@ -424,6 +431,7 @@ class AgentInstanceUtil:
             websocket=self.websocket,
             user_name=self.user_name,
             openai_proxy=self.openai_proxy,
+            stream_callback=stream_callback,
         )
         return analyst
 
@@ -478,6 +486,7 @@ class AgentInstanceUtil:
             delay_messages=self.delay_messages,
             incoming=self.incoming,
             openai_proxy=self.openai_proxy,
+            bi_router=self.bi_router,
         )
         return bi_proxy
 
@@ -903,6 +912,16 @@ class AgentInstanceUtil:
                     "file_comment": table_comment,
                     "file_path": csv_file_path + table_name,
                 }
+                try:
+                    # Read with this encoding; column types are inferred from a sample of rows
+                    profile = get_csv_profile(csv_file_path + table_name)
+                    tb_desc["encoding"] = profile['encoding']
+                    if profile.get('parquet_path'):
+                        # Same data as the csv, loaded without parsing text
+                        tb_desc["read_with"] = "pd.read_parquet('{}')".format(profile['parquet_path'])
+                    tb_desc["column_types"] = {name: stats['dtype'] for name, stats in profile['column_stats'].items()}
+                except Exception as e:
+                    logger.error("from user:[{}".format(self.user_name) + "] , csv profile error: " + str(e))
                 print('tb_desc : ', tb_desc)
                 csv_content.append(tb_desc)
 
@@ -952,49 +971,17 @@ class AgentInstanceUtil:
             if error_times >= max_retry_times:
                 return self.error_message_timeout
 
-            for report_task in report_demand_list:
-
-                error_times = 0
-                for i in range(max_retry_times):
-                    try:
-                        mysql_engineer = self.get_agent_mysql_engineer()
-                        bi_proxy = self.get_agent_bi_proxy()
-                        chart_presenter = self.get_agent_chart_presenter()
-
-                        groupchat = GroupChat(
-                            agents=[mysql_engineer, bi_proxy, chart_presenter],
-                            messages=[],
-                            max_round=10,
-                        )
-                        manager = GroupChatManager(groupchat=groupchat, llm_config=self.gpt4_turbo_config,
-                                                   websocket=self.websocket)
-
-                        q_str = "我需要一个命名为 " + '\n' + report_task["report_name"] + '\n' + "的图表，" + report_task[
-                            "description"]
-                        await planner_user.initiate_chat(
-                            manager,
-                            message='This is database related information：' + '\n' + self.base_message + '\n' + " This is my question: " + '\n' + str(
-                                q_str),
-                        )
-
-                        answer_message = manager._oai_messages[bi_proxy]
-                        is_done = False
-                        for answer_mess in answer_message:
-                            if answer_mess['role']:
-                                if answer_mess['role'] == 'function':
-                                    answer_contents.append(answer_mess)
-                                    print("answer_mess: ", answer_mess)
-                                    is_done = True
-                        if is_done:
-                            break
-                    except Exception as e:
-                        # 使用 traceback 打印详细信息
-                        traceback.print_exc()
-                        logger.error("from user:[{}".format(self.user_name) + "] , " + str(e))
-                        error_times = error_times + 1
+            # Each chart gets its own agents and group chat, so they can run side by side.
+            semaphore = asyncio.Semaphore(report_task_concurrency)
+            results = await asyncio.gather(
+                *[self.generate_report_chart(report_task, semaphore) for report_task in report_demand_list]
+            )
+            if any(result is None for result in results):
+                return self.error_message_timeout
 
-                if error_times == max_retry_times:
-                    return self.error_message_timeout
+            answer_contents = []
+            for chart_contents, answer_message in results:
+                answer_contents.extend(chart_contents)
 
             if len(answer_contents) > 0:
                 answer_contents.append(answer_message)
@@ -1009,9 +996,7 @@ class AgentInstanceUtil:
                     }
                 ]
 
-                num_tokens = num_tokens_from_messages(message, model='gpt-4')
-                print("num_tokens : ", num_tokens)
-                if num_tokens < 20000:
+                if not exceeds_token_limit(message, 20000, model='gpt-4'):
                     error_times = 0  # 失败次数
                     for i in range(max_retry_times):
                         try:
@@ -1053,6 +1038,54 @@ class AgentInstanceUtil:
             logger.error("from user:[{}".format(self.user_name) + "] , " + str(e))
         return "报表生成失败，请检查相关数据是否充分。"
 
+    async def generate_report_chart(self, report_task, semaphore):
+        """ Generate one chart of a report. Returns (function replies, bi_proxy messages), or None if every try failed """
+        async with semaphore:
+            error_times = 0
+            answer_contents = []
+            answer_message = []
+            for i in range(max_retry_times):
+                try:
+                    planner_user = self.get_agent_planner_user()
+                    mysql_engineer = self.get_agent_mysql_engineer()
+                    bi_proxy = self.get_agent_bi_proxy()
+                    chart_presenter = self.get_agent_chart_presenter()
+
+                    groupchat = GroupChat(
+                        agents=[mysql_engineer, bi_proxy, chart_presenter],
+                        messages=[],
+                        max_round=10,
+                    )
+                    manager = GroupChatManager(groupchat=groupchat, llm_config=self.gpt4_turbo_config,
+                                               websocket=self.websocket)
+
+                    q_str = "我需要一个命名为 " + '\n' + report_task["report_name"] + '\n' + "的图表，" + report_task[
+                        "description"]
+                    await planner_user.initiate_chat(
+                        manager,
+                        message='This is database related information：' + '\n' + self.base_message + '\n' + " This is my question: " + '\n' + str(
+                            q_str),
+                    )
+
+                    answer_message = manager._oai_messages[bi_proxy]
+                    for answer_mess in answer_message:
+                        if answer_mess['role']:
+                            if answer_mess['role'] == 'function':
+                                answer_contents.append(answer_mess)
+                                print("answer_mess: ", answer_mess)
+                    if answer_contents:
+                        break
+                except Exception as e:
+                    # 使用 traceback 打印详细信息
+                    traceback.print_exc()
+                    logger.error("from user:[{}".format(self.user_name) + "] , " + str(e))
+                    error_times = error_times + 1
+
+            if error_times == max_retry_times:
+                return None
+
+            return answer_contents, answer_message
+
     async def task_generate_report1108(self, qustion_message):
         """ 任务类型1： 调用 bi, 生成报表 """
         try:
@@ -1168,9 +1201,7 @@ class AgentInstanceUtil:
                     }
                 ]
 
-                num_tokens = num_tokens_from_messages(message, model='gpt-4')
-                print("num_tokens : ", num_tokens)
-                if num_tokens < 20000:
+                if not exceeds_token_limit(message, 20000, model='gpt-4'):
                     error_times = 0  # 失败次数
                     for i in range(max_retry_times):
                         try:
@@ -1327,9 +1358,7 @@ class AgentInstanceUtil:
                         "content": str(base_content),
                     }
                 ]
-                num_tokens = num_tokens_from_messages(message, model='gpt-4')
-                print("num_tokens : ", num_tokens)
-                if num_tokens < 7000:
+                if not exceeds_token_limit(message, 7000, model='gpt-4'):
                     error_times = 0  # 失败次数
                     for i in range(max_retry_times):
                         try:
@@ -15,9 +15,9 @@ from ai.agents.code_utils import (
 import time
 import ast
 from ai.backend.util.write_log import logger
-from ai.backend.util.token_util import num_tokens_from_messages
+from ai.backend.util.token_util import exceeds_token_limit
 import traceback
-from ai.backend.base_config import if_hide_sensitive
+from ai.backend.base_config import if_hide_sensitive, bi_reply_timeout
 
 try:
     from termcolor import colored
@@ -64,6 +64,7 @@ class BIProxyAgent(Agent):
             delay_messages: Optional = None,
             incoming: Optional = None,
             openai_proxy: Optional[str] = None,
+            bi_router: Optional = None,
 
     ):
         """
@@ -106,6 +107,8 @@ class BIProxyAgent(Agent):
                 for available options.
                 To disable llm-based auto reply, set to False.
             default_auto_reply (str or dict or None): default auto reply when no code execution or llm-based reply is generated.
+            bi_router (BIRouter or None): matches the BI replies of the connection to the requests waiting for them.
+                Without it, replies are read from the websocket by `receive_message`.
         -------------------------------------------------------------------------------------------
         """
         super().__init__(name)
@@ -144,6 +147,7 @@ class BIProxyAgent(Agent):
         self.delay_messages = delay_messages
         self.incoming = incoming
         self.openai_proxy = openai_proxy
+        self.bi_router = bi_router
 
 
     def register_reply(
@@ -1093,8 +1097,6 @@ class BIProxyAgent(Agent):
             current_timestamp = int(time.time())
             mysql_code_str = mysql_code_str.replace("\n", " ")
 
-            websocket = self.websocket
-            # ss_websocket = ss_websocket
             result_message = {
                 'state': 200,
                 'receiver': 'bi',
@@ -1106,48 +1108,25 @@ class BIProxyAgent(Agent):
                 'id': str(current_timestamp)
             }
 
-            send_json_str = json.dumps(result_message)
-            await websocket.send(send_json_str)
-            print(str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())) + ' ---- ' + " send a message:{}".format(
-                send_json_str))
-
-            logger.info(
-                "from user:[{}".format(
-                    self.user_name) + "] , " + self.name + " send a message:{}".format(
-                    send_json_str))
-
-            target_sender = 'bi'
-            target_data_type = 'mysql_code'
-            target_id = current_timestamp
-
-            await self.receive_message(target_sender, target_data_type, target_id)
+            receive_json = await self.bi_request(result_message, 'mysql_code')
+            if receive_json is not None:
+                reply_content = receive_json.get('data').get('content')
+                print('reply_content : ', reply_content)
 
-            # Traverse the pending message set delay_messages to see if the message has been received
-            mes_list = self.delay_messages['bi']['mysql_code']
-            print('mes_list : ', mes_list)
-            for mes in mes_list:
-                receive_json = json.loads(mes)
-                if receive_json.get('sender') == 'bi':
-                    reply_content = receive_json.get('data').get('content')
-                    print('reply_content : ', reply_content)
+                if reply_content == 'sql没有查询到数据':
+                    reply_content = 'sql code 执行成功，但是没有查询到数据。'
 
-                    if reply_content == 'sql没有查询到数据':
-                        reply_content = 'sql code 执行成功，但是没有查询到数据。'
+                message = [
+                    {
+                        "role": "system",
+                        "content": str(reply_content),
+                    }
+                ]
 
-                    message = [
-                        {
-                            "role": "system",
-                            "content": str(reply_content),
-                        }
-                    ]
+                if exceeds_token_limit(message, 10000, model='gpt-4'):
+                    return 'The MySQL code is not very suitable. You have queried too much data at once. Please adjust the MySQL code to solve the problem.'
 
-                    num_tokens = num_tokens_from_messages(message, model='gpt-4')
-                    mes_list.remove(mes)
-
-                    if num_tokens > 10000:
-                        return 'The MySQL code is not very suitable. You have queried too much data at once. Please adjust the MySQL code to solve the problem.'
-
-                    return reply_content
+                return reply_content
 
         except Exception as e:
             print(e)
@@ -1190,37 +1169,15 @@ class BIProxyAgent(Agent):
                     'id': str(current_timestamp)
                 }
 
-            websocket = self.websocket
-
-            send_json_str = json.dumps(result_message)
-            await websocket.send(send_json_str)
-            print(str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())) + ' ---- ' + " send a message:{}".format(
-                send_json_str))
-            logger.info(
-                "from user:[{}".format(
-                    self.user_name) + "] , " + self.name + " send a message:{}".format(
-                    send_json_str))
+            receive_json = await self.bi_request(result_message, 'chart_code')
+            if receive_json is not None:
+                reply_content = receive_json['data']['content']
+                print('reply_content : ', reply_content)
 
-            target_sender = 'bi'
-            target_data_type = 'chart_code'
-            target_id = current_timestamp
-
-            await self.receive_message(target_sender, target_data_type, target_id)
-
-            mes_list = self.delay_messages['bi']['chart_code']
-            print('mes_list : ', mes_list)
-            for mes in mes_list:
-                receive_json = json.loads(mes)
-                if receive_json.get('sender') == 'bi':
-                    reply_content = receive_json['data']['content']
-                    print('reply_content : ', reply_content)
-
-                    if receive_json.get('state') == 200:
-                        mes_list.remove(mes)
-                        return "Charts have been successfully generated for users."
-                    else:
-                        mes_list.remove(mes)
-                        return "Failed to generate chart. Please check whether the data format is correct"
+                if receive_json.get('state') == 200:
+                    return "Charts have been successfully generated for users."
+                else:
+                    return "Failed to generate chart. Please check whether the data format is correct"
 
         except Exception as e:
             print(e)
@@ -1244,36 +1201,15 @@ class BIProxyAgent(Agent):
                 'id': str(current_timestamp)
             }
 
-            send_json_str = json.dumps(result_message)
-            await self.websocket.send(send_json_str)
+            receive_json = await self.bi_request(result_message, 'ask_data')
+            if receive_json is not None:
+                reply_content = receive_json['data']['content']
+                print('reply_content : ', reply_content)
 
-            print(str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())) + ' ---- ' + " send a message:{}".format(
-                send_json_str))
-            logger.info(
-                "from user:[{}".format(
-                    self.user_name) + "] , " + self.name + " send a message:{}".format(
-                    send_json_str))
-
-            target_sender = 'bi'
-            target_data_type = 'ask_data'
-            target_id = current_timestamp
-
-            await self.receive_message(target_sender, target_data_type, target_id)
-
-            mes_list = self.delay_messages['bi']['ask_data']
-            print('mes_list : ', mes_list)
-            for mes in mes_list:
-                receive_json = json.loads(mes)
-                if receive_json.get('sender') == 'bi':
-                    reply_content = receive_json['data']['content']
-                    print('reply_content : ', reply_content)
-
-                    if receive_json.get('state') == 200:
-                        mes_list.remove(mes)
-                        return True, reply_content
-                    else:
-                        mes_list.remove(mes)
-                        return False, "Failed to get chart data. " + str(reply_content)
+                if receive_json.get('state') == 200:
+                    return True, reply_content
+                else:
+                    return False, "Failed to get chart data. " + str(reply_content)
 
         except Exception as e:
             traceback.print_exc()
@@ -1287,7 +1223,6 @@ class BIProxyAgent(Agent):
         try:
 
             current_timestamp = int(time.time())
-            websocket = self.websocket
             result_message = {
                 'state': 200,
                 'receiver': 'bi',
@@ -1299,43 +1234,17 @@ class BIProxyAgent(Agent):
 
             }
 
-            send_json_str = json.dumps(result_message)
-
-            # print("将消息放入待发送队列")
-            # await self.outgoing.put(send_json_str)
+            receive_json = await self.bi_request(result_message, 'delete_chart')
+            if receive_json is not None:
+                reply_content = receive_json['data']['content']
+                print('reply_content : ', reply_content)
 
-            await websocket.send(send_json_str)
-            print(str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())) + ' ---- ' + " send a message:{}".format(
-                send_json_str))
-
-            logger.info(
-                "from user:[{}".format(
-                    self.user_name) + "] , " + self.name + " send a message:{}".format(
-                    send_json_str))
-
-            # 接收 message信息， 放入不同队列
-            target_sender = 'bi'
-            target_data_type = 'delete_chart'
-            target_id = current_timestamp
-
-            await self.receive_message(target_sender, target_data_type, target_id)
-
-            #  遍历待处理 delay_messages，【延时】消息队列，查询是否收到了消息
-            mes_list = self.delay_messages['bi']['delete_chart']
-            for mes in mes_list:
-                receive_json = json.loads(mes)
-                if receive_json.get('sender') == 'bi':
-                    reply_content = receive_json['data']['content']
-                    print('reply_content : ', reply_content)
-
-                    if receive_json.get('state') == 200:
-                        mes_list.remove(mes)
-                        # return "Chart deleted successfully."
-                        return "删除图表成功"
-                    else:
-                        mes_list.remove(mes)
-                        # return "Chart deleted fail."
-                        return "删除图表失败。 请检查提供的图表列表格式是否正确以及图表名称是否存在。"
+                if receive_json.get('state') == 200:
+                    # return "Chart deleted successfully."
+                    return "删除图表成功"
+                else:
+                    # return "Chart deleted fail."
+                    return "删除图表失败。 请检查提供的图表列表格式是否正确以及图表名称是否存在。"
 
         except Exception as e:
             print(e)
@@ -1374,6 +1283,35 @@ class BIProxyAgent(Agent):
             traceback.print_exc()
             logger.error("from user:[{}".format(self.user_name) + "] , " + str(e))
 
+    async def bi_request(self, result_message, target_data_type: str):
+        """ Send a request to BI and return its reply (parsed), or None if there is no reply in time """
+        if self.bi_router is not None:
+            print(str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())) + ' ---- ' + " send a message:{}".format(
+                result_message))
+            receive_json = await self.bi_router.request(self.websocket, result_message, timeout=bi_reply_timeout)
+            logger.info(
+                "from user:[{}".format(
+                    self.user_name) + "] , " + self.name + " got a reply:{}".format(receive_json))
+            return receive_json
+
+        send_json_str = json.dumps(result_message)
+        await self.websocket.send(send_json_str)
+        logger.info(
+            "from user:[{}".format(
+                self.user_name) + "] , " + self.name + " send a message:{}".format(
+                send_json_str))
+
+        await self.receive_message('bi', target_data_type, int(result_message['id']))
+
+        # Traverse the pending message set delay_messages to see if the message has been received
+        mes_list = self.delay_messages['bi'][target_data_type]
+        for mes in mes_list:
+            receive_json = json.loads(mes)
+            if receive_json.get('sender') == 'bi':
+                mes_list.remove(mes)
+                return receive_json
+        return None
+
     async def receive_message(self, target_sender: str, target_data_type: str, target_id: int):
         """ Receive message information and put it into different queues """
         for i in range(10):
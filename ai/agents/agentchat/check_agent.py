@@ -2,7 +2,6 @@ from .conversable_agent import ConversableAgent
 from .agent import Agent
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from ai.agents import oai
-import asyncio
 
 
 class CheckAgent(ConversableAgent):
@@ -68,33 +67,13 @@ Reply "TERMINATE" in the end when everything is done.
         if messages is None:
             messages = self._oai_messages[sender]
 
-        def create_chat():
-            # print("create_chat: ")
-            # TODO: #1143 handle token limit exceeded error
-            if self.openai_proxy is None:
-                response = oai.ChatCompletion.create(
-                    context=messages[-1].pop("context", None), messages=self._oai_system_message + messages,
-                    use_cache=False,
-                    **llm_config
-                )
-            else:
-                response = oai.ChatCompletion.create(
-                    context=messages[-1].pop("context", None), messages=self._oai_system_message + messages,
-                    use_cache=False,
-                    openai_proxy=self.openai_proxy,
-                    **llm_config
-                )
-            # print("response: ", response)
-            return response
-
-        async def consume_async():
-            # loop = asyncio.new_event_loop()
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, create_chat)
-            # print("result :", result)
-            return result
-
-        response = await consume_async()
+        context = messages[-1].pop("context", None)
+        response = await oai.ChatCompletion.acreate(
+            context=context, messages=self.messages_to_send(messages),
+            use_cache=False,
+            openai_proxy=self.openai_proxy,
+            **llm_config
+        )
         # print("response：", response)
 
         # # TODO: #1143 handle token limit exceeded error
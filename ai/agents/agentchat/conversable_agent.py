@@ -6,6 +6,8 @@ import logging
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 from ai.agents import oai
 from .agent import Agent
+from .history import HistoryCompactor, messages_tokens
+from ai.backend.base_config import history_max_tokens, history_max_message_tokens
 from ai.agents.code_utils import (
     DEFAULT_MODEL,
     UNKNOWN,
@@ -61,6 +63,8 @@ class ConversableAgent(Agent):
             user_name: Optional[str] = "default_user",
             openai_proxy: Optional[str] = None,
             use_cache: Optional[bool] = True,
+            stream_callback: Optional[Callable] = None,
+            max_history_tokens: Optional[int] = history_max_tokens,
 
     ):
         """
@@ -103,6 +107,12 @@ class ConversableAgent(Agent):
                 for available options.
                 To disable llm-based auto reply, set to False.
             default_auto_reply (str or dict or None): default auto reply when no code execution or llm-based reply is generated.
+            stream_callback (coroutine function or None): when set, llm replies are streamed (only set it on agents
+                whose replies are the answer to the user): it is called as
+                `stream_callback(content, False)` with each piece of content as it is generated, then as
+                `stream_callback(reply, True)` with the whole reply.
+            max_history_tokens (int or None): token budget of the messages sent to the llm, see HistoryCompactor.
+                None to send the whole history.
         -------------------------------------------------------------------------------------------
 
         """
@@ -141,6 +151,12 @@ class ConversableAgent(Agent):
         self.user_name = user_name
         self.openai_proxy = openai_proxy
         self.use_cache = use_cache
+        self.stream_callback = stream_callback
+        self.history_compactor = (
+            HistoryCompactor(max_tokens=max_history_tokens, max_message_tokens=history_max_message_tokens)
+            if max_history_tokens
+            else None
+        )
 
     def register_reply(
             self,
@@ -633,6 +649,13 @@ class ConversableAgent(Agent):
         else:
             self._oai_messages[agent].clear()
 
+    def messages_to_send(self, messages: List[Dict]) -> List[Dict]:
+        """The system message and the conversation, compacted to the token budget of the agent."""
+        if self.history_compactor is None:
+            return self._oai_system_message + messages
+        reserved_tokens = messages_tokens(self._oai_system_message) - 3
+        return self._oai_system_message + self.history_compactor.compact(messages, reserved_tokens)
+
     async def generate_oai_reply(
             self,
             messages: Optional[List[Dict]] = None,
@@ -649,36 +672,31 @@ class ConversableAgent(Agent):
             messages = self._oai_messages[sender]
         print('run functon generate_oai_reply :', self.user_name)
 
-        def create_chat():
-            # print("create_chat: ")
-            print("self.openai_proxy , ", self.openai_proxy)
-
-            # TODO: #1143 handle token limit exceeded error
-            if self.openai_proxy is None:
-                response = oai.ChatCompletion.create(
-                    context=messages[-1].pop("context", None), use_cache=self.use_cache,
-                    messages=self._oai_system_message + messages,
-                    **llm_config
-                )
-            else:
-                response = oai.ChatCompletion.create(
-                    context=messages[-1].pop("context", None), use_cache=self.use_cache,
-                    messages=self._oai_system_message + messages,
-                    openai_proxy=self.openai_proxy,
-                    **llm_config
-                )
-
-            # print("response: ", response)
-            return response
-
-        async def consume_async():
-            # loop = asyncio.new_event_loop()
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, create_chat)
-            # print("result :", result)
-            return result
-
-        response = await consume_async()
+        context = messages[-1].pop("context", None)
+        # function call turns are intermediate steps, only text replies are streamed
+        if self.stream_callback is not None and not llm_config.get("functions"):
+            streamed = []
+
+            async def on_chunk(content):
+                streamed.append(content)
+                await self.stream_callback(content, False)
+
+            response = await oai.ChatCompletion.astream(
+                on_chunk,
+                context=context,
+                messages=self.messages_to_send(messages),
+                openai_proxy=self.openai_proxy,
+                **llm_config
+            )
+            if streamed:
+                await self.stream_callback("".join(streamed), True)
+        else:
+            response = await oai.ChatCompletion.acreate(
+                context=context, use_cache=self.use_cache,
+                messages=self.messages_to_send(messages),
+                openai_proxy=self.openai_proxy,
+                **llm_config
+            )
         # print("response：", response)
 
         # # TODO: #1143 handle token limit exceeded error
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from ai.backend.util.token_util import num_tokens_from_messages
+
+logger = logging.getLogger(__name__)
+
+COUNT_MODEL = "gpt-4"
+# Number of message token counts kept, by digest of the message (not its content, which can be a whole schema)
+TOKEN_CACHE_SIZE = 4096
+
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def _count_tokens(role: str, content: str, name: str, model: str) -> int:
+    message = {"role": role, "content": content}
+    if name:
+        message["name"] = name
+    try:
+        # num_tokens_from_messages adds 3 tokens for the reply, which is counted once per request
+        return num_tokens_from_messages([message], model=model) - 3
+    except NotImplementedError:
+        return num_tokens_from_messages([message], model=COUNT_MODEL) - 3
+
+
+def _content_tokens(role: str, content: str, name: str, model: str) -> int:
+    key = (role, hashlib.sha1(content.encode("utf-8")).digest(), name, model)
+    with _token_counts_lock:
+        tokens = _token_counts.get(key)
+        if tokens is not None:
+            _token_counts.move_to_end(key)
+            return tokens
+
+    tokens = _count_tokens(role, content, name, model)
+    with _token_counts_lock:
+        _token_counts[key] = tokens
+        while len(_token_counts) > TOKEN_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return tokens
+
+
+def _message_text(message: Dict) -> str:
+    content = message.get("content") or ""
+    if message.get("function_call"):
+        content += json.dumps(message["function_call"], ensure_ascii=False)
+    return content
+
+
+def message_tokens(message: Dict, model: str = COUNT_MODEL) -> int:
+    """Number of tokens of a message in a chat completion request."""
+    return _content_tokens(message.get("role", ""), _message_text(message), message.get("name", ""), model)
+
+
+def messages_tokens(messages: List[Dict], model: str = COUNT_MODEL) -> int:
+    return sum(message_tokens(message, model) for message in messages) + 3
+
+
+class HistoryCompactor:
+    """Keeps the messages sent to the llm within a token budget.
+
+    Messages longer than `max_message_tokens` (typically query results and tool outputs) are cut in the middle,
+    except the first and the last one.
+    If the conversation is still over `max_tokens`, the oldest turns are left out, except the first message
+    (the task) and the last `keep_last` messages. The agent's history itself is not modified.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 6000,
+        max_message_tokens: Optional[int] = 2000,
+        keep_last: int = 4,
+        model: str = COUNT_MODEL,
+    ):
+        self.max_tokens = max_tokens
+        self.max_message_tokens = max_message_tokens
+        self.keep_last = keep_last
+        self.model = model
+        # tokens sent per turn, before and after compaction
+        self.last_stats = None
+        self.total_tokens_before = 0
+        self.total_tokens_after = 0
+
+    def _truncate(self, message: Dict, tokens: int) -> Dict:
+        content = message.get("content")
+        if not isinstance(content, str) or tokens <= self.max_message_tokens:
+            return message
+        # cut by characters, in proportion to the tokens to remove
+        keep_chars = max(int(len(content) * self.max_message_tokens / tokens), 1)
+        head = content[: keep_chars * 2 // 3]
+        tail = content[len(content) - keep_chars // 3:]
+        omitted = tokens - self.max_message_tokens
+        return dict(message, content=f"{head}\n...[about {omitted} tokens omitted]...\n{tail}")
+
+    def compact(self, messages: List[Dict], reserved_tokens: int = 0) -> List[Dict]:
+        """Return the messages to send, given `reserved_tokens` already used by the system messages."""
+        tokens = [message_tokens(message, self.model) for message in messages]
+        tokens_before = sum(tokens) + reserved_tokens + 3
+
+        compacted = list(messages)
+        if self.max_message_tokens:
+            # the first message is the task (with the database schema) and the last one is the message to
+            # answer, both are kept whole
+            for i in range(1, len(compacted) - 1):
+                if tokens[i] > self.max_message_tokens:
+                    compacted[i] = self._truncate(compacted[i], tokens[i])
+                    tokens[i] = message_tokens(compacted[i], self.model)
+
+        budget = self.max_tokens - reserved_tokens - 3
+        total = sum(tokens)
+        first_kept = 1
+        last_droppable = len(compacted) - self.keep_last
+        while total > budget and first_kept < last_droppable:
+            total -= tokens[first_kept]
+            first_kept += 1
+        # a function result is not sent without the call it answers
+        while first_kept < last_droppable and compacted[first_kept].get("role") == "function":
+            total -= tokens[first_kept]
+            first_kept += 1
+
+        if first_kept > 1:
+            note = {"role": "system", "content": f"[{first_kept - 1} earlier messages omitted]"}
+            compacted = compacted[:1] + [note] + compacted[first_kept:]
+            total += message_tokens(note, self.model)
+
+        tokens_after = total + reserved_tokens + 3
+        self.last_stats = {
+            "messages_before": len(messages),
+            "messages_after": len(compacted),
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+        }
+        self.total_tokens_before += tokens_before
+        self.total_tokens_after += tokens_after
+        if tokens_after < tokens_before:
+            logger.info(f"history compacted: {self.last_stats}")
+        return compacted
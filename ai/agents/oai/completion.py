@@ -1,14 +1,18 @@
 from time import sleep
+import asyncio
 import logging
+import os
 import time
 from typing import List, Optional, Dict, Callable, Union
 import sys
 import shutil
+import threading
 import numpy as np
 from flaml import tune, BlendSearch
 from flaml.tune.space import is_constant
 from flaml.automl.logger import logger_formatter
 from .openai_utils import get_key
+from .response_cache import ResponseCache, normalize_key
 
 try:
     import openai
@@ -22,6 +26,7 @@ try:
         AuthenticationError,
     )
     from openai import Completion as openai_Completion
+    import aiohttp
     import diskcache
 
 
@@ -38,6 +43,92 @@ if not logger.handlers:
     logger.addHandler(_ch)
 
 
+if ERROR is None:
+    # errors handled by the retry policy of `_Request`
+    _RETRIED_ERRORS = (
+        ServiceUnavailableError,
+        APIConnectionError,
+        APIError,
+        RateLimitError,
+        Timeout,
+        InvalidRequestError,
+    )
+
+
+class _Request:
+    """Retry policy of one request to the openai api, shared by the sync and async methods of `Completion`."""
+
+    def __init__(self, completion_class, openai_completion, config, key, cache, raise_on_ratelimit_or_timeout):
+        self.completion_class = completion_class
+        self.openai_completion = openai_completion
+        self.key = key
+        self.cache = cache
+        self.raise_on_ratelimit_or_timeout = raise_on_ratelimit_or_timeout
+        self.start_time = time.time()
+        self.request_timeout = completion_class.request_timeout
+        self.max_retry_period = config.pop("max_retry_period", completion_class.max_retry_period)
+        self.retry_wait_time = config.pop("retry_wait_time", completion_class.retry_wait_time)
+        self.config = config
+
+    def params(self):
+        """Arguments of the next attempt."""
+        if "request_timeout" in self.config:
+            return self.config
+        return dict(self.config, request_timeout=self.request_timeout)
+
+    def done(self, response):
+        if self.cache is not None:
+            self.cache.record_miss(time.time() - self.start_time)
+            self.cache.set(self.key, response)
+        self.completion_class._book_keeping(self.config, response)
+        return response
+
+    def retry_wait(self, err):
+        """Seconds to wait before retrying after `err`, or None to give up (the response is then -1).
+        Raises `err` if it can't be retried."""
+        retry_wait_time = self.retry_wait_time
+        if isinstance(err, (ServiceUnavailableError, APIConnectionError)):
+            # transient error
+            logger.info(f"retrying in {retry_wait_time} seconds...", exc_info=1)
+            return retry_wait_time
+        if isinstance(err, APIError):
+            error_code = err and err.json_body and isinstance(err.json_body, dict) and err.json_body.get("error")
+            error_code = error_code and error_code.get("code")
+            if error_code == "content_filter":
+                raise err
+            # transient error
+            logger.info(f"retrying in {retry_wait_time} seconds...", exc_info=1)
+            return retry_wait_time
+        if isinstance(err, (RateLimitError, Timeout)):
+            time_left = self.max_retry_period - (time.time() - self.start_time + retry_wait_time)
+            if (
+                    time_left > 0
+                    and isinstance(err, RateLimitError)
+                    or time_left > self.request_timeout
+                    and isinstance(err, Timeout)
+                    and "request_timeout" not in self.config
+            ):
+                if isinstance(err, Timeout):
+                    self.request_timeout <<= 1
+                self.request_timeout = min(self.request_timeout, time_left)
+                logger.info(f"retrying in {retry_wait_time} seconds...", exc_info=1)
+                return retry_wait_time
+            if self.raise_on_ratelimit_or_timeout:
+                raise err
+            if self.cache is not None and isinstance(err, Timeout):
+                self.cache.set(self.key, -1)
+            logger.warning(
+                f"Failed to get response from openai api due to getting RateLimitError or Timeout for {self.max_retry_period} seconds."
+            )
+            return None
+        # InvalidRequestError
+        if "azure" in self.config.get("api_type", openai.api_type) and "model" in self.config:
+            # azure api uses "engine" instead of "model"
+            self.config["engine"] = self.config.pop("model").replace("gpt-3.5-turbo", "gpt-35-turbo")
+            return 0
+        raise err
+
+
 class Completion(openai_Completion):
     """A class for OpenAI completion API.
 
@@ -112,6 +203,16 @@ class Completion(openai_Completion):
     max_retry_period = 120
     # time out for request to openai server
     request_timeout = 60
+    # max number of concurrent requests per api key, for the async methods
+    max_concurrent_requests_per_key = 20
+    # max number of connections kept by the shared HTTP session of the async methods
+    max_connections = 100
+    # number of responses kept in memory in front of each disk cache
+    cache_memory_size = 1024
+    # max size in bytes of each disk cache, the least recently used responses are evicted beyond it
+    cache_size_limit = 2 ** 30
+    # seconds a cached response is used for, None to keep it until it is evicted
+    cache_ttl = 7 * 24 * 3600
 
     openai_completion_class = not ERROR and openai.Completion
     _total_cost = 0
@@ -119,6 +220,11 @@ class Completion(openai_Completion):
 
     _history_dict = _count_create = None
 
+    _aiosessions = {}
+    _key_semaphores = {}
+    _caches = {}
+    _caches_lock = threading.Lock()
+
     @classmethod
     def set_cache(cls, seed: Optional[int] = 41, cache_path_root: Optional[str] = ".cache"):
         """Set cache path.
@@ -143,10 +249,34 @@ class Completion(openai_Completion):
                 The complete cache path will be {cache_path}/{seed}.
         """
         if seed is None:
+            with cls._caches_lock:
+                for cache_path in [path for path in cls._caches if os.path.dirname(path) == cache_path_root]:
+                    cls._caches.pop(cache_path).close()
             shutil.rmtree(cache_path_root, ignore_errors=True)
             return
-        with diskcache.Cache(f"{cache_path_root}/{seed}") as cache:
-            cache.clear()
+        cls._get_cache(f"{cache_path_root}/{seed}").clear()
+
+    @classmethod
+    def _get_cache(cls, cache_path: Optional[str] = None) -> ResponseCache:
+        """Get the response cache of a path (the current seed's by default), shared by all the sessions."""
+        cache_path = cache_path or cls.cache_path
+        cache = cls._caches.get(cache_path)
+        if cache is None:
+            with cls._caches_lock:
+                cache = cls._caches.get(cache_path)
+                if cache is None:
+                    cache = cls._caches[cache_path] = ResponseCache(
+                        cache_path,
+                        memory_size=cls.cache_memory_size,
+                        size_limit=cls.cache_size_limit,
+                        ttl=cls.cache_ttl,
+                    )
+        return cache
+
+    @classmethod
+    def cache_stats(cls) -> Dict:
+        """Hit/miss counters and latencies of the response caches opened by this process, by path."""
+        return {cache_path: cache.stats() for cache_path, cache in list(cls._caches.items())}
 
     @classmethod
     def _book_keeping(cls, config: Dict, response):
@@ -180,86 +310,99 @@ class Completion(openai_Completion):
         cls._count_create += 1
 
     @classmethod
-    def _get_response(cls, config: Dict, raise_on_ratelimit_or_timeout=False, use_cache=True):
-        """Get the response from the openai api call.
+    def _start_request(cls, config: Dict, raise_on_ratelimit_or_timeout=False, use_cache=True, cache=None):
+        """Prepare a request for `_get_response` and `_aget_response`.
 
-        Try cache first. If not found, call the openai api. If the api call fails, retry after retry_wait_time.
+        Returns (request, response): the response if it was found in the cache, else the `_Request` to send.
         """
         config = config.copy()
         openai.api_key_path = config.pop("api_key_path", openai.api_key_path)
-        key = get_key(config)
+        key = normalize_key(config)
         if use_cache:
-            response = cls._cache.get(key, None)
+            cache = cache or cls._get_cache()
+            response = cache.get(key, None)
             if response is not None and (response != -1 or not raise_on_ratelimit_or_timeout):
                 # print("using cached response")
                 cls._book_keeping(config, response)
-                return response
+                return None, response
         openai_completion = (
             openai.ChatCompletion
             if config["model"].replace("gpt-35-turbo", "gpt-3.5-turbo") in cls.chat_models
                or issubclass(cls, ChatCompletion)
             else openai.Completion
         )
-        start_time = time.time()
-        request_timeout = cls.request_timeout
-        max_retry_period = config.pop("max_retry_period", cls.max_retry_period)
-        retry_wait_time = config.pop("retry_wait_time", cls.retry_wait_time)
+        request = _Request(cls, openai_completion, config, key, cache if use_cache else None,
+                           raise_on_ratelimit_or_timeout)
+        return request, None
+
+    @classmethod
+    def _get_response(cls, config: Dict, raise_on_ratelimit_or_timeout=False, use_cache=True, cache=None):
+        """Get the response from the openai api call.
+
+        Try cache first. If not found, call the openai api. If the api call fails, retry after retry_wait_time.
+        `cache` is the response cache to use, the one of the current seed by default.
+        """
+        request, response = cls._start_request(config, raise_on_ratelimit_or_timeout, use_cache, cache)
+        if request is None:
+            return response
         while True:
             try:
-                if "request_timeout" in config:
-                    response = openai_completion.create(**config)
-                else:
-                    response = openai_completion.create(request_timeout=request_timeout, **config)
-            except (
-                    ServiceUnavailableError,
-                    APIConnectionError,
-            ):
-                # transient error
-                logger.info(f"retrying in {retry_wait_time} seconds...", exc_info=1)
-                sleep(retry_wait_time)
-            except APIError as err:
-                error_code = err and err.json_body and isinstance(err.json_body, dict) and err.json_body.get("error")
-                error_code = error_code and error_code.get("code")
-                if error_code == "content_filter":
-                    raise
-                # transient error
-                logger.info(f"retrying in {retry_wait_time} seconds...", exc_info=1)
-                sleep(retry_wait_time)
-            except (RateLimitError, Timeout) as err:
-                time_left = max_retry_period - (time.time() - start_time + retry_wait_time)
-                if (
-                        time_left > 0
-                        and isinstance(err, RateLimitError)
-                        or time_left > request_timeout
-                        and isinstance(err, Timeout)
-                        and "request_timeout" not in config
-                ):
-                    if isinstance(err, Timeout):
-                        request_timeout <<= 1
-                    request_timeout = min(request_timeout, time_left)
-                    logger.info(f"retrying in {retry_wait_time} seconds...", exc_info=1)
-                    sleep(retry_wait_time)
-                elif raise_on_ratelimit_or_timeout:
-                    raise
-                else:
-                    response = -1
-                    if use_cache and isinstance(err, Timeout):
-                        cls._cache.set(key, response)
-                    logger.warning(
-                        f"Failed to get response from openai api due to getting RateLimitError or Timeout for {max_retry_period} seconds."
-                    )
-                    return response
-            except InvalidRequestError:
-                if "azure" in config.get("api_type", openai.api_type) and "model" in config:
-                    # azure api uses "engine" instead of "model"
-                    config["engine"] = config.pop("model").replace("gpt-3.5-turbo", "gpt-35-turbo")
-                else:
-                    raise
+                response = request.openai_completion.create(**request.params())
+            except _RETRIED_ERRORS as err:
+                wait_time = request.retry_wait(err)
+                if wait_time is None:
+                    return -1
+                sleep(wait_time)
             else:
-                if use_cache:
-                    cls._cache.set(key, response)
-                cls._book_keeping(config, response)
-                return response
+                return request.done(response)
+
+    @classmethod
+    def _get_aiosession(cls):
+        """Get the HTTP session of the running event loop, shared by all async requests to reuse connections."""
+        loop = asyncio.get_running_loop()
+        session = cls._aiosessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=cls.max_connections))
+            cls._aiosessions[loop] = session
+        return session
+
+    @classmethod
+    async def close_aiosession(cls):
+        """Close the shared HTTP session of the running event loop."""
+        session = cls._aiosessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    @classmethod
+    def _get_key_semaphore(cls, api_key):
+        semaphore = cls._key_semaphores.get(api_key)
+        if semaphore is None:
+            semaphore = cls._key_semaphores[api_key] = asyncio.Semaphore(cls.max_concurrent_requests_per_key)
+        return semaphore
+
+    @classmethod
+    async def _aget_response(cls, config: Dict, raise_on_ratelimit_or_timeout=False, use_cache=True, cache=None):
+        """Async version of `_get_response`.
+
+        Requests go through the shared HTTP session and are limited per api key. Retries wait without blocking
+        the event loop. `cache` is the response cache to use, the one of the current seed by default.
+        """
+        request, response = cls._start_request(config, raise_on_ratelimit_or_timeout, use_cache, cache)
+        if request is None:
+            return response
+        openai.aiosession.set(cls._get_aiosession())
+        semaphore = cls._get_key_semaphore(request.config.get("api_key") or openai.api_key)
+        while True:
+            try:
+                async with semaphore:
+                    response = await request.openai_completion.acreate(**request.params())
+            except _RETRIED_ERRORS as err:
+                wait_time = request.retry_wait(err)
+                if wait_time is None:
+                    return -1
+                await asyncio.sleep(wait_time)
+            else:
+                return request.done(response)
 
     @classmethod
     def _get_max_valid_n(cls, key, max_tokens):
@@ -675,14 +818,13 @@ class Completion(openai_Completion):
             )
         old_level = logger.getEffectiveLevel()
         logger.setLevel(logging_level)
-        with diskcache.Cache(cls.cache_path) as cls._cache:
-            analysis = tune.run(
-                cls._eval,
-                search_alg=search_alg,
-                num_samples=num_samples,
-                log_file_name=log_file_name,
-                verbose=3,
-            )
+        analysis = tune.run(
+            cls._eval,
+            search_alg=search_alg,
+            num_samples=num_samples,
+            log_file_name=log_file_name,
+            verbose=3,
+        )
         config = analysis.best_config
         params = cls._get_params_for_create(config)
         if cls._config_list is not None and is_const:
@@ -821,12 +963,167 @@ class Completion(openai_Completion):
             return cls._get_response(
                 params, raise_on_ratelimit_or_timeout=raise_on_ratelimit_or_timeout, use_cache=False
             )
-        seed = cls.seed
+        cache_path = cls.cache_path
+        if "seed" in params:
+            cache_path = os.path.join(os.path.dirname(cls.cache_path), str(params.pop("seed")))
+        return cls._get_response(
+            params, raise_on_ratelimit_or_timeout=raise_on_ratelimit_or_timeout, cache=cls._get_cache(cache_path)
+        )
+
+    @classmethod
+    async def acreate(
+            cls,
+            context: Optional[Dict] = None,
+            use_cache: Optional[bool] = True,
+            config_list: Optional[List[Dict]] = None,
+            filter_func: Optional[Callable[[Dict, Dict, Dict], bool]] = None,
+            raise_on_ratelimit_or_timeout: Optional[bool] = True,
+            allow_format_str_template: Optional[bool] = False,
+            openai_proxy: Optional[str] = None,
+            **config,
+    ):
+        """Make a completion for a given context without blocking the event loop.
+
+        Same arguments and return value as `create`.
+        """
+        if ERROR:
+            raise ERROR
+        if openai_proxy is not None:
+            openai.proxy = openai_proxy
+
+        # Warn if a config list was provided but was empty
+        if type(config_list) is list and len(config_list) == 0:
+            logger.warning(
+                "Completion was provided with a config_list, but the list was empty. Adopting default OpenAI behavior, which reads from the 'model' parameter instead."
+            )
+
+        if config_list:
+            last = len(config_list) - 1
+            cost = 0
+            for i, each_config in enumerate(config_list):
+                base_config = config.copy()
+                base_config["allow_format_str_template"] = allow_format_str_template
+                base_config.update(each_config)
+                if i < last and filter_func is None and "max_retry_period" not in base_config:
+                    # max_retry_period = 0 to avoid retrying when no filter is given
+                    base_config["max_retry_period"] = 0
+                try:
+                    response = await cls.acreate(
+                        context,
+                        use_cache,
+                        raise_on_ratelimit_or_timeout=i < last or raise_on_ratelimit_or_timeout,
+                        openai_proxy=openai_proxy,
+                        **base_config,
+                    )
+                    if response == -1:
+                        return response
+                    pass_filter = filter_func is None or filter_func(
+                        context=context, base_config=config, response=response
+                    )
+                    if pass_filter or i == last:
+                        response["cost"] = cost + response["cost"]
+                        response["config_id"] = i
+                        response["pass_filter"] = pass_filter
+                        return response
+                    cost += response["cost"]
+                except (AuthenticationError, RateLimitError, Timeout, InvalidRequestError):
+                    logger.debug(f"failed with config {i}", exc_info=1)
+                    if i == last:
+                        raise
+        params = cls._construct_params(context, config, allow_format_str_template=allow_format_str_template)
+        if not use_cache:
+            return await cls._aget_response(
+                params, raise_on_ratelimit_or_timeout=raise_on_ratelimit_or_timeout, use_cache=False
+            )
+        cache_path = cls.cache_path
         if "seed" in params:
-            cls.set_cache(params.pop("seed"))
-        with diskcache.Cache(cls.cache_path) as cls._cache:
-            cls.set_cache(seed)
-            return cls._get_response(params, raise_on_ratelimit_or_timeout=raise_on_ratelimit_or_timeout)
+            cache_path = os.path.join(os.path.dirname(cls.cache_path), str(params.pop("seed")))
+        return await cls._aget_response(
+            params, raise_on_ratelimit_or_timeout=raise_on_ratelimit_or_timeout, cache=cls._get_cache(cache_path)
+        )
+
+    @classmethod
+    async def astream(
+            cls,
+            on_chunk: Callable,
+            context: Optional[Dict] = None,
+            config_list: Optional[List[Dict]] = None,
+            allow_format_str_template: Optional[bool] = False,
+            openai_proxy: Optional[str] = None,
+            **config,
+    ):
+        """Make a chat completion, passing the generated content to `on_chunk` as it arrives.
+
+        Args:
+            on_chunk (Callable): coroutine function called with each piece of content.
+            Other arguments are the same as `create`. The next config of `config_list` is only
+                tried when the previous one failed before streaming anything.
+
+        Returns:
+            The assembled response, in the same shape as `create` (not cached, with a cost of 0).
+        """
+        if ERROR:
+            raise ERROR
+        if openai_proxy is not None:
+            openai.proxy = openai_proxy
+
+        config_list = config_list or [{}]
+        last = len(config_list) - 1
+        streamed = []
+
+        async def on_content(content):
+            streamed.append(content)
+            await on_chunk(content)
+
+        for i, each_config in enumerate(config_list):
+            base_config = config.copy()
+            base_config.update(each_config)
+            base_config.pop("max_retry_period", None)
+            base_config.pop("retry_wait_time", None)
+            params = cls._construct_params(context, base_config, allow_format_str_template=allow_format_str_template)
+            try:
+                return await cls._astream_response(params, on_content)
+            except (AuthenticationError, RateLimitError, Timeout, InvalidRequestError, APIError, APIConnectionError):
+                logger.debug(f"failed with config {i}", exc_info=1)
+                if i == last or streamed:
+                    raise
+
+    @classmethod
+    async def _astream_response(cls, params: Dict, on_content: Callable):
+        openai.aiosession.set(cls._get_aiosession())
+        request_timeout = params.pop("request_timeout", cls.request_timeout)
+        model = params.get("model")
+        content = []
+        function_call = None
+        finish_reason = None
+
+        async with cls._get_key_semaphore(params.get("api_key") or openai.api_key):
+            chunks = await openai.ChatCompletion.acreate(stream=True, request_timeout=request_timeout, **params)
+            async for chunk in chunks:
+                model = chunk.get("model", model)
+                if not chunk["choices"]:
+                    continue
+                choice = chunk["choices"][0]
+                delta = choice.get("delta", {})
+                if delta.get("content"):
+                    content.append(delta["content"])
+                    await on_content(delta["content"])
+                if delta.get("function_call"):
+                    if function_call is None:
+                        function_call = {"name": "", "arguments": ""}
+                    function_call["name"] += delta["function_call"].get("name") or ""
+                    function_call["arguments"] += delta["function_call"].get("arguments") or ""
+                finish_reason = choice.get("finish_reason") or finish_reason
+
+        message = {"role": "assistant", "content": "".join(content)}
+        if function_call is not None:
+            message["content"] = message["content"] or None
+            message["function_call"] = function_call
+        return {
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "cost": 0,
+        }
 
     @classmethod
     def instantiate(
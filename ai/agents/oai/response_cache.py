@@ -0,0 +1,140 @@
+import hashlib
+import json
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+# Keys which don't change the response: credentials and retry settings. The endpoint (api_base,
+# api_type) stays in the key, another deployment can serve another model under the same name.
+NON_RESPONSE_KEYS = {
+    "api_key",
+    "api_version",
+    "api_key_path",
+    "request_timeout",
+    "max_retry_period",
+    "retry_wait_time",
+}
+
+
+def normalize_key(config: Dict) -> str:
+    """Get the cache key of a request config.
+
+    The key depends on what changes the response (messages or prompt, the model parameters and the endpoint), so
+    the same request made with another api key or retry setting hits the same entry.
+    """
+    normalized = {k: v for k, v in config.items() if k not in NON_RESPONSE_KEYS}
+    if "model" in normalized:
+        normalized["model"] = normalized["model"].replace("gpt-35-turbo", "gpt-3.5-turbo")
+    data = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Response cache shared by all the sessions of the process.
+
+    An in-memory LRU of `memory_size` entries sits in front of a diskcache bounded to `size_limit` bytes.
+    Entries expire after `ttl` seconds (None to keep them until they are evicted).
+    Responses are copied on the way out, callers are free to modify them.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        memory_size: Optional[int] = 1024,
+        size_limit: Optional[int] = 2 ** 30,
+        ttl: Optional[float] = None,
+    ):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self._disk = diskcache.Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "sets": 0,
+            "lookup_seconds": 0.0,
+            "miss_seconds": 0.0,
+        }
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _remember(self, key, data, expire_at):
+        with self._lock:
+            self._memory[key] = (data, expire_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def get(self, key, default=None):
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                entry = self._memory.get(key)
+                if entry is not None:
+                    data, expire_at = entry
+                    if expire_at is None or expire_at > time.time():
+                        self._memory.move_to_end(key)
+                        self._counters["memory_hits"] += 1
+                        return pickle.loads(data)
+                    del self._memory[key]
+
+            value, expire_at = self._disk.get(key, default=None, expire_time=True)
+            if value is None:
+                self._count("misses")
+                return default
+            self._count("disk_hits")
+            self._remember(key, pickle.dumps(value), expire_at)
+            return value
+        finally:
+            self._count("lookup_seconds", time.perf_counter() - start)
+
+    def set(self, key, value):
+        expire_at = time.time() + self.ttl if self.ttl is not None else None
+        self._disk.set(key, value, expire=self.ttl)
+        self._remember(key, pickle.dumps(value), expire_at)
+        self._count("sets")
+
+    def record_miss(self, seconds: float):
+        """Record the time spent getting a response which was not cached."""
+        self._count("miss_seconds", seconds)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        self._disk.clear()
+
+    def close(self):
+        with self._lock:
+            self._memory.clear()
+        self._disk.close()
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and latencies since the cache was opened."""
+        with self._lock:
+            counters = dict(self._counters)
+            memory_entries = len(self._memory)
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        lookups = hits + counters["misses"]
+        return {
+            "hits": hits,
+            "memory_hits": counters["memory_hits"],
+            "disk_hits": counters["disk_hits"],
+            "misses": counters["misses"],
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "avg_lookup_ms": 1000 * counters["lookup_seconds"] / lookups if lookups else 0.0,
+            "avg_miss_ms": 1000 * counters["miss_seconds"] / counters["misses"] if counters["misses"] else 0.0,
+            "memory_entries": memory_entries,
+            "disk_bytes": self._disk.volume(),
+        }
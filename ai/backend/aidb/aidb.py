@@ -5,7 +5,7 @@ from ai.backend.base_config import CONFIG
 import re
 import ast
 import json
-from ai.backend.util.token_util import num_tokens_from_messages
+from ai.backend.util.token_util import exceeds_token_limit, num_tokens_from_messages
 import os
 import time
 from ai.backend.util import base_util
@@ -77,10 +77,7 @@ class AIDB:
             }
         ]
 
-        num_tokens = num_tokens_from_messages(message, model='gpt-4')
-        print('num_tokens: ', num_tokens)
-
-        if num_tokens < CONFIG.max_token_num:
+        if not exceeds_token_limit(message, CONFIG.max_token_num, model='gpt-4'):
             table_content = []
             if q_str.get('table_desc'):
                 for tb in q_str.get('table_desc'):
@@ -211,6 +208,7 @@ class AIDB:
             print(" 最终 q_str : ", q_str)
             await self.put_message(200, CONFIG.talker_bi, CONFIG.type_comment, q_str)
         else:
+            num_tokens = num_tokens_from_messages(message, model='gpt-4')
             if self.language_mode == CONFIG.language_chinese:
                 content = '所选表格' + str(num_tokens) + ' , 超过了最大长度:' + str(CONFIG.max_token_num) + ' , 请重新选择'
             else:
@@ -229,6 +227,12 @@ class AIDB:
                                 time.localtime())) + ' ---- ' + "from user:[{}".format(
             self.user_name) + "], reply a message:{}".format(consume_output))
 
+    async def put_stream_message(self, content, is_final=False):
+        """ Send a piece of a streamed llm reply to the user, then the whole reply once it is complete """
+        data_type = CONFIG.type_answer_chunk_end if is_final else CONFIG.type_answer_chunk
+        mess = {'state': 200, 'data': {'data_type': data_type, 'content': content}, 'receiver': CONFIG.talker_user}
+        await asyncio.wait_for(self.websocket.send(json.dumps(mess)), timeout=CONFIG.request_timeout)
+
     async def check_api_key(self):
         self.agent_instance_util.api_key_use = True
 
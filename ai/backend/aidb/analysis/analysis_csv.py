@@ -1,14 +1,14 @@
+import asyncio
 import traceback
 import json
 from ai.backend.util.write_log import logger
 from ai.backend.base_config import CONFIG
 from .analysis import Analysis
-import pandas as pd
 from ai.backend.util import base_util
 import re
 import ast
 from ai.agents.agentchat import TaskSelectorAgent
-import chardet
+from ai.backend.util.csv_profile import get_csv_profile
 
 language_chinese = CONFIG.language_chinese
 max_retry_times = CONFIG.max_retry_times
@@ -102,16 +102,12 @@ class AnalysisCsv(Analysis):
             for tb in q_str.get('table_desc'):
                 if len(tb.get('field_desc')) == 0:
 
-                    # Read file and detect encoding
+                    # Encoding and columns from a sample of the file, cached until the file changes
                     csv_file = CONFIG.up_file_path + tb.get('table_name')
-                    f = open(csv_file, 'rb')
-                    # Read the file using the detected encoding
-                    encoding = chardet.detect(f.read())['encoding']
-                    f.close()
-                    data = pd.read_csv(open(csv_file, encoding=encoding, errors='ignore'))
+                    profile = await asyncio.get_running_loop().run_in_executor(None, get_csv_profile, csv_file)
 
                     # Get column headers (first row of data)
-                    column_titles = list(data.columns)
+                    column_titles = profile['columns']
                     # print("column_titles ：", column_titles)
 
                     for i in range(len(column_titles)):
@@ -218,7 +214,7 @@ class AnalysisCsv(Analysis):
             for i in range(max_retry_times):
                 try:
                     planner_user = self.agent_instance_util.get_agent_planner_user()
-                    analyst = self.agent_instance_util.get_agent_analyst()
+                    analyst = self.agent_instance_util.get_agent_analyst(stream_callback=self.put_stream_message)
 
                     question_supplement = 'Please make an analysis and summary in English, including which charts were generated, and briefly introduce the contents of these charts.'
                     if self.language_mode == language_chinese:
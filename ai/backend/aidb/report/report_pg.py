@@ -7,7 +7,7 @@ from ai.backend.util import database_util
 from ai.agents.agentchat import HumanProxyAgent, TaskSelectorAgent
 
 max_retry_times = CONFIG.max_retry_times
-from ai.backend.util.token_util import num_tokens_from_messages
+from ai.backend.util.token_util import exceeds_token_limit
 
 
 class ReportPostgresql(Report):
@@ -158,9 +158,7 @@ class ReportPostgresql(Report):
                     }
                 ]
 
-                num_tokens = num_tokens_from_messages(message, model='gpt-4')
-                print("num_tokens : ", num_tokens)
-                if num_tokens < 20000:
+                if not exceeds_token_limit(message, 20000, model='gpt-4'):
                     error_times = 0
                     for i in range(max_retry_times):
                         try:
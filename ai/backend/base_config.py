@@ -11,6 +11,13 @@ class Config():
         self.request_timeout = 55
         self.max_retry_period = 90
         self.max_retry_times = 3
+        self.report_task_concurrency = 3
+        self.bi_reply_timeout = 100
+        self.history_max_tokens = 6000
+        self.history_max_message_tokens = 2000
+        self.ws_workers = base_util.get_ws_workers()
+        self.ws_drain_timeout = 60
+        self.ws_status_path = '/status'
         self.up_file_path = base_util.get_upload_path()
 
         self.web_server_ip = base_util.get_web_server_ip()
@@ -35,6 +42,8 @@ class Config():
         self.type_comment_second = 'mysql_comment_second'
         self.type_data_check = 'data_check'
         self.type_answer = 'answer'
+        self.type_answer_chunk = 'answer_chunk'
+        self.type_answer_chunk_end = 'answer_chunk_end'
         self.type_question = 'question'
         self.type_log_data = 'log_data'
         self.type_test = 'test'
@@ -63,6 +72,21 @@ database_model = 'online'
 request_timeout = 55
 max_retry_period = 90
 max_retry_times = 3
+# Number of report charts generated at the same time
+report_task_concurrency = 3
+# Seconds to wait for BI to reply to a request
+bi_reply_timeout = 100
+# Token budget of the conversation history sent to the llm by an agent (the task message and the
+# latest messages are kept, older ones dropped), None to send it whole
+history_max_tokens = 6000
+# Messages of the history longer than this (query results, tool outputs) are cut in the middle
+history_max_message_tokens = 2000
+# Number of websocket server processes (AI_WS_WORKERS), each connection stays on the process that accepted it
+ws_workers = base_util.get_ws_workers()
+# Seconds a stopping websocket server process waits for its sessions to end before closing them
+ws_drain_timeout = 60
+# HTTP path answering with the number of sessions per websocket server process
+ws_status_path = '/status'
 csv_file_path = base_util.get_upload_path()
 print('csv_file_path :', csv_file_path)
 
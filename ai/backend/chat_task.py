@@ -9,6 +9,7 @@ from ai.backend.base_config import CONFIG
 from ai.backend.aidb.report import ReportMysql, ReportPostgresql
 from ai.backend.aidb.analysis import AnalysisMysql, AnalysisCsv, AnalysisPostgresql
 from ai.backend.aidb import AIDB
+from ai.backend.util.bi_router import BIRouter
 
 message_pool: ChatMemoryManager = ChatMemoryManager(name="message_pool")
 
@@ -19,6 +20,7 @@ class ChatClass:
         self.incoming = asyncio.Queue()
         self.outgoing = asyncio.Queue()
         self.path = path
+        self.bi_router = BIRouter()
         # Messages that cannot be processed currently are temporarily stored.
         self.delay_messages = {'user': [], 'bi': {'mysql_code': [], 'chart_code': [],
                                                   'delete_chart': [], 'ask_data': []}, 'close': []}
@@ -36,6 +38,7 @@ class ChatClass:
                                                      delay_messages=self.delay_messages,
                                                      outgoing=self.outgoing,
                                                      incoming=self.incoming,
+                                                     bi_router=self.bi_router,
                                                      )
         self.agent_instance_util.set_socket(websocket)
         self.agent_instance_util.set_language_mode(CONFIG.default_language_mode)
@@ -51,13 +54,45 @@ class ChatClass:
         self.reportMysql = ReportMysql(self)
         self.reportPostgresql = ReportPostgresql(self)
 
-    async def get_message(self):
-        """ Receive messages and put them into the [pending] message queue """
-        msg_in = await self.ws.recv()
-        await self.incoming.put(msg_in)
-        print(str(time.strftime("%Y-%m-%d %H:%M:%S",
-                                time.localtime())) + ' ---- ' + "from user:[{}".format(
-            self.user_name) + "], got a message:{}".format(msg_in))
+    async def read_messages(self):
+        """ The only reader of the socket. BI replies go to the request waiting for them,
+        heartbeats are answered right away, everything else is put into the [pending] message queue """
+        try:
+            async for msg_in in self.ws:
+                print(str(time.strftime("%Y-%m-%d %H:%M:%S",
+                                        time.localtime())) + ' ---- ' + "from user:[{}".format(
+                    self.user_name) + "], got a message:{}".format(msg_in))
+
+                if self.bi_router.dispatch(msg_in):
+                    continue
+
+                if self.is_heart_check(msg_in):
+                    result = {'state': 200, 'data': {}, 'receiver': 'heartCheck'}
+                    await self.outgoing.put(json.dumps(result))
+                    continue
+
+                await self.incoming.put(msg_in)
+        finally:
+            self.bi_router.close()
+
+    @staticmethod
+    def is_heart_check(message):
+        try:
+            json_str = json.loads(message)
+        except ValueError:
+            return False
+        return isinstance(json_str, dict) and json_str.get('sender') == 'heartCheck'
+
+    async def send_messages(self):
+        """ Send the messages of the outgoing queue """
+        while True:
+            msg_out = await self.produce()
+            await self.send_message(msg_out)
+
+    async def consume_messages(self):
+        """ Process the received messages one by one """
+        while True:
+            await self.consume()
 
     async def send_message(self, message):
         print(str(time.strftime("%Y-%m-%d %H:%M:%S",
@@ -1,48 +1,160 @@
 import asyncio
+import http
+import json
+import multiprocessing
+import os
+import signal
 import websockets
 import time
 from ai.backend.chat_task import ChatClass
+from ai.backend.base_config import ws_workers, ws_drain_timeout, ws_status_path
 
 
 class WSServer:
+    """ Websocket server of the AI backend.
 
-    def __init__(self, server_port):
+    With several workers, each one is a process listening on the same port (SO_REUSEPORT), the kernel spreads the
+    connections between them and a connection stays on the process that accepted it, with its ChatClass.
+    SIGHUP starts new workers and lets the old ones drain, SIGTERM/SIGINT drains and stops.
+    """
+
+    def __init__(self, server_port, workers=None):
         self.server_port = server_port
+        self.workers = workers or ws_workers
+        self.sessions = 0
+        # (pid, sessions) of every worker, shared between the processes; two slots per worker for restarts
+        self._stats = None
+        self._slot = None
 
     def serve_forever(self):
+        if self.workers > 1:
+            self._run_master()
+        else:
+            self._run_worker()
+
+    def _run_master(self):
+        self._stats = multiprocessing.Array('q', 4 * self.workers, lock=False)
+        generation = 0
+        processes = [self._start_worker(i) for i in range(self.workers)]
+        draining = []
+        events = []
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: events.append('stop'))
+        signal.signal(signal.SIGINT, lambda signum, frame: events.append('stop'))
+        signal.signal(signal.SIGHUP, lambda signum, frame: events.append('restart'))
+
+        print(str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
+        print("=== start WebSocket server with {} workers ===".format(self.workers))
+
+        while 'stop' not in events:
+            time.sleep(1)
+            if 'restart' in events:
+                events.clear()
+                generation += 1
+                print("restart workers, generation {}".format(generation))
+                old_processes = processes
+                processes = [self._start_worker((generation % 2) * self.workers + i) for i in range(self.workers)]
+                for process in old_processes:
+                    process.terminate()
+                draining.extend(old_processes)
+
+            draining = [process for process in draining if process.is_alive()]
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    print("worker {} exited with code {}, restarting it".format(process.pid, process.exitcode))
+                    processes[i] = self._start_worker((generation % 2) * self.workers + i)
+
+        for process in processes + draining:
+            process.terminate()
+        for process in processes + draining:
+            process.join()
+
+    def _start_worker(self, slot):
+        process = multiprocessing.Process(target=self._run_worker, args=(slot,), daemon=False)
+        process.start()
+        return process
+
+    def _run_worker(self, slot=None):
+        self._slot = slot
+        if slot is not None:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._serve(reuse_port=slot is not None))
+        finally:
+            self._report(pid=0)
+            loop.close()
+
+    async def _serve(self, reuse_port=False):
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+
         server_ip = "0.0.0.0"
         # server_port = 5001
         server_port = self.server_port
-        start_server = websockets.serve(self.handler, server_ip, server_port, ping_interval=None)
+        server = await websockets.serve(self.handler, server_ip, server_port, ping_interval=None,
+                                        process_request=self.process_request, reuse_port=reuse_port)
+        self._report()
 
-        # start_server = websockets.serve(lambda x, y: router(x, y), server_ip, server_port, ping_interval=None)
         print(str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
-        print("=== start WebSocket server ===")
+        print("=== start WebSocket server === pid:{}".format(os.getpid()))
         print("start listen " + server_ip + ":" + str(server_port))
 
-        # start_server = websockets.serve(self.handler, '0.0.0.0', 5678)
-        asyncio.get_event_loop().run_until_complete(start_server)
-        asyncio.get_event_loop().run_forever()
+        await stop
+
+        # stop accepting connections, let the current sessions end
+        server.server.close()
+        print("draining {} sessions, pid:{}".format(self.sessions, os.getpid()))
+        deadline = time.time() + ws_drain_timeout
+        while self.sessions > 0 and time.time() < deadline:
+            await asyncio.sleep(1)
+        server.close()
+        await server.wait_closed()
+
+    def _report(self, pid=None):
+        if self._stats is None or self._slot is None:
+            return
+        self._stats[2 * self._slot] = os.getpid() if pid is None else pid
+        self._stats[2 * self._slot + 1] = self.sessions if pid is None else 0
+
+    def status(self):
+        """ Number of sessions of every worker """
+        if self._stats is None:
+            workers = [{'pid': os.getpid(), 'sessions': self.sessions}]
+        else:
+            workers = [{'pid': self._stats[i], 'sessions': self._stats[i + 1]}
+                       for i in range(0, len(self._stats), 2) if self._stats[i]]
+        return {'workers': workers, 'sessions': sum(worker['sessions'] for worker in workers)}
+
+    async def process_request(self, path, request_headers):
+        if path != ws_status_path:
+            return None
+        body = json.dumps(self.status()).encode()
+        return http.HTTPStatus.OK, [('Content-Type', 'application/json')], body
 
     async def handler(self, websocket, path):
+        self.sessions += 1
+        self._report()
+        try:
+            await self.chat(websocket, path)
+        finally:
+            self.sessions -= 1
+            self._report()
+
+    async def chat(self, websocket, path):
         master = ChatClass(websocket, path)
 
-        while True:
-            listener_task = asyncio.ensure_future(master.get_message())
-            producer_task = asyncio.ensure_future(master.produce())
-            done, pending = await asyncio.wait(
-                [listener_task, producer_task],
-                return_when=asyncio.FIRST_COMPLETED)
-
-            if listener_task in done:
-                await master.consume()
-            else:
-                listener_task.cancel()
-
-            if producer_task in done:
-                msg_to_send = producer_task.result()
-                await master.send_message(msg_to_send)
-            else:
-                producer_task.cancel()
+        # The reader keeps reading while a question is being processed, so BI replies reach the
+        # agents waiting for them without the agents reading the socket themselves.
+        producer_task = asyncio.ensure_future(master.send_messages())
+        consumer_task = asyncio.ensure_future(master.consume_messages())
+        try:
+            await master.read_messages()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            producer_task.cancel()
+            consumer_task.cancel()
@@ -42,6 +42,14 @@ def get_web_server_ip():
     else:
         return None
 
+
+def get_ws_workers():
+    ws_workers = os.environ.get("AI_WS_WORKERS", None)
+    if ws_workers and len(str(ws_workers)) > 0:
+        return max(int(ws_workers), 1)
+    else:
+        return 1
+
 def dbinfo_encode(json_data):
     if json_data.get('user'):
         json_data['user'] = user_secret
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import time
+
+
+class BIRouter:
+    """ Matches the replies of BI to the requests waiting for them.
+
+    The connection has a single reader (see ChatClass.read_messages), which passes every message to `dispatch`.
+    Replies are matched by `id`, so several requests can wait at the same time and each one completes as soon
+    as its reply arrives.
+    """
+
+    def __init__(self):
+        # ids look like the timestamps used before, but are unique per connection
+        self._next_id = int(time.time() * 1000)
+        self._pending = {}
+
+    def new_id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+    async def request(self, websocket, message, timeout):
+        """ Send `message` (its 'id' is set here) and return the parsed reply, or None if there is none in time """
+        request_id = self.new_id()
+        message['id'] = request_id
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await websocket.send(json.dumps(message))
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._pending.pop(request_id, None)
+
+    def dispatch(self, message):
+        """ Hand a received message to the request waiting for it. Returns False if no one is waiting for it """
+        try:
+            json_str = json.loads(message)
+        except ValueError:
+            return False
+        if not isinstance(json_str, dict) or json_str.get('sender') != 'bi':
+            return False
+
+        future = self._pending.get(str(json_str.get('id')))
+        if future is None or future.done():
+            return False
+
+        future.set_result(json_str)
+        return True
+
+    def close(self):
+        """ Fail the requests still waiting, the connection is gone """
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("websocket connection closed"))
+        self._pending.clear()
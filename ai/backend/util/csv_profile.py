@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+
+import chardet
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# Bytes read to detect the encoding of a file
+ENCODING_SAMPLE_BYTES = 64 * 1024
+# Rows read to infer the column types and stats
+SAMPLE_ROWS = 1000
+# Number of profiles kept in memory
+MAX_PROFILES = 256
+
+# Encodings detected on a sample, replaced by a superset in case the rest of the file uses more characters
+ENCODING_SUPERSETS = {
+    'ascii': 'utf-8',
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030',
+}
+
+_profiles = OrderedDict()
+_lock = threading.Lock()
+
+
+def detect_encoding(csv_file):
+    """ Detect the encoding of a file from its first bytes """
+    with open(csv_file, 'rb') as f:
+        sample = f.read(ENCODING_SAMPLE_BYTES)
+    encoding = chardet.detect(sample)['encoding'] or 'utf-8'
+    return ENCODING_SUPERSETS.get(encoding.lower(), encoding)
+
+
+def columnar_path(csv_file):
+    """ Path of the parquet copy of an uploaded csv file (written by BI after the upload), None if there is none """
+    parquet_file = os.path.splitext(csv_file)[0] + '.parquet'
+    if pq is not None and os.path.isfile(parquet_file):
+        return parquet_file
+    return None
+
+
+def _to_python(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _column_stats(series):
+    stats = {
+        'dtype': str(series.dtype),
+        'non_null': int(series.count()),
+    }
+    if pd.api.types.is_numeric_dtype(series) and stats['non_null']:
+        stats['min'] = _to_python(series.min())
+        stats['max'] = _to_python(series.max())
+    else:
+        stats['examples'] = [str(value) for value in series.dropna().unique()[:3]]
+    return stats
+
+
+def _build_parquet_profile(csv_file, parquet_file):
+    """ Profile from the parquet metadata: types, row count and stats of the whole file, without reading rows """
+    parquet = pq.ParquetFile(parquet_file)
+    metadata = parquet.metadata
+    column_stats = {}
+    for i, field in enumerate(parquet.schema_arrow):
+        stats = {'dtype': str(field.type), 'non_null': metadata.num_rows}
+        for row_group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(row_group).column(i).statistics
+            if statistics is None:
+                continue
+            stats['non_null'] -= statistics.null_count
+            if statistics.has_min_max and field.type.to_pandas_dtype() != object:
+                stats['min'] = min(stats.get('min', statistics.min), statistics.min)
+                stats['max'] = max(stats.get('max', statistics.max), statistics.max)
+        column_stats[field.name] = stats
+    return {
+        'encoding': detect_encoding(csv_file),
+        'columns': list(column_stats),
+        'rows': metadata.num_rows,
+        'parquet_path': parquet_file,
+        'column_stats': column_stats,
+    }
+
+
+def _build_profile(csv_file):
+    parquet_file = columnar_path(csv_file)
+    if parquet_file is not None:
+        return _build_parquet_profile(csv_file, parquet_file)
+    encoding = detect_encoding(csv_file)
+    sample = pd.read_csv(csv_file, encoding=encoding, encoding_errors='ignore', nrows=SAMPLE_ROWS)
+    return {
+        'encoding': encoding,
+        'columns': [str(column) for column in sample.columns],
+        'sample_rows': len(sample),
+        'column_stats': {str(column): _column_stats(sample[column]) for column in sample.columns},
+    }
+
+
+def get_csv_profile(csv_file):
+    """ Encoding, columns and column types/stats (from a sample of rows) of a csv file.
+
+    Profiles are cached by path, modification time and size, so a file is only read again after it changes.
+    Once the parquet copy of the file exists, the profile comes from its metadata.
+    """
+    stat = os.stat(csv_file)
+    key = (os.path.abspath(csv_file), stat.st_mtime_ns, stat.st_size, columnar_path(csv_file))
+    with _lock:
+        profile = _profiles.get(key)
+        if profile is not None:
+            _profiles.move_to_end(key)
+            return profile
+
+    profile = _build_profile(csv_file)
+    with _lock:
+        _profiles[key] = profile
+        while len(_profiles) > MAX_PROFILES:
+            _profiles.popitem(last=False)
+    return profile
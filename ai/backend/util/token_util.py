@@ -1,17 +1,54 @@
+from functools import lru_cache
 import tiktoken
 
+# 流式计数时每次编码的字符数
+ENCODE_CHUNK_SIZE = 4096
 
-# 定义函数 num_tokens_from_messages，该函数返回由一组消息所使用的token数。
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
-    """Return the number of tokens used by a list of messages."""
-    # 尝试获取模型的编码
+
+# 编码器的创建开销较大，每个模型只创建一次
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the (shared) tiktoken encoding of a model."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         # 如果模型没有找到，使用 cl100k_base 编码并给出警告
         print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    # 针对不同的模型设置token数量
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_upper_bound(text):
+    """Return an upper bound of the number of tokens of a text, without encoding it: a token is at least one byte."""
+    return len(text.encode("utf-8"))
+
+
+def approx_num_tokens(text):
+    """Return a rough estimate of the number of tokens of a text, without encoding it (about 4 bytes per token)."""
+    return (num_tokens_upper_bound(text) + 3) // 4
+
+
+def _encode_upto(encoding, text, max_tokens):
+    """ Count the tokens of a text, in chunks, stopping as soon as the count is over max_tokens """
+    if num_tokens_upper_bound(text) <= max_tokens:
+        return len(encoding.encode(text))
+    num_tokens = 0
+    start = 0
+    while start < len(text) and num_tokens <= max_tokens:
+        end = start + ENCODE_CHUNK_SIZE
+        if end < len(text):
+            # 在换行处切分，避免把一个token切成两半
+            newline = text.rfind("\n", start, end)
+            if newline > start:
+                end = newline + 1
+        num_tokens += len(encoding.encode(text[start:end]))
+        start = end
+    return num_tokens
+
+
+@lru_cache(maxsize=None)
+def _model_token_params(model):
+    """ Return (encoding, tokens_per_message, tokens_per_name) of a model, None for gpt-3 models """
+    encoding = get_encoding(model)
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -28,11 +65,11 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
     elif "gpt-3.5-turbo" in model:
         # 对于 gpt-3.5-turbo 模型可能会有更新，此处返回假设为 gpt-3.5-turbo-0613 的token数量，并给出警告
         print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+        return _model_token_params("gpt-3.5-turbo-0613")
     elif "gpt-4" in model:
         # 对于 gpt-4 模型可能会有更新，此处返回假设为 gpt-4-0613 的token数量，并给出警告
         print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        return _model_token_params("gpt-4-0613")
     elif model in {
         "davinci",
         "curie",
@@ -40,31 +77,52 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
         "ada"
     }:
         print("Warning: gpt-3 related model is used. Returning num tokens assuming gpt2.")
-        encoding = tiktoken.get_encoding("gpt2")
-        num_tokens = 0
-        # only calc the content
-        for message in messages:
-            for key, value in message.items():
-                if key == "content":
-                    num_tokens += len(encoding.encode(value))
-        return num_tokens
+        return tiktoken.get_encoding("gpt2"), None, None
     else:
         # 对于没有实现的模型，抛出未实现错误
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
+    return encoding, tokens_per_message, tokens_per_name
+
+
+# 定义函数 num_tokens_from_messages，该函数返回由一组消息所使用的token数。
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo", max_tokens=None):
+    """Return the number of tokens used by a list of messages.
+
+    With max_tokens, counting stops as soon as the count is over it: the result is only known to be greater
+    than max_tokens beyond it. Long texts are then encoded in chunks, which can be off by a few tokens.
+    """
+    encoding, tokens_per_message, tokens_per_name = _model_token_params(model)
+    limit = max_tokens if max_tokens is not None else float("inf")
     num_tokens = 0
+    if tokens_per_message is None:
+        # only calc the content
+        for message in messages:
+            for key, value in message.items():
+                if key == "content":
+                    num_tokens += _encode_upto(encoding, value, limit - num_tokens)
+                    if num_tokens > limit:
+                        return num_tokens
+        return num_tokens
     # 计算每条消息的token数
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            num_tokens += _encode_upto(encoding, value, limit - num_tokens)
             if key == "name":
                 num_tokens += tokens_per_name
+            if num_tokens > limit:
+                return num_tokens
     num_tokens += 3  # 每条回复都以助手为首
     return num_tokens
 
 
+def exceeds_token_limit(messages, max_tokens, model="gpt-4"):
+    """Return whether a list of messages uses more than max_tokens tokens, encoding no more than needed."""
+    return num_tokens_from_messages(messages, model=model, max_tokens=max_tokens) > max_tokens
+
+
 if __name__ == '__main__':
     message = [
         {
@@ -13,9 +13,10 @@ ai = AppGroup(help="ai")
 
 
 @ai.command()
-def run_ai():
+@click.option("--workers", type=int, default=None, help="Number of server processes (default: AI_WS_WORKERS or 1).")
+def run_ai(workers=None):
     server_port = 8339
-    s = WSServer(server_port)
+    s = WSServer(server_port, workers=workers)
     s.serve_forever()
 
 
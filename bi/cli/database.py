@@ -56,6 +56,34 @@ def create_tables():
         # To create triggers for searchable models, we need to call configure_mappers().
         sqlalchemy.orm.configure_mappers()
         db.create_all()
+    else:
+        _upgrade_tables(db)
+
+
+# Columns added to existing tables, created by create_all() on new databases only.
+ADDED_COLUMNS = [
+    ("data_source_file", "columnar_file_name", "VARCHAR(255)"),
+    ("data_source_file", "row_count", "INTEGER"),
+    ("data_source_file", "column_stats", "TEXT"),
+]
+
+
+def _upgrade_tables(db):
+    with db.engine.begin() as connection:
+        for table, column, column_type in ADDED_COLUMNS:
+            connection.execute(
+                "ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {};".format(table, column, column_type)
+            )
+
+
+@manager.command()
+def upgrade_tables():
+    """Add the columns missing from the tables of an existing database."""
+    from bi.models import db
+
+    _wait_for_db_connection(db)
+    _upgrade_tables(db)
+    print("Added the missing columns ({} checked).".format(len(ADDED_COLUMNS)))
 
 
 @manager.command()
@@ -120,3 +148,58 @@ def reencrypt(old_secret, new_secret, show_sql):
 
     _reencrypt_for_table("data_sources", "DataSource")
     _reencrypt_for_table("notification_destinations", "NotificationDestination")
+
+
+@manager.command()
+@option("--batch-size", default=100, help="number of query results to convert per transaction")
+@option("--to-json/--no-to-json", default=False, help="convert columnar results back to JSON")
+def convert_query_results(batch_size, to_json):
+    """Re-encode stored query results to the columnar format (or back to JSON)."""
+    from bi.models import db, columnar
+    from bi.utils import json_dumps, json_loads
+
+    _wait_for_db_connection(db)
+
+    query_results = sqlalchemy.Table(
+        "query_results",
+        sqlalchemy.MetaData(),
+        Column("id", key_type("QueryResult"), primary_key=True),
+        Column("data", db.Text),
+    )
+
+    last_id = 0
+    converted = 0
+    while True:
+        batch = db.session.execute(
+            select([query_results])
+            .where(query_results.c.id > last_id)
+            .order_by(query_results.c.id)
+            .limit(batch_size)
+        ).fetchall()
+
+        if not batch:
+            break
+
+        for item in batch:
+            last_id = item["id"]
+            value = item["data"]
+
+            if to_json and columnar.is_columnar(value):
+                value = json_dumps(columnar.decode(value))
+            elif not to_json and value and not columnar.is_columnar(value):
+                data = json_loads(value)
+                if not isinstance(data, dict) or "rows" not in data:
+                    continue
+                value = columnar.encode(data)
+            else:
+                continue
+
+            db.session.execute(
+                query_results.update()
+                .where(query_results.c.id == item["id"])
+                .values(data=value)
+            )
+            converted += 1
+
+        db.session.commit()
+        print("Converted {} query results (last id: {}).".format(converted, last_id))
@@ -4,7 +4,7 @@ import sys
 import datetime
 from itertools import chain
 
-from click import argument
+from click import argument, option
 from flask.cli import AppGroup
 from rq import Connection
 from rq.worker import WorkerStatus
@@ -15,6 +15,7 @@ from supervisor_checks.check_modules import base
 from bi import rq_redis_connection
 from bi.tasks import (
     Worker,
+    SimpleWorker,
     rq_scheduler,
     schedule_periodic_jobs,
     periodic_job_definitions,
@@ -33,7 +34,12 @@ def scheduler():
 
 @manager.command()
 @argument("queues", nargs=-1)
-def worker(queues):
+@option(
+    "--no-fork/--fork",
+    default=False,
+    help="run jobs in the worker process, keeping pooled data source connections between jobs",
+)
+def worker(queues, no_fork):
     # Configure any SQLAlchemy mappers loaded until now so that the mapping configuration
     # will already be available to the forked work horses and they won't need
     # to spend valuable time re-doing that on every fork.
@@ -45,7 +51,8 @@ def worker(queues):
         queues = chain(*[queue.split(",") for queue in queues])
 
     with Connection(rq_redis_connection):
-        w = Worker(queues, log_job_description=False, job_monitoring_interval=5)
+        worker_class = SimpleWorker if no_fork else Worker
+        w = worker_class(queues, log_job_description=False, job_monitoring_interval=5)
         w.work()
 
 
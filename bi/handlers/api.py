@@ -23,8 +23,10 @@ from bi.handlers.dashboards import (
 from bi.handlers.data_sources import (
     DataSourceListResource,
     DataSourcePauseResource,
+    DataSourcePreviewResource,
     DataSourceResource,
     DataSourceSchemaResource,
+    DataSourceSchemaSearchResource,
     DataSourceTestResource,
     DataSourceTypeListResource,
 )
@@ -161,6 +163,11 @@ api.add_org_resource(
 api.add_org_resource(
     DataSourceSchemaResource, "/api/data_sources/<data_source_id>/schema"
 )
+api.add_org_resource(
+    DataSourceSchemaSearchResource,
+    "/api/data_sources/<data_source_id>/schema/search",
+    endpoint="data_source_schema_search",
+)
 api.add_org_resource(
     DatabricksDatabaseListResource, "/api/databricks/databases/<data_source_id>"
 )
@@ -176,6 +183,9 @@ api.add_org_resource(
     DataSourcePauseResource, "/api/data_sources/<data_source_id>/pause"
 )
 api.add_org_resource(DataSourceTestResource, "/api/data_sources/<data_source_id>/test")
+api.add_org_resource(
+    DataSourcePreviewResource, "/api/data_sources/<data_source_id>/preview"
+)
 api.add_org_resource(
     DataSourceResource, "/api/data_sources/<data_source_id>", endpoint="data_source"
 )
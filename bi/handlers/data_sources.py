@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import time
 
@@ -6,20 +7,24 @@ from flask_restful import abort
 from funcy import project
 from sqlalchemy.exc import IntegrityError
 
-from bi import models
+from bi import models, settings
 from bi.handlers.base import BaseResource, get_object_or_404, require_fields
 from bi.permissions import (
     require_access,
     require_admin,
     require_permission,
+    not_view_only,
     view_only,
 )
 from bi.query_runner import (
     get_configuration_schema_for_query_runner_type,
     query_runners,
     NotSupported,
+    expand_rows,
+    pool,
 )
-from bi.utils import filter_none
+from bi.models.schema_cache import SEARCH_PREFIX, SEARCH_SUBSTRING
+from bi.utils import filter_none, json_loads
 from bi.utils.configuration import ConfigurationContainer, ValidationError
 from bi.tasks.general import test_connection, get_schema
 from bi.serializers import serialize_job
@@ -88,6 +93,8 @@ class DataSourceResource(BaseResource):
 
             abort(400)
 
+        pool.invalidate(data_source.id)
+
         self.record_event(
             {"action": "edit", "object_id": data_source.id, "object_type": "datasource"}
         )
@@ -218,6 +225,45 @@ class DataSourceSchemaResource(BaseResource):
         return serialize_job(job)
 
 
+class DataSourceSchemaSearchResource(BaseResource):
+    def get(self, data_source_id):
+        """
+        Searches the tables of a data source's schema by name.
+
+        :qparam string q: Text the table names start with, or contain when `mode` is "substring"
+        :qparam string mode: "prefix" (default) or "substring"
+        :qparam number page: Page number to retrieve
+        :qparam number page_size: Number of tables to return per page
+
+        Returns the refresh job when the schema was not loaded yet.
+        """
+        data_source = get_object_or_404(
+            models.DataSource.get_by_id_and_org, data_source_id, self.current_org
+        )
+        require_access(data_source, self.current_user, view_only)
+
+        term = request.args.get("q", "")
+        mode = request.args.get("mode", SEARCH_PREFIX)
+        page = request.args.get("page", 1, type=int)
+        page_size = request.args.get("page_size", 25, type=int)
+
+        if mode not in (SEARCH_PREFIX, SEARCH_SUBSTRING):
+            abort(400, message="mode 必须为 prefix 或 substring。")
+        if page < 1:
+            abort(400, message="页码必须为正整数。")
+        if page_size > 250 or page_size < 1:
+            abort(400, message="每页行数超出范围(1-250)。")
+
+        if not data_source.schema_cache.exists():
+            job = get_schema.delay(data_source.id, False)
+            return serialize_job(job)
+
+        result = data_source.search_schema(term, mode=mode, page=page, page_size=page_size)
+        for table in result["results"]:
+            table.setdefault("comment", [])
+        return result
+
+
 class DataSourcePauseResource(BaseResource):
     @require_admin
     def post(self, data_source_id):
@@ -286,3 +332,52 @@ class DataSourceTestResource(BaseResource):
             }
         )
         return response
+
+
+class DataSourcePreviewResource(BaseResource):
+    @require_permission("execute_query")
+    def post(self, data_source_id):
+        """Runs a small ad-hoc query right away, without a query job, and returns its rows.
+        The query is cancelled on the server when it exceeds the preview time limit."""
+        data_source = get_object_or_404(
+            models.DataSource.get_by_id_and_org, data_source_id, self.current_org
+        )
+        require_access(data_source, self.current_user, not_view_only)
+
+        req = request.get_json(True)
+        require_fields(req, ("query",))
+
+        if data_source.paused:
+            abort(400, message="{} is paused.".format(data_source.name))
+
+        query_runner = data_source.query_runner
+        # The blocking fallback of run_query_async can't be cancelled, it would hold the request
+        # until the query ends whatever the time limit.
+        if not query_runner.supports_async:
+            return {
+                "error": {
+                    "code": 1,
+                    "message": "Data source type does not support previews",
+                }
+            }
+
+        try:
+            data, error = asyncio.run(
+                query_runner.run_query_async(
+                    req["query"],
+                    self.current_user,
+                    timeout=settings.QUERY_PREVIEW_TIMEOUT,
+                    max_rows=settings.QUERY_PREVIEW_MAX_ROWS,
+                )
+            )
+        except Exception as e:
+            data, error = None, str(e)
+
+        self.record_event(
+            {"action": "preview", "object_id": data_source_id, "object_type": "datasource"}
+        )
+
+        if error is not None:
+            return {"error": {"code": 2, "message": "Error running the preview", "details": error}}
+
+        return {"data": expand_rows(json_loads(data))}
@@ -8,6 +8,7 @@ from bi.permissions import (
     require_permission,
 )
 from bi import settings
+from bi.tasks import convert_data_source_file
 
 
 class DataSourceFileResource(BaseResource):  # BaseResource
@@ -76,6 +77,7 @@ class DataSourceFileResource(BaseResource):  # BaseResource
             )
             models.db.session.add(result)
             models.db.session.commit()
+            convert_data_source_file.delay(result.id)
         else:
             abort(400, message='Please upload the csv format file')
         self.record_event(
@@ -108,6 +110,10 @@ class DataSourceFileResource(BaseResource):  # BaseResource
             )
             if os.path.isfile(file_name):
                 os.remove(file_name)
+            if data.columnar_file_name:
+                columnar_file_name = os.path.join(settings.DATA_SOURCE_FILE_DIR, data.columnar_file_name)
+                if os.path.isfile(columnar_file_name):
+                    os.remove(columnar_file_name)
             models.db.session.commit()
         except Exception as e:
             abort(400, message=str(e))
@@ -2,7 +2,7 @@ import logging
 import time
 
 import unicodedata
-from flask import make_response, request
+from flask import make_response, request, Response, stream_with_context
 from flask_login import current_user
 from flask_restful import abort
 from werkzeug.urls import url_quote
@@ -32,8 +32,8 @@ from bi.models.parameterized_query import (
 )
 from bi.serializers import (
     serialize_query_result,
-    serialize_query_result_to_dsv,
-    serialize_query_result_to_xlsx,
+    stream_query_result_to_dsv,
+    stream_query_result_to_xlsx,
     serialize_job,
 )
 
@@ -156,6 +156,29 @@ def content_disposition_filenames(attachment_filename):
     return filenames
 
 
+def get_slice_params(args):
+    """Parse the optional `offset`, `limit`, `columns` and `order_by` query string
+    arguments used to fetch a page of a query result. See `DBPersistence.data_slice` for
+    the cost of a page."""
+    params = {}
+
+    try:
+        if "offset" in args:
+            params["offset"] = max(int(args["offset"]), 0)
+        if "limit" in args:
+            params["limit"] = max(int(args["limit"]), 0)
+    except ValueError:
+        abort(400, message="offset and limit must be integers.")
+
+    if args.get("columns"):
+        params["columns"] = [c for c in args["columns"].split(",") if c]
+
+    if args.get("order_by"):
+        params["order_by"] = args["order_by"]
+
+    return params
+
+
 class QueryResultListResource(BaseResource):
     @require_permission("execute_query")
     def post(self):
@@ -327,6 +350,10 @@ class QueryResultResource(BaseResource):
         :param number query_id: The ID of the query whose results should be fetched
         :param number query_result_id: the ID of the query result to fetch
         :param string filetype: Format to return. One of 'json', 'xlsx', or 'csv'. Defaults to 'json'.
+        :qparam number offset: (json only) Index of the first row to return
+        :qparam number limit: (json only) Maximum number of rows to return
+        :qparam string columns: (json only) Comma separated list of columns to return
+        :qparam string order_by: (json only) Column to sort rows by, prefix with "-" for descending order
 
         :<json number id: Query result ID
         :<json string query: Query that produced this result
@@ -403,7 +430,11 @@ class QueryResultResource(BaseResource):
                 "csv": self.make_csv_response,
                 "tsv": self.make_tsv_response,
             }
-            response = response_builders[filetype](query_result)
+            slice_params = get_slice_params(request.args) if filetype == "json" else {}
+            if slice_params:
+                response = self.make_json_response(query_result, **slice_params)
+            else:
+                response = response_builders[filetype](query_result)
 
             if len(settings.ACCESS_CONTROL_ALLOW_ORIGIN) > 0:
                 self.add_cors_headers(response.headers)
@@ -424,23 +455,27 @@ class QueryResultResource(BaseResource):
             abort(404, message="No cached result found for this query.")
 
     @staticmethod
-    def make_json_response(query_result):
-        data = json_dumps({"query_result": query_result.to_dict()})
+    def make_json_response(query_result, **slice_params):
+        data = json_dumps({"query_result": query_result.to_dict(**slice_params)})
         headers = {"Content-Type": "application/json"}
         return make_response(data, 200, headers)
 
     @staticmethod
     def make_csv_response(query_result):
         headers = {"Content-Type": "text/csv; charset=UTF-8"}
-        return make_response(
-            serialize_query_result_to_dsv(query_result, ","), 200, headers
+        return Response(
+            stream_with_context(stream_query_result_to_dsv(query_result, ",")),
+            200,
+            headers,
         )
 
     @staticmethod
     def make_tsv_response(query_result):
         headers = {"Content-Type": "text/tab-separated-values; charset=UTF-8"}
-        return make_response(
-            serialize_query_result_to_dsv(query_result, "\t"), 200, headers
+        return Response(
+            stream_with_context(stream_query_result_to_dsv(query_result, "\t")),
+            200,
+            headers,
         )
 
     @staticmethod
@@ -448,7 +483,9 @@ class QueryResultResource(BaseResource):
         headers = {
             "Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         }
-        return make_response(serialize_query_result_to_xlsx(query_result), 200, headers)
+        return Response(
+            stream_with_context(stream_query_result_to_xlsx(query_result)), 200, headers
+        )
 
 
 class JobResource(BaseResource):
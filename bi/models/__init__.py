@@ -1,15 +1,18 @@
+import collections
 import datetime
 import calendar
+import itertools
+import threading
 import logging
 import time
 import numbers
 import pytz
 
-from sqlalchemy import distinct, or_, and_, UniqueConstraint, cast
+from sqlalchemy import distinct, or_, and_, UniqueConstraint, cast, inspect
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.event import listens_for
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import backref, contains_eager, joinedload, subqueryload, load_only
+from sqlalchemy.orm import backref, contains_eager, defer, joinedload, subqueryload, load_only
 from sqlalchemy.orm.exc import NoResultFound  # noqa: F401
 from sqlalchemy import func
 from sqlalchemy_utils import generic_relationship
@@ -30,7 +33,11 @@ from bi.query_runner import (
     TYPE_BOOLEAN,
     TYPE_DATE,
     TYPE_DATETIME,
-    BaseQueryRunner)
+    ROW_FORMAT_ARRAY,
+    TABLE_SIZE_FIELDS,
+    BaseQueryRunner,
+    expand_rows)
+from bi.query_runner import pool
 from bi.utils import (
     generate_token,
     json_dumps,
@@ -41,6 +48,8 @@ from bi.utils import (
     gen_query_hash)
 from bi.utils.configuration import ConfigurationContainer
 from bi.models.parameterized_query import ParameterizedQuery
+from bi.models import columnar, json_rows
+from bi.models.schema_cache import SchemaCache, SEARCH_PREFIX
 
 from .base import db, gfk_type, Column, GFKBase, SearchBaseQuery, key_type, primary_key
 from .changes import ChangeTrackingMixin, Change  # noqa
@@ -70,6 +79,7 @@ class ScheduledQueriesExecutions(object):
 
     def update(self, query_id):
         redis_connection.hmset(self.KEY_NAME, {query_id: time.time()})
+        scheduled_queries_due.touch([query_id])
 
     def get(self, query_id):
         timestamp = self.executions.get(str(query_id))
@@ -82,6 +92,113 @@ class ScheduledQueriesExecutions(object):
 scheduled_queries_executions = ScheduledQueriesExecutions()
 
 
+class ScheduledQueriesDue(object):
+    """Redis sorted set of scheduled query ids, scored by the time they should be looked at
+    next. The scheduler only loads the queries whose score has passed and puts them back with
+    their next due time, so a tick costs O(due) instead of O(scheduled).
+
+    Anything that may move a query's due time (schedule, schedule_failures or latest result
+    changes, executions starting) "touches" the query, scoring it 0 so the next tick
+    re-evaluates it. All ids are touched again every QUERY_SCHEDULER_RESYNC_INTERVAL seconds,
+    which also fills the set the first time."""
+
+    KEY_NAME = "sq:due"
+    SYNCED_AT_KEY_NAME = "sq:due:synced_at"
+
+    def touch(self, query_ids):
+        if query_ids:
+            redis_connection.zadd(self.KEY_NAME, {query_id: 0 for query_id in query_ids})
+
+    def schedule(self, due_times):
+        """`due_times` maps query ids to the timestamp they should be looked at next."""
+        if due_times:
+            redis_connection.zadd(self.KEY_NAME, due_times)
+
+    def remove(self, query_ids):
+        if query_ids:
+            redis_connection.zrem(self.KEY_NAME, *query_ids)
+
+    def pop_due(self, now):
+        pipe = redis_connection.pipeline()
+        pipe.zrangebyscore(self.KEY_NAME, "-inf", now)
+        pipe.zremrangebyscore(self.KEY_NAME, "-inf", now)
+        query_ids, _ = pipe.execute()
+        return [int(query_id) for query_id in query_ids]
+
+    def needs_resync(self, now):
+        synced_at = redis_connection.get(self.SYNCED_AT_KEY_NAME)
+        return synced_at is None or now - float(synced_at) >= settings.QUERY_SCHEDULER_RESYNC_INTERVAL
+
+    def resync(self, query_ids, now):
+        self.touch(query_ids)
+        redis_connection.set(self.SYNCED_AT_KEY_NAME, now)
+
+
+scheduled_queries_due = ScheduledQueriesDue()
+
+
+class LatestQueryResults(object):
+    """Redis index of the latest result id (and its retrieval time) per data source and query hash,
+    so looking up a cached result doesn't need to scan `query_results`."""
+
+    KEY_PREFIX = "qr:latest"
+
+    def _key(self, data_source_id, query_hash):
+        return "{}:{}:{}".format(self.KEY_PREFIX, data_source_id, query_hash)
+
+    def get(self, data_source_id, query_hash):
+        value = redis_connection.get(self._key(data_source_id, query_hash))
+        if not value:
+            return None
+
+        query_result_id, retrieved_at = value.split(":")
+        return int(query_result_id), float(retrieved_at)
+
+    def update(self, query_result):
+        redis_connection.set(
+            self._key(query_result.data_source_id, query_result.query_hash),
+            "{}:{}".format(query_result.id, query_result.retrieved_at.timestamp()),
+            ex=settings.QUERY_RESULTS_INDEX_TTL,
+        )
+
+
+latest_query_results = LatestQueryResults()
+
+
+class QueryResultsLRU(object):
+    """Keeps data of the most recently used query results (like their deserialized data) in
+    process memory by result id. Only this plain data is shared between requests and threads,
+    never the ORM instances (which belong to the session that loaded them). Results are never
+    modified, so the data of an id stays valid; consumers must treat it as read-only."""
+
+    def __init__(self, size):
+        self.size = size
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query_result_id):
+        with self._lock:
+            raw_data = self._results.get(query_result_id)
+            if raw_data is not None:
+                self._results.move_to_end(query_result_id)
+            return raw_data
+
+    def add(self, query_result_id, value):
+        if self.size <= 0 or value is None:
+            return
+
+        with self._lock:
+            self._results[query_result_id] = value
+            self._results.move_to_end(query_result_id)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+
+query_results_lru = QueryResultsLRU(settings.QUERY_RESULTS_LRU_SIZE)
+# Columnar encodings of results stored as JSON, see `DBPersistence._slice_reader`
+query_result_slices = QueryResultsLRU(settings.QUERY_RESULTS_SLICE_CACHE_SIZE)
+
+
 @generic_repr("id", "name", "type", "org_id", "created_at")
 class DataSource(BelongsToOrgMixin, db.Model):
     id = primary_key("DataSource")
@@ -189,13 +306,15 @@ class DataSource(BelongsToOrgMixin, db.Model):
         res = db.session.delete(self)
         db.session.commit()
 
-        redis_connection.delete(self._schema_key)
+        self.schema_cache.delete()
 
         return res
 
     def get_cached_schema(self):
-        cache = redis_connection.get(self._schema_key)
-        return json_loads(cache) if cache else None
+        return self.schema_cache.get()
+
+    def search_schema(self, term, mode=SEARCH_PREFIX, page=1, page_size=25):
+        return self.schema_cache.search(term, mode=mode, page=page, page_size=page_size)
 
     def get_schema(self, refresh=False):
         out_schema = None
@@ -214,7 +333,8 @@ class DataSource(BelongsToOrgMixin, db.Model):
                 )
                 out_schema = schema
             finally:
-                redis_connection.set(self._schema_key, json_dumps(out_schema))
+                changes = self.schema_cache.update(out_schema)
+                logging.info("Stored schema of data_source %s: %s", self.id, changes)
 
         return out_schema
 
@@ -225,21 +345,26 @@ class DataSource(BelongsToOrgMixin, db.Model):
                 combined = list(zip(i['columns'], i['comment']))
                 combined.sort()
                 i['columns'], i['comment'] = zip(*combined)
-                result.append({
+                table = {
                     "name": i["name"],
                     "columns": i['columns'],
                     "comment": i['comment']
-                })
+                }
             else:
-                result.append({
+                table = {
                     "name": i["name"],
                     "columns": sorted(i["columns"], key=lambda x: x["name"] if isinstance(x, dict) else x),
-                })
+                }
+            # table stats, see BaseSQLQueryRunner._get_tables_stats
+            for key in TABLE_SIZE_FIELDS:
+                if key in i:
+                    table[key] = i[key]
+            result.append(table)
         return result
 
     @property
-    def _schema_key(self):
-        return "data_source:schema:{}".format(self.id)
+    def schema_cache(self):
+        return SchemaCache(redis_connection, self.id)
 
     @property
     def _pause_key(self):
@@ -249,6 +374,16 @@ class DataSource(BelongsToOrgMixin, db.Model):
     def paused(self):
         return redis_connection.exists(self._pause_key)
 
+    @classmethod
+    def paused_ids(cls, data_sources):
+        """Returns the ids of the paused data sources among `data_sources`, in one round trip."""
+        data_sources = list(data_sources)
+        pipe = redis_connection.pipeline(transaction=False)
+        for ds in data_sources:
+            pipe.exists(ds._pause_key)
+
+        return {ds.id for ds, paused in zip(data_sources, pipe.execute()) if paused}
+
     @property
     def pause_reason(self):
         return redis_connection.get(self._pause_key)
@@ -286,6 +421,9 @@ class DataSource(BelongsToOrgMixin, db.Model):
     def query_runner(self):
         query_runner = get_query_runner(self.type, self.options)
 
+        if query_runner is not None and self.options.get("connection_pool"):
+            query_runner.pool_key = (self.id, pool.options_hash(self.options.to_dict()))
+
         if self.uses_ssh_tunnel:
             query_runner = with_ssh_tunnel(query_runner, self.options.get("ssh_tunnel"))
 
@@ -316,16 +454,51 @@ class DataSourceGroup(db.Model):
 
 
 DESERIALIZED_DATA_ATTR = "_deserialized_data"
+COLUMNAR_READER_ATTR = "_columnar_reader_cache"
+RAW_DATA_ATTR = "_raw_data_cache"
+SLICE_READER_ATTR = "_slice_reader_cache"
+
+
+def _sort_key(value):
+    # Numbers sort before other values, values of mixed types are compared as strings.
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value)
+    return (1, str(value))
 
 
 class DBPersistence(object):
+    """Stores result data as JSON.
+
+    Rows may be stored as arrays of values (see `ROW_FORMAT_ARRAY`): `data` expands them to
+    dicts for the consumers of the whole result, `iter_rows` only expands the rows it returns
+    (and parses them as it goes, see `bi.models.json_rows`).
+    """
+
+    # The loaded data is checked before `_data`: results served from `query_results_lru` are
+    # loaded with `_data` deferred, reading it would fetch it from the database.
+
     @property
-    def data(self):
-        if self._data is None:
-            return None
+    def _raw_data(self):
+        """The parsed result, with its rows in the stored format."""
+        if hasattr(self, DESERIALIZED_DATA_ATTR):
+            return self._deserialized_data
 
+        if not hasattr(self, RAW_DATA_ATTR):
+            if self._data is None:
+                return None
+            setattr(self, RAW_DATA_ATTR, json_loads(self._data))
+
+        return getattr(self, RAW_DATA_ATTR)
+
+    @property
+    def data(self):
         if not hasattr(self, DESERIALIZED_DATA_ATTR):
-            setattr(self, DESERIALIZED_DATA_ATTR, json_loads(self._data))
+            raw_data = self._raw_data
+            if raw_data is None:
+                return None
+            setattr(self, DESERIALIZED_DATA_ATTR, expand_rows(raw_data))
+            if hasattr(self, RAW_DATA_ATTR):
+                delattr(self, RAW_DATA_ATTR)
 
         return self._deserialized_data
 
@@ -333,11 +506,245 @@ class DBPersistence(object):
     def data(self, data):
         if hasattr(self, DESERIALIZED_DATA_ATTR):
             delattr(self, DESERIALIZED_DATA_ATTR)
+        if hasattr(self, RAW_DATA_ATTR):
+            delattr(self, RAW_DATA_ATTR)
+        if hasattr(self, SLICE_READER_ATTR):
+            delattr(self, SLICE_READER_ATTR)
         self._data = data
 
+    def _use_raw_data(self, raw_data):
+        """Use `raw_data`, the `_raw_data` of this result loaded before, instead of parsing `_data` again."""
+        setattr(self, RAW_DATA_ATTR, raw_data)
+
+    @property
+    def _parsed(self):
+        return hasattr(self, DESERIALIZED_DATA_ATTR) or hasattr(self, RAW_DATA_ATTR)
+
+    @property
+    def result_columns(self):
+        if not self._parsed and self._data is not None:
+            return json_rows.read_columns(self._data)
+
+        data = self._raw_data
+        return (data and data.get("columns")) or []
+
+    @property
+    def _slice_reader(self):
+        """The result as a `columnar.ColumnarResult`, to read pages of it without parsing all of
+        it again. Building it parses the whole result once, it is then kept in
+        `query_result_slices`."""
+        if not hasattr(self, SLICE_READER_ATTR):
+            reader = query_result_slices.get(self.id)
+            if reader is None:
+                reader = columnar.ColumnarResult(columnar.encode(json_loads(self._data)))
+                query_result_slices.add(self.id, reader)
+            setattr(self, SLICE_READER_ATTR, reader)
+
+        return getattr(self, SLICE_READER_ATTR)
+
+    @property
+    def result_extra(self):
+        """The keys of the result other than its columns and rows (like the runner's `metadata`)."""
+        if not self._parsed and self._data is not None:
+            return dict(self._slice_reader.extra)
+
+        data = self._raw_data or {}
+        return {k: v for k, v in data.items() if k not in ("columns", "rows", "row_format")}
+
+    def iter_rows(self, offset=0, limit=None, columns=None):
+        # Unless the result is already parsed, pages come from the slice reader and the whole
+        # result is parsed as it is read.
+        if not self._parsed and self._data is not None:
+            if offset or limit is not None:
+                return self._slice_reader.iter_rows(offset, limit, columns)
+            return self._stream_rows(offset, limit, columns)
+
+        return self._iter_parsed_rows(offset, limit, columns)
+
+    def _stream_rows(self, offset, limit, columns):
+        names = [column["name"] for column in self.result_columns]
+        end = None if limit is None else offset + limit
+
+        for row in itertools.islice(json_rows.iter_rows(self._data, names), offset, end):
+            if columns is None:
+                yield row
+            else:
+                yield {name: row.get(name) for name in columns}
+
+    def _iter_parsed_rows(self, offset, limit, columns):
+        data = self._raw_data
+        rows = (data and data.get("rows")) or []
+        end = None if limit is None else offset + limit
+
+        if data and data.get("row_format") == ROW_FORMAT_ARRAY:
+            names = [column["name"] for column in data["columns"]]
+            if columns is None:
+                for row in itertools.islice(rows, offset, end):
+                    yield dict(zip(names, row))
+            else:
+                indexes = [(name, names.index(name) if name in names else None) for name in columns]
+                for row in itertools.islice(rows, offset, end):
+                    yield {name: None if index is None else row[index] for name, index in indexes}
+            return
+
+        for row in itertools.islice(rows, offset, end):
+            if columns is None:
+                yield row
+            else:
+                yield {name: row.get(name) for name in columns}
+
+    @property
+    def row_count(self):
+        if not self._parsed and self._data is not None:
+            return self._slice_reader.row_count
+
+        data = self._raw_data
+        return len((data and data.get("rows")) or [])
+
+    def data_slice(self, offset=0, limit=None, columns=None, order_by=None):
+        """Return a page of the result, projected to `columns` and optionally sorted.
+
+        `order_by` is a column name, prefixed with "-" for descending order. Sorting needs
+        every row, otherwise only the requested window is decoded.
+
+        Results stored as JSON can't be read from the middle: their first page parses the
+        whole result into a columnar encoding, kept in `query_result_slices` (per process), from
+        which the next pages only decode their chunks. Evicted results pay that parse again.
+        """
+        result_columns = self.result_columns
+        if columns is not None:
+            result_columns = [c for c in result_columns if c["name"] in columns]
+            columns = [c["name"] for c in result_columns]
+
+        if order_by:
+            descending = order_by.startswith("-")
+            sort_column = order_by.lstrip("-")
+            rows = list(self.iter_rows())
+            # Rows without a value come last in both directions.
+            rows = sorted(
+                (row for row in rows if row.get(sort_column) is not None),
+                key=lambda row: _sort_key(row.get(sort_column)),
+                reverse=descending,
+            ) + [row for row in rows if row.get(sort_column) is None]
+            end = None if limit is None else offset + limit
+            rows = rows[offset:end]
+            if columns is not None:
+                rows = [{name: row.get(name) for name in columns} for row in rows]
+        else:
+            rows = list(self.iter_rows(offset, limit, columns))
+
+        data = self.result_extra
+        data.update(
+            columns=result_columns,
+            rows=rows,
+            offset=offset,
+            total_rows=self.row_count,
+        )
+        return data
+
+
+class ColumnarPersistence(DBPersistence):
+    """Stores result data as compressed typed column chunks (see `bi.models.columnar`).
+
+    Rows stored as plain JSON (before switching to this persistence) are still readable.
+    """
+
+    @property
+    def _loaded(self):
+        """Whether the data is already loaded (or stored as plain JSON), not read from the chunks."""
+        return (
+            hasattr(self, DESERIALIZED_DATA_ATTR)
+            or hasattr(self, RAW_DATA_ATTR)
+            or not columnar.is_columnar(self._data)
+        )
+
+    @property
+    def data(self):
+        if not hasattr(self, DESERIALIZED_DATA_ATTR):
+            if hasattr(self, RAW_DATA_ATTR):
+                data = expand_rows(getattr(self, RAW_DATA_ATTR))
+                delattr(self, RAW_DATA_ATTR)
+            elif self._data is None:
+                return None
+            elif columnar.is_columnar(self._data):
+                data = columnar.decode(self._data)
+            else:
+                data = expand_rows(json_loads(self._data))
+            setattr(self, DESERIALIZED_DATA_ATTR, data)
+
+        return self._deserialized_data
+
+    @data.setter
+    def data(self, data):
+        if hasattr(self, DESERIALIZED_DATA_ATTR):
+            delattr(self, DESERIALIZED_DATA_ATTR)
+
+        if hasattr(self, COLUMNAR_READER_ATTR):
+            delattr(self, COLUMNAR_READER_ATTR)
+
+        if hasattr(self, RAW_DATA_ATTR):
+            delattr(self, RAW_DATA_ATTR)
+
+        if hasattr(self, SLICE_READER_ATTR):
+            delattr(self, SLICE_READER_ATTR)
+
+        if data is None or columnar.is_columnar(data):
+            self._data = data
+            return
+
+        deserialized = json_loads(data) if isinstance(data, str) else data
+        if isinstance(deserialized, dict) and "rows" in deserialized:
+            self._data = columnar.encode(deserialized)
+            if deserialized.get("row_format") != ROW_FORMAT_ARRAY:
+                setattr(self, DESERIALIZED_DATA_ATTR, deserialized)
+        else:
+            self._data = data if isinstance(data, str) else json_dumps(data)
+
+    @property
+    def _raw_data(self):
+        if not self._loaded:
+            return self.data
+
+        return super(ColumnarPersistence, self)._raw_data
+
+    @property
+    def _columnar_reader(self):
+        if not hasattr(self, COLUMNAR_READER_ATTR):
+            setattr(self, COLUMNAR_READER_ATTR, columnar.ColumnarResult(self._data))
+
+        return getattr(self, COLUMNAR_READER_ATTR)
+
+    @property
+    def result_columns(self):
+        if self._loaded:
+            return super(ColumnarPersistence, self).result_columns
+
+        return self._columnar_reader.columns
+
+    @property
+    def result_extra(self):
+        if self._loaded:
+            return super(ColumnarPersistence, self).result_extra
+
+        return dict(self._columnar_reader.extra)
+
+    @property
+    def row_count(self):
+        if self._loaded:
+            return super(ColumnarPersistence, self).row_count
+
+        return self._columnar_reader.row_count
 
-QueryResultPersistence = (
-    settings.dynamic_settings.QueryResultPersistence or DBPersistence
+    def iter_rows(self, offset=0, limit=None, columns=None):
+        # Decode only the chunks/columns needed, unless the full result is already loaded.
+        if self._loaded:
+            return super(ColumnarPersistence, self).iter_rows(offset, limit, columns)
+
+        return self._columnar_reader.iter_rows(offset, limit, columns)
+
+
+QueryResultPersistence = settings.dynamic_settings.QueryResultPersistence or (
+    ColumnarPersistence if settings.QUERY_RESULTS_COLUMNAR_STORAGE else DBPersistence
 )
 
 
@@ -359,12 +766,12 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
     def __str__(self):
         return "%d | %s | %s" % (self.id, self.query_hash, self.retrieved_at)
 
-    def to_dict(self):
+    def to_dict(self, **slice_params):
         return {
             "id": self.id,
             "query_hash": self.query_hash,
             "query": self.query_text,
-            "data": self.data,
+            "data": self.data_slice(**slice_params) if slice_params else self.data,
             "data_source_id": self.data_source_id,
             "runtime": self.runtime,
             "retrieved_at": self.retrieved_at,
@@ -383,6 +790,10 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
     def get_latest(cls, data_source, query, max_age=0):
         query_hash = gen_query_hash(query)
 
+        query_result = cls._get_latest_from_index(data_source, query_hash, max_age)
+        if query_result is not None:
+            return query_result
+
         if max_age == -1:
             query = cls.query.filter(
                 cls.query_hash == query_hash, cls.data_source == data_source
@@ -400,6 +811,30 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
 
         return query.order_by(cls.retrieved_at.desc()).first()
 
+    @classmethod
+    def _get_latest_from_index(cls, data_source, query_hash, max_age):
+        entry = latest_query_results.get(data_source.id, query_hash)
+        if entry is None:
+            return None
+
+        query_result_id, retrieved_at = entry
+        if max_age != -1 and retrieved_at + max_age < time.time():
+            return None
+
+        # The indexed result might have been removed since, then fall back to the full lookup.
+        raw_data = query_results_lru.get(query_result_id)
+        if raw_data is None:
+            query_result = cls.query.get(query_result_id)
+            if query_result is not None:
+                query_results_lru.add(query_result.id, query_result._raw_data)
+        else:
+            # The data is cached, don't transfer it again.
+            query_result = cls.query.options(defer(cls._data)).get(query_result_id)
+            if query_result is not None:
+                query_result._use_raw_data(raw_data)
+
+        return query_result
+
     @classmethod
     def store_result(
         cls, org, data_source, query_hash, query, data, run_time, retrieved_at
@@ -415,6 +850,8 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
         )
 
         db.session.add(query_result)
+        db.session.flush()
+        # latest_query_results is updated by the caller, once the result is committed
         logging.info("Inserted query (%s) data; id=%s", query_hash, query_result.id)
 
         return query_result
@@ -427,6 +864,15 @@ class QueryResult(db.Model, QueryResultPersistence, BelongsToOrgMixin):
 def should_schedule_next(
     previous_iteration, now, interval, time=None, day_of_week=None, failures=0
 ):
+    next_iteration = next_schedule_time(
+        previous_iteration, interval, time, day_of_week, failures
+    )
+    return next_iteration is not None and now > next_iteration
+
+
+def next_schedule_time(previous_iteration, interval, time=None, day_of_week=None, failures=0):
+    """Returns when a query last run at `previous_iteration` is due next, or None if its
+    failure backoff overflows (it's never due again)."""
     # if time exists then interval > 23 hours (82800s)
     # if day_of_week exists then interval > 6 days (518400s)
     if time is None:
@@ -467,8 +913,8 @@ def should_schedule_next(
         try:
             next_iteration += datetime.timedelta(minutes=2 ** failures)
         except OverflowError:
-            return False
-    return now > next_iteration
+            return None
+    return next_iteration
 
 
 @gfk_type
@@ -655,17 +1101,33 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
 
     @classmethod
     def outdated_queries(cls):
+        now = utils.utcnow()
+        now_timestamp = now.timestamp()
+
+        if scheduled_queries_due.needs_resync(now_timestamp):
+            query_ids = [
+                query_id
+                for (query_id,) in db.session.query(Query.id).filter(Query.schedule.isnot(None))
+            ]
+            scheduled_queries_due.resync(query_ids, now_timestamp)
+
+        due_query_ids = scheduled_queries_due.pop_due(now_timestamp)
+        if not due_query_ids:
+            return []
+
         queries = (
             Query.query.options(
-                joinedload(Query.latest_query_data).load_only("retrieved_at")
+                joinedload(Query.latest_query_data).load_only("retrieved_at"),
+                joinedload(Query.org),
+                joinedload(Query.data_source),
             )
-                .filter(Query.schedule.isnot(None))
+                .filter(Query.id.in_(due_query_ids), Query.schedule.isnot(None))
                 .order_by(Query.id)
                 .all()
         )
 
-        now = utils.utcnow()
         outdated_queries = {}
+        due_times = {}
         scheduled_queries_executions.refresh()
 
         for query in queries:
@@ -685,16 +1147,28 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
                     query.latest_query_data and query.latest_query_data.retrieved_at
                 )
 
-                if should_schedule_next(
-                    retrieved_at or now,
-                    now,
+                # Queries that never ran aren't due until they get a result (which touches them).
+                if retrieved_at is None:
+                    continue
+
+                next_iteration = next_schedule_time(
+                    retrieved_at,
                     query.schedule["interval"],
                     query.schedule["time"],
                     query.schedule["day_of_week"],
                     query.schedule_failures,
-                ):
+                )
+                if next_iteration is None:
+                    continue
+
+                if now > next_iteration:
                     key = "{}:{}".format(query.query_hash, query.data_source_id)
                     outdated_queries[key] = query
+                    # Look at it again soon in case it can't be enqueued now. Once its
+                    # execution starts, it is touched and gets its real next due time.
+                    due_times[query.id] = now_timestamp + settings.QUERY_SCHEDULER_RETRY_DELAY
+                else:
+                    due_times[query.id] = next_iteration.timestamp()
             except Exception as e:
                 query.schedule["disabled"] = True
                 db.session.commit()
@@ -708,6 +1182,8 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
                     type(e)(message).with_traceback(e.__traceback__)
                 )
 
+        scheduled_queries_due.schedule(due_times)
+
         return list(outdated_queries.values())
 
     @classmethod
@@ -790,19 +1266,27 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
 
     @classmethod
     def update_latest_result(cls, query_result):
-        # TODO: Investigate how big an impact this select-before-update makes.
-        queries = Query.query.filter(
-            Query.query_hash == query_result.query_hash,
-            Query.data_source == query_result.data_source,
+        # A single set-based UPDATE: no per-query SELECT, ORM state or change tracking, and
+        # updated_at is left untouched (the TimestampMixin hook doesn't run for it).
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.query_hash == query_result.query_hash)
+            .where(table.c.data_source_id == query_result.data_source_id)
+            .values(latest_query_data_id=query_result.id)
+            .returning(table.c.id)
         )
+        query_ids = [row[0] for row in db.session.execute(statement)]
 
-        for q in queries:
-            q.latest_query_data = query_result
-            # don't auto-update the updated_at timestamp
-            q.skip_updated_at = True
-            db.session.add(q)
+        # Queries already loaded in the session don't know about the new result.
+        updated = set(query_ids)
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, Query) and obj.id in updated:
+                db.session.expire(obj, ["latest_query_data", "latest_query_data_id"])
+
+        # The update bypasses the mapper events, so touch the scheduler here.
+        scheduled_queries_due.touch(query_ids)
 
-        query_ids = [q.id for q in queries]
         logging.info(
             "Updated %s queries with result (%s).",
             len(query_ids),
@@ -899,6 +1383,17 @@ def receive_before_insert_update(mapper, connection, target):
     target.update_query_hash()
 
 
+@listens_for(Query, "after_insert")
+@listens_for(Query, "after_update")
+def touch_scheduled_query(mapper, connection, target):
+    state = inspect(target)
+    if any(
+        state.attrs[attr].history.has_changes()
+        for attr in ("schedule", "schedule_failures", "latest_query_data", "latest_query_data_id")
+    ):
+        scheduled_queries_due.touch([target.id])
+
+
 @listens_for(Query.user_id, "set")
 def query_last_modified_by(target, val, oldval, initiator):
     target.last_modified_by_id = val
@@ -982,7 +1477,7 @@ class DataTableColumns(BelongsToOrgMixin, db.Model):
 
 
 # new file table
-@generic_repr("id", "user_id", "org_id", "source_name", "file_name", "is_use", "file_type", "created_at")
+@generic_repr("id", "user_id", "org_id", "source_name", "file_name", "is_use", "file_type", "row_count", "created_at")
 class DataSourceFile(BelongsToOrgMixin, db.Model):
     id = primary_key("DataSourceFile")
     user_id = Column(key_type("User"), db.ForeignKey("users.id"))
@@ -993,6 +1488,10 @@ class DataSourceFile(BelongsToOrgMixin, db.Model):
     file_name = Column(db.String(255))
     is_use = Column(db.Boolean, default=True)
     file_type = Column(db.String(255))
+    # parquet copy of the file, written in the background after the upload (see tasks.convert_data_source_file)
+    columnar_file_name = Column(db.String(255), nullable=True)
+    row_count = Column(db.Integer, nullable=True)
+    column_stats = Column(MutableDict.as_mutable(PseudoJSON), nullable=True)
     created_at = Column(db.DateTime(True), default=db.func.now())
 
     __tablename__ = "data_source_file"
@@ -1030,6 +1529,9 @@ class DataSourceFile(BelongsToOrgMixin, db.Model):
             "file_name": self.file_name,
             "is_use": self.is_use,
             "file_type": self.file_type,
+            "columnar_file_name": self.columnar_file_name,
+            "row_count": self.row_count,
+            "column_stats": self.column_stats,
             "created_at": self.created_at.strftime('%Y-%m-%d %H:%M:%S')
         }
 
@@ -0,0 +1,185 @@
+"""
+Columnar storage for ``QueryResult`` data.
+
+Results are split into row chunks and every column of a chunk is encoded and
+compressed on its own. Integer and float columns without nulls are packed as
+fixed-width binary arrays (using the types reported by the query runner), all
+other columns fall back to a JSON list. The payload is kept in the existing
+``query_results.data`` text column (base64 encoded, behind a magic prefix), so
+legacy JSON rows keep working and no schema change is required.
+
+Layout of the decoded payload::
+
+    MAGIC | header length (uint32) | header (JSON) | column blobs...
+"""
+import base64
+import struct
+import sys
+import zlib
+from array import array
+
+from bi import settings
+from bi.query_runner import TYPE_INTEGER, TYPE_FLOAT, ROW_FORMAT_ARRAY
+from bi.utils import json_dumps, json_loads
+
+MAGIC = b"HCR1"
+PREFIX = "columnar:"
+
+ENCODING_JSON = "j"
+ENCODING_INT64 = "q"
+ENCODING_FLOAT64 = "d"
+
+_INT64_MIN = -(2 ** 63)
+_INT64_MAX = 2 ** 63 - 1
+_HEADER_LENGTH = struct.Struct("<I")
+
+
+def is_columnar(value):
+    return isinstance(value, str) and value.startswith(PREFIX)
+
+
+def _pack_array(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_array(typecode, blob):
+    unpacked = array(typecode)
+    unpacked.frombytes(blob)
+    if sys.byteorder != "little":
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+def _encode_column(column_type, values):
+    if column_type == TYPE_INTEGER and all(
+        type(v) is int and _INT64_MIN <= v <= _INT64_MAX for v in values
+    ):
+        return ENCODING_INT64, _pack_array(ENCODING_INT64, values)
+
+    if column_type == TYPE_FLOAT and all(type(v) is float for v in values):
+        return ENCODING_FLOAT64, _pack_array(ENCODING_FLOAT64, values)
+
+    return ENCODING_JSON, json_dumps(values).encode("utf-8")
+
+
+def _decode_column(encoding, blob):
+    if encoding == ENCODING_JSON:
+        return json_loads(blob.decode("utf-8"))
+
+    return _unpack_array(encoding, blob)
+
+
+def encode(data, chunk_size=None, compression_level=None):
+    """Encode a ``{"columns": [...], "rows": [...]}`` result into the columnar format.
+
+    Rows can be dicts or arrays of values (``"row_format": "array"``). Any other top level
+    keys (e.g. runner metadata) are kept as-is in the header.
+    """
+    chunk_size = chunk_size or settings.QUERY_RESULTS_COLUMNAR_CHUNK_SIZE
+    if compression_level is None:
+        compression_level = settings.QUERY_RESULTS_COLUMNAR_COMPRESSION_LEVEL
+
+    columns = data["columns"] or []
+    rows = data["rows"] or []
+    names = [column["name"] for column in columns]
+    types = [column.get("type") for column in columns]
+    compact = data.get("row_format") == ROW_FORMAT_ARRAY
+
+    blobs = []
+    offset = 0
+    chunks = []
+
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start:start + chunk_size]
+        chunk_blobs = []
+
+        for index, (name, column_type) in enumerate(zip(names, types)):
+            if compact:
+                values = [row[index] for row in chunk_rows]
+            else:
+                values = [row.get(name) for row in chunk_rows]
+            encoding, blob = _encode_column(column_type, values)
+            blob = zlib.compress(blob, compression_level)
+            chunk_blobs.append([encoding, offset, len(blob)])
+            blobs.append(blob)
+            offset += len(blob)
+
+        chunks.append({"rows": len(chunk_rows), "columns": chunk_blobs})
+
+    header = {
+        "columns": columns,
+        "row_count": len(rows),
+        "chunks": chunks,
+        "extra": {k: v for k, v in data.items() if k not in ("columns", "rows", "row_format")},
+    }
+    header = json_dumps(header).encode("utf-8")
+
+    payload = b"".join([MAGIC, _HEADER_LENGTH.pack(len(header)), header] + blobs)
+
+    return PREFIX + base64.b64encode(payload).decode("ascii")
+
+
+class ColumnarResult(object):
+    """Read access to an encoded result, decoding only the chunks and columns asked for."""
+
+    def __init__(self, value):
+        payload = base64.b64decode(value[len(PREFIX):])
+
+        if payload[:len(MAGIC)] != MAGIC:
+            raise ValueError("Invalid columnar query result payload.")
+
+        header_start = len(MAGIC) + _HEADER_LENGTH.size
+        (header_length,) = _HEADER_LENGTH.unpack(payload[len(MAGIC):header_start])
+        header = json_loads(payload[header_start:header_start + header_length].decode("utf-8"))
+
+        self._payload = memoryview(payload)[header_start + header_length:]
+        self.columns = header["columns"]
+        self.row_count = header["row_count"]
+        self.chunks = header["chunks"]
+        self.extra = header["extra"]
+
+    def column_names(self):
+        return [column["name"] for column in self.columns]
+
+    def _column_values(self, chunk, index):
+        encoding, offset, length = chunk["columns"][index]
+        blob = zlib.decompress(self._payload[offset:offset + length])
+        return _decode_column(encoding, blob)
+
+    def iter_rows(self, offset=0, limit=None, columns=None):
+        """Yield rows (as dicts) in ``[offset, offset + limit)``, optionally projected to ``columns``."""
+        names = self.column_names()
+        if columns is None:
+            selected = list(range(len(names)))
+        else:
+            selected = [names.index(name) for name in columns if name in names]
+
+        end = self.row_count if limit is None else min(self.row_count, offset + limit)
+        chunk_start = 0
+
+        for chunk in self.chunks:
+            chunk_end = chunk_start + chunk["rows"]
+
+            if chunk_end > offset and chunk_start < end:
+                values = [self._column_values(chunk, i) for i in selected]
+                keys = [names[i] for i in selected]
+
+                for i in range(max(offset, chunk_start) - chunk_start, min(end, chunk_end) - chunk_start):
+                    yield dict(zip(keys, (column[i] for column in values)))
+
+            if chunk_end >= end:
+                break
+            chunk_start = chunk_end
+
+    def to_dict(self):
+        data = dict(self.extra)
+        data["columns"] = self.columns
+        data["rows"] = list(self.iter_rows())
+        return data
+
+
+def decode(value):
+    return ColumnarResult(value).to_dict()
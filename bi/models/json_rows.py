@@ -0,0 +1,37 @@
+"""
+Streaming reads of query result data stored as JSON (see ``DBPersistence``).
+
+The stored text is parsed incrementally, so reading the rows of a large result one
+at a time (e.g. for a download) never holds more than a few rows in memory.
+"""
+import ijson
+
+
+class _TextReader(object):
+    """File-like object reading `text` as UTF-8, without encoding all of it at once."""
+
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.text) - self.position
+        chunk = self.text[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk.encode("utf-8")
+
+
+def read_columns(text):
+    """The columns of the result stored as `text`. Runners write them before the rows, so
+    the rows are usually not read."""
+    for columns in ijson.items(_TextReader(text), "columns", use_float=True):
+        return columns or []
+    return []
+
+
+def iter_rows(text, names):
+    """Yields the rows of the result stored as `text` as dicts. `names` are the names of the
+    result's columns, for rows stored as arrays of values."""
+    for row in ijson.items(_TextReader(text), "rows.item", use_float=True):
+        yield dict(zip(names, row)) if isinstance(row, list) else row
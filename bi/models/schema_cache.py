@@ -0,0 +1,223 @@
+"""
+Per-table storage of data source schemas in Redis.
+
+Every table is its own entry, so a refresh only rewrites the tables which
+changed and readers can fetch or search a few tables without loading the whole
+catalog. For a data source the keys are::
+
+    data_source:schema:{id}:tables      hash, table name -> table JSON (without its size)
+    data_source:schema:{id}:digests     hash, table name -> digest of the table JSON
+    data_source:schema:{id}:sizes       hash, table name -> JSON of the table's size fields
+    data_source:schema:{id}:names       sorted set (all scores 0), "lowercased name NUL name"
+    data_source:schema:{id}:refreshed   time of the last refresh, set once the schema is stored
+    data_source:schema:{id}:refresh     hash, catalog fingerprint and duration of the last refresh
+    data_source:schema:{id}:refreshing  set while a refresh is queued or running
+
+The names set is ordered lexicographically, so a prefix search is a range
+lookup. A substring search scans the names only, never the tables.
+
+Table sizes (and when they were counted) change on most refreshes while the
+tables themselves rarely do, so they are kept apart: a size change doesn't make
+the table count as changed.
+"""
+import hashlib
+import time
+
+from bi.query_runner import TABLE_SIZE_FIELDS
+from bi.utils import json_dumps, json_loads
+
+SEARCH_PREFIX = "prefix"
+SEARCH_SUBSTRING = "substring"
+
+# Number of tables written or read per Redis command
+BATCH_SIZE = 1000
+
+_SEPARATOR = "\x00"
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _digest(data):
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+def _member(name):
+    return "{}{}{}".format(name.lower(), _SEPARATOR, name)
+
+
+def _name(member):
+    return _text(member).split(_SEPARATOR, 1)[1]
+
+
+def _split_size(table):
+    """Returns (the table without its size fields, the size fields as JSON or None)."""
+    size = {key: table[key] for key in TABLE_SIZE_FIELDS if key in table}
+    table = {key: value for key, value in table.items() if key not in TABLE_SIZE_FIELDS}
+    return table, json_dumps(size) if size else None
+
+
+def _batches(items):
+    items = list(items)
+    for i in range(0, len(items), BATCH_SIZE):
+        yield items[i:i + BATCH_SIZE]
+
+
+class SchemaCache(object):
+    def __init__(self, redis_connection, data_source_id):
+        self.redis = redis_connection
+        prefix = "data_source:schema:{}".format(data_source_id)
+        # Whole schema as one JSON value, as stored by previous versions
+        self.legacy_key = prefix
+        self.tables_key = prefix + ":tables"
+        self.digests_key = prefix + ":digests"
+        self.sizes_key = prefix + ":sizes"
+        self.names_key = prefix + ":names"
+        self.refreshed_key = prefix + ":refreshed"
+        self.refresh_key = prefix + ":refresh"
+        self.refreshing_key = prefix + ":refreshing"
+
+    def exists(self):
+        return self.redis.exists(self.refreshed_key) > 0
+
+    def refreshed_at(self):
+        value = self.redis.get(self.refreshed_key)
+        return float(value) if value else None
+
+    def table_count(self):
+        return self.redis.hlen(self.tables_key)
+
+    def get_refresh_info(self):
+        return {_text(k): _text(v) for k, v in self.redis.hgetall(self.refresh_key).items()}
+
+    def set_refresh_info(self, **info):
+        self.redis.hset(self.refresh_key, mapping=info)
+
+    def start_refresh(self, ttl):
+        """Marks a refresh as queued, returns False if one already is (or still runs).
+        The mark expires after `ttl` seconds in case the refresh never ends it."""
+        return bool(self.redis.set(self.refreshing_key, time.time(), nx=True, ex=ttl))
+
+    def end_refresh(self):
+        self.redis.delete(self.refreshing_key)
+
+    def get(self):
+        """The whole schema sorted by table name, None if it was never stored."""
+        if not self.exists():
+            return None
+        sizes = {_text(name): size for name, size in self.redis.hgetall(self.sizes_key).items()}
+        tables = [
+            (_text(name), self._table(value, sizes.get(_text(name))))
+            for name, value in self.redis.hgetall(self.tables_key).items()
+        ]
+        return [table for _, table in sorted(tables, key=lambda item: item[0])]
+
+    def get_tables(self, names):
+        """The given tables, in the same order, skipping the ones which don't exist."""
+        tables = []
+        for batch in _batches(names):
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hmget(self.tables_key, batch)
+            pipe.hmget(self.sizes_key, batch)
+            values, sizes = pipe.execute()
+            tables.extend(
+                self._table(value, size) for value, size in zip(values, sizes) if value is not None
+            )
+        return tables
+
+    def _table(self, value, size):
+        table = json_loads(value)
+        if size is not None:
+            table.update(json_loads(size))
+        return table
+
+    def update(self, schema):
+        """Stores `schema` (a list of tables), only writing the tables which changed.
+
+        Returns the number of tables added, changed and removed."""
+        new_tables = {}
+        new_sizes = {}
+        for table in schema:
+            table, size = _split_size(table)
+            new_tables[table["name"]] = json_dumps(table)
+            if size is not None:
+                new_sizes[table["name"]] = size
+        new_digests = {name: _digest(data) for name, data in new_tables.items()}
+        old_digests = {
+            _text(name): _text(digest)
+            for name, digest in self.redis.hgetall(self.digests_key).items()
+        }
+        old_sizes = {
+            _text(name): _text(size) for name, size in self.redis.hgetall(self.sizes_key).items()
+        }
+        resized = [name for name, size in new_sizes.items() if old_sizes.get(name) != size]
+        unsized = [name for name in old_sizes if name not in new_sizes]
+
+        added = [name for name in new_digests if name not in old_digests]
+        changed = [
+            name
+            for name, digest in new_digests.items()
+            if name in old_digests and old_digests[name] != digest
+        ]
+        removed = [name for name in old_digests if name not in new_digests]
+
+        pipe = self.redis.pipeline()
+        for batch in _batches(added + changed):
+            pipe.hset(self.tables_key, mapping={name: new_tables[name] for name in batch})
+            pipe.hset(self.digests_key, mapping={name: new_digests[name] for name in batch})
+        for batch in _batches(added):
+            pipe.zadd(self.names_key, {_member(name): 0 for name in batch})
+        for batch in _batches(resized):
+            pipe.hset(self.sizes_key, mapping={name: new_sizes[name] for name in batch})
+        for batch in _batches(unsized):
+            pipe.hdel(self.sizes_key, *batch)
+        for batch in _batches(removed):
+            pipe.hdel(self.tables_key, *batch)
+            pipe.hdel(self.digests_key, *batch)
+            pipe.zrem(self.names_key, *[_member(name) for name in batch])
+        pipe.set(self.refreshed_key, time.time())
+        pipe.delete(self.legacy_key)
+        pipe.execute()
+
+        return {"added": len(added), "changed": len(changed), "removed": len(removed)}
+
+    def search(self, term, mode=SEARCH_PREFIX, page=1, page_size=25):
+        """Tables whose name matches `term` (case insensitive), sorted by name and paginated."""
+        term = (term or "").lower()
+        start = (page - 1) * page_size
+
+        if mode == SEARCH_PREFIX:
+            # 0xff never occurs in UTF-8, it sorts after every name starting with the term
+            low = b"[" + term.encode("utf-8") if term else b"-"
+            high = b"[" + term.encode("utf-8") + b"\xff" if term else b"+"
+            count = self.redis.zlexcount(self.names_key, low, high)
+            members = self.redis.zrangebylex(self.names_key, low, high, start=start, num=page_size)
+            names = [_name(member) for member in members]
+        else:
+            matches = [
+                _name(member)
+                for member in self.redis.zrange(self.names_key, 0, -1)
+                if term in _text(member).split(_SEPARATOR, 1)[0]
+            ]
+            count = len(matches)
+            names = matches[start:start + page_size]
+
+        return {
+            "count": count,
+            "page": page,
+            "page_size": page_size,
+            "results": self.get_tables(names),
+        }
+
+    def delete(self):
+        self.redis.delete(
+            self.legacy_key,
+            self.tables_key,
+            self.digests_key,
+            self.sizes_key,
+            self.names_key,
+            self.refreshed_key,
+            self.refresh_key,
+            self.refreshing_key,
+        )
@@ -1,5 +1,8 @@
+import asyncio
 import logging
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from dateutil import parser
 from functools import wraps
@@ -14,6 +17,7 @@ from bi.utils import json_loads
 from rq.timeouts import JobTimeoutException
 
 from bi.utils.requests_session import requests_or_advocate, requests_session, UnacceptableAddressException
+from bi.query_runner import pool
 
 
 import sqlparse
@@ -25,7 +29,14 @@ __all__ = [
     "BaseHTTPQueryRunner",
     "InterruptException",
     "JobTimeoutException",
+    "NotSupported",
     "BaseSQLQueryRunner",
+    "ResultWriter",
+    "ROW_FORMAT_ARRAY",
+    "TABLE_SIZE_FIELDS",
+    "expand_rows",
+    "check_interrupted",
+    "AsyncQuery",
     "TYPE_DATETIME",
     "TYPE_BOOLEAN",
     "TYPE_INTEGER",
@@ -51,6 +62,73 @@ SUPPORTED_COLUMN_TYPES = set(
     [TYPE_INTEGER, TYPE_FLOAT, TYPE_BOOLEAN, TYPE_STRING, TYPE_DATETIME, TYPE_DATE]
 )
 
+# Value of a result's "row_format" when its rows are arrays of values in the order of "columns".
+ROW_FORMAT_ARRAY = "array"
+
+# Fields the table stats add to the tables of a schema. They change on most refreshes, so the
+# schema cache stores them apart from the tables (see `bi.models.schema_cache`).
+TABLE_SIZE_FIELDS = ("size", "size_estimated", "size_updated_at")
+
+
+def expand_rows(data):
+    """Returns `data` with its rows as column name -> value dicts, whichever format they are in."""
+    if not data or data.get("row_format") != ROW_FORMAT_ARRAY:
+        return data
+
+    names = [column["name"] for column in data["columns"]]
+    expanded = {key: value for key, value in data.items() if key != "row_format"}
+    expanded["rows"] = [dict(zip(names, row)) for row in data["rows"]]
+    return expanded
+
+
+class _Interruption(threading.local):
+    # Set by `run_concurrently` in its worker threads
+    event = None
+
+
+_interruption = _Interruption()
+
+
+def check_interrupted():
+    """Raises `InterruptException` in a `run_concurrently` call which was given up on (failure or
+    job timeout of the caller). Runners call it while waiting for a query, so they cancel it."""
+    event = _interruption.event
+    if event is not None and event.is_set():
+        raise InterruptException("Interrupted.")
+
+
+def run_concurrently(fn, items, workers):
+    """Returns `[fn(item) for item in items]`, running up to `workers` calls at a time."""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    interrupted = threading.Event()
+
+    def call(item):
+        _interruption.event = interrupted
+        try:
+            return fn(item)
+        finally:
+            _interruption.event = None
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(call, item) for item in items]
+    try:
+        return [future.result() for future in futures]
+    finally:
+        # On failure (or a job timeout) don't start the calls still waiting, interrupt the
+        # running ones and wait for them to cancel their queries and give back their connections.
+        interrupted.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _set_table_size(table, size, estimated, updated_at):
+    table.update(zip(TABLE_SIZE_FIELDS, (size, estimated, updated_at)))
+
+
 def split_sql_statements(query):
     def strip_trailing_comments(stmt):
         idx = len(stmt.tokens) - 1
@@ -115,12 +193,106 @@ class NotSupported(Exception):
     pass
 
 
+class ResultWriter(object):
+    """Serializes a query result to JSON one batch of rows at a time.
+
+    Stops accepting rows once the configured row or byte cap is reached (0 disables a cap)
+    and marks the result as truncated in its `metadata`. The byte cap is measured on the
+    serialized rows. With `compact`, rows are written as arrays of values (see `ROW_FORMAT_ARRAY`).
+    """
+
+    def __init__(self, columns, max_rows=0, max_bytes=0, encoder=utils.JSONEncoder, compact=None):
+        self.columns = columns
+        self.column_names = [column["name"] for column in columns]
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.encoder = encoder
+        self.compact = settings.QUERY_RESULTS_COMPACT_ROWS if compact is None else compact
+        self.row_count = 0
+        self.byte_count = 0
+        self.truncated = False
+        self._parts = []
+
+    def _dumps(self, data):
+        return utils.json_dumps(data, ignore_nan=True, cls=self.encoder)
+
+    def _append(self, serialized, row_count):
+        self._parts.append(serialized)
+        self.row_count += row_count
+        self.byte_count += len(serialized) + 1
+
+    def write(self, rows):
+        """Add a batch of row tuples. Returns False once no more rows should be fetched."""
+        if self.truncated:
+            return False
+
+        if self.max_rows and self.row_count + len(rows) > self.max_rows:
+            rows = rows[: self.max_rows - self.row_count]
+            self.truncated = True
+
+        if not rows:
+            return not self.truncated
+
+        if self.compact:
+            records = [list(row) for row in rows]
+        else:
+            records = [dict(zip(self.column_names, row)) for row in rows]
+        serialized = self._dumps(records)[1:-1]
+
+        if self.max_bytes and self.byte_count + len(serialized) > self.max_bytes:
+            self.truncated = True
+            for record in records:
+                serialized = self._dumps(record)
+                if self.byte_count + len(serialized) > self.max_bytes:
+                    break
+                self._append(serialized, 1)
+            return False
+
+        self._append(serialized, len(rows))
+        return not self.truncated
+
+    def getvalue(self):
+        data = '{"columns": %s, "rows": [%s]' % (
+            self._dumps(self.columns),
+            ",".join(self._parts),
+        )
+        if self.compact:
+            data += ', "row_format": "%s"' % ROW_FORMAT_ARRAY
+        if self.truncated:
+            metadata = {
+                "truncated": True,
+                "row_count": self.row_count,
+                "max_rows": self.max_rows,
+                "max_bytes": self.max_bytes,
+            }
+            data += ', "metadata": %s' % self._dumps(metadata)
+
+        return data + "}"
+
+
+class AsyncQuery(object):
+    """Handle of a query started with `BaseQueryRunner.execute_async`."""
+
+    def __init__(self, connection, max_rows=None):
+        self.connection = connection
+        self.max_rows = max_rows
+        self.cursor = None
+        self.done = False
+        # Future of the blocking read, for runners which read in an executor
+        self.reader = None
+
+
 class BaseQueryRunner(object):
     deprecated = False
     should_annotate_query = True
     noop_query = None
     limit_query = " LIMIT 1000"
     limit_keywords = [ "LIMIT", "OFFSET"]
+    # (data source id, options hash), set by `DataSource.query_runner` when the data source
+    # has connection pooling enabled.
+    pool_key = None
+    # Whether the runner implements the `*_async` methods below natively.
+    supports_async = False
 
     def __init__(self, configuration):
         self.syntax = "sql"
@@ -213,6 +385,90 @@ class BaseQueryRunner(object):
     def run_query(self, query, user):
         raise NotImplementedError()
 
+    async def execute_async(self, query, user, max_rows=None):
+        """Starts running `query` without blocking the event loop. Returns a runner specific
+        handle for `fetch_async`, `cancel_async` and `close_async`."""
+        raise NotSupported()
+
+    async def fetch_async(self, handle):
+        """Waits for the query of `handle` to complete and returns (json_data, error)."""
+        raise NotSupported()
+
+    async def cancel_async(self, handle):
+        """Cancels the query of `handle` on the server."""
+        raise NotSupported()
+
+    async def close_async(self, handle):
+        pass
+
+    async def run_query_async(self, query, user, timeout=None, max_rows=None):
+        """Event loop friendly `run_query`. The query is cancelled on the server when it
+        exceeds `timeout` seconds or the calling task is cancelled. `max_rows` can only
+        lower the data source's row cap.
+
+        Runners without native support run `run_query` in the loop's default executor
+        instead (without `max_rows` and server side cancellation)."""
+        if not self.supports_async:
+            loop = asyncio.get_event_loop()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(None, self.run_query, query, user), timeout
+                )
+            except asyncio.TimeoutError:
+                return None, "Query exceeded the time limit."
+
+        handle = await self.execute_async(query, user, max_rows=max_rows)
+        try:
+            return await asyncio.wait_for(self.fetch_async(handle), timeout)
+        except asyncio.TimeoutError:
+            await self.cancel_async(handle)
+            return None, "Query exceeded the time limit."
+        except asyncio.CancelledError:
+            await self.cancel_async(handle)
+            raise
+        finally:
+            await self.close_async(handle)
+
+    def get_connection_pool(self):
+        """Returns the pool for this data source's connections, or None if pooling is disabled."""
+        if self.pool_key is None:
+            return None
+
+        return pool.get_pool(
+            "connection",
+            self.pool_key,
+            lambda: pool.ConnectionPool(validate=self._validate_connection),
+        )
+
+    def _validate_connection(self, connection):
+        """Checks that a pooled connection is still usable before reusing it."""
+        return True
+
+    def result_limits(self):
+        """Returns the (max_rows, max_bytes) caps for results of this data source."""
+        max_rows = self.configuration.get("max_rows") or settings.QUERY_RESULTS_MAX_ROWS
+        max_bytes = self.configuration.get("max_bytes") or settings.QUERY_RESULTS_MAX_BYTES
+        return int(max_rows), int(max_bytes)
+
+    def row_cap(self, max_rows=None):
+        """Returns the row cap of a result (0 means unlimited). `max_rows` can lower the row cap
+        of the data source."""
+        limit, _ = self.result_limits()
+        return min(max_rows, limit) if max_rows and limit else max_rows or limit
+
+    def write_results(self, cursor, columns, encoder=utils.JSONEncoder, max_rows=None):
+        """Fetches all rows from a DB-API cursor in batches into a `ResultWriter`. `max_rows`
+        can lower the row cap of the data source."""
+        _, max_bytes = self.result_limits()
+        writer = ResultWriter(columns, self.row_cap(max_rows), max_bytes, encoder)
+
+        while True:
+            rows = cursor.fetchmany(settings.QUERY_RUNNER_FETCH_BATCH_SIZE)
+            if not rows or not writer.write(rows):
+                break
+
+        return writer
+
     def fetch_columns(self, columns):
         column_names = []
         duplicates_counter = 1
@@ -234,6 +490,11 @@ class BaseQueryRunner(object):
     def get_schema(self, get_stats=False):
         raise NotSupported()
 
+    def get_schema_fingerprint(self):
+        """Returns a value which changes whenever the schema changes, computed without reading
+        the schema itself, or None when the runner can't tell."""
+        return None
+
     def _handle_run_query_error(self, error):
         if error is None:
             return
@@ -241,12 +502,28 @@ class BaseQueryRunner(object):
         logger.error(error)
         raise Exception(f"Error during query execution. Reason: {error}")
 
-    def _run_query_internal(self, query):
+    def _run_query_rows(self, query):
+        """Runs `query` for internal use (schema discovery, table stats) and returns
+        (column names, rows), the rows being tuples of values in the order of the names.
+
+        Runners able to read the rows off their cursor override this to skip the JSON
+        result `run_query` builds for the users."""
         results, error = self.run_query(query, None)
 
         if error is not None:
-            raise Exception("Failed running query [%s]." % query)
-        return json_loads(results)["rows"]
+            self._handle_run_query_error(error)
+
+        data = json_loads(results)
+        names = [column["name"] for column in data["columns"]]
+        if data.get("row_format") == ROW_FORMAT_ARRAY:
+            rows = [tuple(row) for row in data["rows"]]
+        else:
+            rows = [tuple(row.get(name) for name in names) for row in data["rows"]]
+        return names, rows
+
+    def _run_query_internal(self, query):
+        names, rows = self._run_query_rows(query)
+        return [dict(zip(names, row)) for row in rows]
 
     @classmethod
     def to_dict(cls):
@@ -270,6 +547,16 @@ class BaseQueryRunner(object):
 
 
 class BaseSQLQueryRunner(BaseQueryRunner):
+    # Query returning a single row which changes with the tables and columns, see get_schema_fingerprint
+    schema_fingerprint_query = None
+
+    def get_schema_fingerprint(self):
+        if self.schema_fingerprint_query is None:
+            return None
+
+        _, rows = self._run_query_rows(self.schema_fingerprint_query)
+        return ":".join(str(value) for value in rows[0])
+
     def get_schema(self, get_stats=False):
         schema_dict = {}
         self._get_tables(schema_dict)
@@ -280,11 +567,32 @@ class BaseSQLQueryRunner(BaseQueryRunner):
     def _get_tables(self, schema_dict):
         return []
 
+    def _get_table_size_estimates(self):
+        """Returns {table name: (estimated rows, time of the estimate)} from the catalog
+        statistics, or None when the runner has none. Names are the ones of `_get_tables`."""
+        return None
+
     def _get_tables_stats(self, tables_dict):
-        for t in tables_dict.keys():
-            if type(tables_dict[t]) == dict:
-                res = self._run_query_internal("select count(*) as cnt from %s" % t)
-                tables_dict[t]["size"] = res[0]["cnt"]
+        tables = [t for t in tables_dict.keys() if type(tables_dict[t]) == dict]
+
+        if settings.SCHEMA_TABLE_SIZE_MODE != "exact":
+            estimates = self._get_table_size_estimates()
+            if estimates is not None:
+                # Tables without statistics (views, never analyzed tables) get no size rather than a scan.
+                for t in tables:
+                    if t in estimates:
+                        size, updated_at = estimates[t]
+                        _set_table_size(tables_dict[t], size, True, updated_at)
+                return
+
+        def count(table):
+            _, rows = self._run_query_rows("select count(*) as cnt from %s" % table)
+            return rows[0][0]
+
+        counted_at = utils.utcnow()
+        sizes = run_concurrently(count, tables, settings.SCHEMA_TABLE_STATS_CONCURRENCY)
+        for t, size in zip(tables, sizes):
+            _set_table_size(tables_dict[t], size, False, counted_at)
 
     @property
     def supports_auto_limit(self):
@@ -484,44 +792,90 @@ def guess_type_from_string(string_value):
     return TYPE_STRING
 
 
-def with_ssh_tunnel(query_runner, details):
-    def tunnel(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
-            try:
-                remote_host, remote_port = query_runner.host, query_runner.port
-            except NotImplementedError:
-                raise NotImplementedError(
-                    "SSH tunneling is not implemented for this query runner yet."
-                )
+def _open_ssh_tunnel(details, remote_address):
+    bastion_address = (details["ssh_host"], details.get("ssh_port", 22))
+    auth = {
+        "ssh_username": details["ssh_username"],
+        **settings.dynamic_settings.ssh_tunnel_auth(),
+    }
+    return open_tunnel(bastion_address, remote_bind_address=remote_address, **auth)
 
-            stack = ExitStack()
-            try:
-                bastion_address = (details["ssh_host"], details.get("ssh_port", 22))
-                remote_address = (remote_host, remote_port)
-                auth = {
-                    "ssh_username": details["ssh_username"],
-                    **settings.dynamic_settings.ssh_tunnel_auth(),
-                }
-                server = stack.enter_context(
-                    open_tunnel(
-                        bastion_address, remote_bind_address=remote_address, **auth
+
+def _start_ssh_tunnel(details, remote_address):
+    server = _open_ssh_tunnel(details, remote_address)
+    server.start()
+    return server
+
+
+def with_ssh_tunnel(query_runner, details):
+    # The tunnel is shared by the calls running at the same time (like the table counts of a
+    # schema refresh): the first one opens it and points the runner at it, the last one closes it.
+    lock = threading.Lock()
+    state = {"users": 0, "stack": None, "remote_address": None}
+
+    def open_tunnel():
+        with lock:
+            if state["users"] == 0:
+                try:
+                    remote_host, remote_port = query_runner.host, query_runner.port
+                except NotImplementedError:
+                    raise NotImplementedError(
+                        "SSH tunneling is not implemented for this query runner yet."
                     )
-                )
-            except Exception as error:
-                raise type(error)("SSH tunnel: {}".format(str(error)))
 
-            with stack:
+                remote_address = (remote_host, remote_port)
+                stack = ExitStack()
                 try:
-                    query_runner.host, query_runner.port = server.local_bind_address
-                    result = f(*args, **kwargs)
-                finally:
-                    query_runner.host, query_runner.port = remote_host, remote_port
+                    if query_runner.pool_key is not None:
+                        # Keep tunnels open between queries, like the connections going through them.
+                        tunnels = pool.get_pool(
+                            "tunnel",
+                            query_runner.pool_key,
+                            lambda: pool.ConnectionPool(
+                                validate=lambda server: server.is_active,
+                                close=lambda server: server.stop(),
+                            ),
+                        )
+                        server = stack.enter_context(
+                            tunnels.connection(
+                                lambda: _start_ssh_tunnel(details, remote_address)
+                            )
+                        )
+                    else:
+                        server = stack.enter_context(
+                            _open_ssh_tunnel(details, remote_address)
+                        )
+                except Exception as error:
+                    raise type(error)("SSH tunnel: {}".format(str(error)))
+
+                query_runner.host, query_runner.port = server.local_bind_address
+                state.update(stack=stack, remote_address=remote_address)
+            state["users"] += 1
+
+    def close_tunnel():
+        with lock:
+            state["users"] -= 1
+            if state["users"] == 0:
+                query_runner.host, query_runner.port = state["remote_address"]
+                state["stack"].close()
 
-                return result
+    def tunnel(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            open_tunnel()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                close_tunnel()
 
         return wrapper
 
     query_runner.run_query = tunnel(query_runner.run_query)
+    # Internal queries, and the schema refresh once for all of its queries.
+    query_runner._run_query_rows = tunnel(query_runner._run_query_rows)
+    query_runner.get_schema = tunnel(query_runner.get_schema)
+    query_runner.get_schema_fingerprint = tunnel(query_runner.get_schema_fingerprint)
+    # The async methods would bypass the tunnel, use the blocking fallback instead.
+    query_runner.supports_async = False
 
     return query_runner
@@ -1,15 +1,19 @@
+import asyncio
 import os
 import logging
 import select
+import threading
 from base64 import b64decode
 from tempfile import NamedTemporaryFile
 from uuid import uuid4
 
 import psycopg2
+import sqlparse
 from psycopg2.extras import Range
 
 from bi.query_runner import *
-from bi.utils import JSONEncoder, json_dumps, json_loads
+from bi.query_runner import split_sql_statements
+from bi.utils import JSONEncoder
 
 logger = logging.getLogger(__name__)
 
@@ -54,7 +58,10 @@ class PostgreSQLJSONEncoder(JSONEncoder):
 
 
 def _wait(conn, timeout=None):
+    # Wake up every second at least, to notice when a `run_concurrently` call is interrupted.
+    timeout = timeout or 1
     while 1:
+        check_interrupted()
         try:
             state = conn.poll()
             if state == psycopg2.extensions.POLL_OK:
@@ -69,6 +76,81 @@ def _wait(conn, timeout=None):
             raise psycopg2.OperationalError("select.error received")
 
 
+async def _wait_async(conn):
+    """`_wait` for asyncio: polls the connection whenever its socket is ready."""
+    loop = asyncio.get_event_loop()
+    fd = conn.fileno()
+
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("poll() returned %s" % state)
+
+        ready = loop.create_future()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+class ServerSideCursor(object):
+    """Cursor reading the result of a SELECT from the server in batches (DECLARE ... CURSOR /
+    FETCH n), so libpq doesn't buffer the whole result before `write_results` caps it. Named
+    cursors are not available on async connections, these statements are.
+
+    The cursor lives in a transaction, ended by `close`.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.name = "bi_{}".format(uuid4().hex)
+        self.description = None
+
+    def _execute(self, statement):
+        self.cursor.execute(statement)
+        _wait(self.connection)
+
+    def execute(self, query):
+        self._execute("BEGIN")
+        self._execute("DECLARE {} NO SCROLL CURSOR FOR {}".format(self.name, query))
+        # Fetching no row returns the description of the result.
+        self._execute("FETCH FORWARD 0 FROM {}".format(self.name))
+        self.description = self.cursor.description
+
+    def fetchmany(self, size):
+        self._execute("FETCH FORWARD {:d} FROM {}".format(size, self.name))
+        return self.cursor.fetchall()
+
+    def close(self):
+        self._execute("CLOSE {}".format(self.name))
+        self._execute("COMMIT")
+        self.cursor.close()
+
+
+def _single_select(query):
+    """Returns the statement of `query` if it is a single SELECT, which can be read through a
+    `ServerSideCursor`, None otherwise."""
+    statements = split_sql_statements(query)
+    if len(statements) != 1:
+        return None
+
+    parsed = sqlparse.parse(statements[0])
+    if not parsed or parsed[0].get_type() != "SELECT":
+        return None
+    # SELECT ... INTO creates a table, it can't be declared as a cursor
+    if any(token.is_keyword and token.normalized == "INTO" for token in parsed[0].tokens):
+        return None
+    return statements[0]
+
+
 def full_table_name(schema, name):
     if "." in name:
         name = '"{}"'.format(name)
@@ -76,7 +158,7 @@ def full_table_name(schema, name):
     return "{}.{}".format(schema, name)
 
 
-def build_schema(query_result, schema):
+def build_schema(names, rows, schema):
     # By default we omit the public schema name from the table name. But there are
     # edge cases, where this might cause conflicts. For example:
     # * We have a schema named "main" with table "users".
@@ -84,28 +166,30 @@ def build_schema(query_result, schema):
     # (while this feels unlikely, this actually happened)
     # In this case if we omit the schema name for the public table, we will have
     # a conflict.
+    schema_idx = names.index("table_schema")
+    table_idx = names.index("table_name")
+    column_idx = names.index("column_name")
+    type_idx = names.index("data_type") if "data_type" in names else None
+
     table_names = set(
-        map(
-            lambda r: full_table_name(r["table_schema"], r["table_name"]),
-            query_result["rows"],
-        )
+        full_table_name(row[schema_idx], row[table_idx]) for row in rows
     )
 
-    for row in query_result["rows"]:
-        if row["table_schema"] != "public":
-            table_name = full_table_name(row["table_schema"], row["table_name"])
+    for row in rows:
+        if row[schema_idx] != "public":
+            table_name = full_table_name(row[schema_idx], row[table_idx])
         else:
-            if row["table_name"] in table_names:
-                table_name = full_table_name(row["table_schema"], row["table_name"])
+            if row[table_idx] in table_names:
+                table_name = full_table_name(row[schema_idx], row[table_idx])
             else:
-                table_name = row["table_name"]
+                table_name = row[table_idx]
 
         if table_name not in schema:
             schema[table_name] = {"name": table_name, "columns": []}
 
-        column = row["column_name"]
-        if row.get("data_type") is not None:
-            column = {"name": row["column_name"], "type": row["data_type"]}
+        column = row[column_idx]
+        if type_idx is not None and row[type_idx] is not None:
+            column = {"name": row[column_idx], "type": row[type_idx]}
 
         schema[table_name]["columns"].append(column)
 
@@ -138,6 +222,30 @@ def _get_ssl_config(configuration):
 
 class PostgreSQL(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    # Read SELECT results in batches through a ServerSideCursor
+    server_side_cursors = True
+    # Reads pg_class/pg_attribute on the server and returns a single checksum row.
+    schema_fingerprint_query = """
+    SELECT count(*),
+           md5(string_agg(c.oid::text || ':' || s.nspname || '.' || c.relname || ':' ||
+                          a.attnum::text || ':' || a.attname || ':' || a.atttypid::text,
+                          ',' ORDER BY c.oid, a.attnum))
+    FROM pg_class c
+    JOIN pg_namespace s
+    ON c.relnamespace = s.oid
+    AND s.nspname NOT IN ('pg_catalog', 'information_schema')
+    JOIN pg_attribute a
+    ON a.attrelid = c.oid
+    AND a.attnum > 0
+    AND NOT a.attisdropped
+    WHERE c.relkind IN ('r', 'v', 'm', 'f', 'p')
+    """
+    supports_async = True
+
+    def __init__(self, configuration):
+        super().__init__(configuration)
+        # Held while self.ssl_config is set and read, by the threads connecting at the same time.
+        self._connect_lock = threading.Lock()
 
     @classmethod
     def configuration_schema(cls):
@@ -165,6 +273,9 @@ class PostgreSQL(BaseSQLQueryRunner):
                 "sslrootcertFile": {"type": "string", "title": "SSL根证书"},
                 "sslcertFile": {"type": "string", "title": "SSL客户端证书"},
                 "sslkeyFile": {"type": "string", "title": "SSL客户端密钥"},
+                "max_rows": {"type": "number", "title": "最大返回行数"},
+                "max_bytes": {"type": "number", "title": "最大返回字节数"},
+                "connection_pool": {"type": "boolean", "title": "使用连接池"},
             },
             "order": ["host", "port", "user", "password"],
             "required": ["dbname"],
@@ -174,6 +285,9 @@ class PostgreSQL(BaseSQLQueryRunner):
                 "sslrootcertFile",
                 "sslcertFile",
                 "sslkeyFile",
+                "max_rows",
+                "max_bytes",
+                "connection_pool",
             ],
         }
 
@@ -181,15 +295,35 @@ class PostgreSQL(BaseSQLQueryRunner):
     def type(cls):
         return "pg"
 
-    def _get_definitions(self, schema, query):
-        results, error = self.run_query(query, None)
+    def _get_table_size_estimates(self):
+        # reltuples is -1 for tables never vacuumed or analyzed (PostgreSQL 14+).
+        query = """
+        SELECT s.nspname AS table_schema,
+               c.relname AS table_name,
+               c.reltuples::bigint AS estimated_rows,
+               greatest(st.last_analyze, st.last_autoanalyze, st.last_vacuum, st.last_autovacuum)
+        FROM pg_class c
+        JOIN pg_namespace s
+        ON c.relnamespace = s.oid
+        AND s.nspname NOT IN ('pg_catalog', 'information_schema')
+        LEFT JOIN pg_stat_all_tables st
+        ON st.relid = c.oid
+        WHERE c.relkind IN ('r', 'm', 'p')
+        AND c.reltuples >= 0
+        """
+        _, rows = self._run_query_rows(query)
 
-        if error is not None:
-            self._handle_run_query_error(error)
+        estimates = {}
+        for table_schema, table_name, estimated_rows, updated_at in rows:
+            estimates[full_table_name(table_schema, table_name)] = (estimated_rows, updated_at)
+            if table_schema == "public":
+                estimates.setdefault(table_name, (estimated_rows, updated_at))
+        return estimates
 
-        results = json_loads(results)
+    def _get_definitions(self, schema, query):
+        names, rows = self._run_query_rows(query)
 
-        build_schema(results, schema)
+        build_schema(names, rows, schema)
 
     def _get_tables(self, schema):
         """
@@ -249,31 +383,70 @@ class PostgreSQL(BaseSQLQueryRunner):
 
         return connection
 
-    def run_query(self, query, user):
-        connection = self._get_connection()
-        _wait(connection, timeout=10)
+    def _start_connection(self):
+        """Starts connecting (without waiting), returns the connection and its SSL config."""
+        with self._connect_lock:
+            connection = self._get_connection()
+            return connection, self.ssl_config
+
+    def _connect(self):
+        connection, ssl_config = self._start_connection()
+        try:
+            _wait(connection, timeout=10)
+        finally:
+            # Certificates are only read while the connection is established.
+            _cleanup_ssl_certs(ssl_config)
+
+        return connection
+
+    def _validate_connection(self, connection):
+        if connection.closed:
+            return False
 
         cursor = connection.cursor()
+        cursor.execute(self.noop_query)
+        _wait(connection, timeout=10)
+        cursor.close()
+
+    def run_query(self, query, user):
+        connection_pool = self.get_connection_pool()
+        if connection_pool is None:
+            connection = self._connect()
+        else:
+            connection = connection_pool.acquire(self._connect)
+
+        reusable = False
 
         try:
-            cursor.execute(query)
-            _wait(connection)
+            select_query = _single_select(query) if self.server_side_cursors else None
+            if select_query is not None:
+                cursor = ServerSideCursor(connection)
+                cursor.execute(select_query)
+            else:
+                cursor = connection.cursor()
+                cursor.execute(query)
+                _wait(connection)
 
             if cursor.description is not None:
                 columns = self.fetch_columns(
                     [(i[0], types_map.get(i[1], None)) for i in cursor.description]
                 )
-                rows = [
-                    dict(zip((column["name"] for column in columns), row))
-                    for row in cursor
-                ]
+                writer = self.write_results(cursor, columns, PostgreSQLJSONEncoder)
+                if writer.truncated:
+                    logger.info(
+                        "Query result truncated at %d rows (%d bytes).",
+                        writer.row_count,
+                        writer.byte_count,
+                    )
 
-                data = {"columns": columns, "rows": rows}
                 error = None
-                json_data = json_dumps(data, ignore_nan=True, cls=PostgreSQLJSONEncoder)
+                json_data = writer.getvalue()
             else:
                 error = "Query completed but it returned no data."
                 json_data = None
+
+            cursor.close()
+            reusable = True
         except (select.error, OSError) as e:
             error = "Query interrupted. Please retry."
             json_data = None
@@ -284,13 +457,117 @@ class PostgreSQL(BaseSQLQueryRunner):
             connection.cancel()
             raise
         finally:
-            connection.close()
-            _cleanup_ssl_certs(self.ssl_config)
+            if connection_pool is None:
+                connection.close()
+            else:
+                connection_pool.release(connection, discard=not reusable)
 
         return json_data, error
 
+    def _run_query_rows(self, query):
+        connection_pool = self.get_connection_pool()
+        if connection_pool is None:
+            connection = self._connect()
+        else:
+            connection = connection_pool.acquire(self._connect)
+
+        cursor = connection.cursor()
+        reusable = False
+
+        try:
+            cursor.execute(query)
+            _wait(connection)
+
+            if cursor.description is None:
+                raise Exception("Query completed but it returned no data.")
+            names = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+
+            reusable = True
+        except (select.error, OSError):
+            raise Exception("Query interrupted. Please retry.")
+        except psycopg2.DatabaseError as e:
+            self._handle_run_query_error(str(e))
+        except (KeyboardInterrupt, InterruptException, JobTimeoutException):
+            connection.cancel()
+            raise
+        finally:
+            if connection_pool is None:
+                connection.close()
+            else:
+                connection_pool.release(connection, discard=not reusable)
+
+        return names, rows
+
+    async def execute_async(self, query, user, max_rows=None):
+        # Not pooled: the pool hands out connections to blocking code only.
+        connection, ssl_config = self._start_connection()
+        try:
+            await _wait_async(connection)
+        except Exception:
+            connection.close()
+            raise
+        finally:
+            _cleanup_ssl_certs(ssl_config)
+
+        handle = AsyncQuery(connection, max_rows)
+        handle.cursor = connection.cursor()
+
+        # The async cursor buffers the whole result client side: with a row cap, only fetch the
+        # rows under the cap (and one more to tell it was reached) through a server-side cursor.
+        # The transaction ends when the connection is closed.
+        row_cap = self.row_cap(max_rows)
+        select_query = _single_select(query) if self.server_side_cursors and row_cap else None
+        if select_query is not None:
+            name = "bi_{}".format(uuid4().hex)
+            query = "BEGIN; DECLARE {} NO SCROLL CURSOR FOR {}; FETCH FORWARD {:d} FROM {}".format(
+                name, select_query, row_cap + 1, name
+            )
+
+        handle.cursor.execute(query)
+        return handle
+
+    async def fetch_async(self, handle):
+        try:
+            await _wait_async(handle.connection)
+        except psycopg2.DatabaseError as e:
+            return None, str(e)
+        finally:
+            handle.done = not handle.connection.isexecuting()
+
+        cursor = handle.cursor
+        if cursor.description is None:
+            return None, "Query completed but it returned no data."
+
+        # Async cursors have the whole (fetched) result client side once the query completed.
+        columns = self.fetch_columns(
+            [(i[0], types_map.get(i[1], None)) for i in cursor.description]
+        )
+        writer = self.write_results(
+            cursor, columns, PostgreSQLJSONEncoder, max_rows=handle.max_rows
+        )
+        return writer.getvalue(), None
+
+    async def cancel_async(self, handle):
+        if handle.done or handle.connection.closed:
+            return
+
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, handle.connection.cancel)
+        except psycopg2.Error:
+            logger.warning("Failed cancelling query.", exc_info=1)
+
+    async def close_async(self, handle):
+        handle.connection.close()
+
 
 class Redshift(PostgreSQL):
+    schema_fingerprint_query = None
+
+    def _get_table_size_estimates(self):
+        return None
+
     @classmethod
     def type(cls):
         return "redshift"
@@ -544,6 +821,12 @@ class RedshiftIAM(Redshift):
 
 
 class CockroachDB(PostgreSQL):
+    schema_fingerprint_query = None
+    server_side_cursors = False
+
+    def _get_table_size_estimates(self):
+        return None
+
     @classmethod
     def type(cls):
         return "cockroach"
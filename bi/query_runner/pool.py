@@ -0,0 +1,140 @@
+"""
+Process-local pools of data source connections (and SSH tunnels).
+
+Pools are keyed by data source id plus a hash of the data source options, so a pool
+is dropped and rebuilt as soon as the options of its data source change. Connections
+are validated before being handed out again and closed after sitting idle for too long.
+
+Note that RQ work horses are forked per job: pooled connections only outlive a job
+when the worker runs jobs in-process (`rq worker --no-fork`).
+"""
+import hashlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from bi import settings
+from bi.utils import json_dumps
+
+logger = logging.getLogger(__name__)
+
+
+def options_hash(options):
+    return hashlib.sha1(json_dumps(options, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ConnectionPool(object):
+    """A LIFO pool of idle connections. `connect` is passed on acquire, as it depends on the
+    runner instance (e.g. the local address of its SSH tunnel)."""
+
+    def __init__(self, validate=None, close=None, max_size=None, max_idle_time=None):
+        self._validate = validate
+        self._close = close or (lambda connection: connection.close())
+        self.max_size = max_size or settings.QUERY_RUNNER_POOL_SIZE
+        self.max_idle_time = max_idle_time or settings.QUERY_RUNNER_POOL_MAX_IDLE_TIME
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _discard(self, connection):
+        try:
+            self._close(connection)
+        except Exception:
+            logger.debug("Failed closing pooled connection.", exc_info=1)
+
+    def _is_valid(self, connection):
+        if self._validate is None:
+            return True
+
+        try:
+            return self._validate(connection) is not False
+        except Exception:
+            return False
+
+    def acquire(self, connect):
+        while True:
+            with self._lock:
+                item = self._idle.pop() if self._idle else None
+
+            if item is None:
+                return connect()
+
+            connection, released_at = item
+            if time.time() - released_at > self.max_idle_time or not self._is_valid(connection):
+                self._discard(connection)
+                continue
+
+            return connection
+
+    def release(self, connection, discard=False):
+        if not discard:
+            with self._lock:
+                if len(self._idle) < self.max_size:
+                    self._idle.append((connection, time.time()))
+                    return
+
+        self._discard(connection)
+
+    @contextmanager
+    def connection(self, connect):
+        connection = self.acquire(connect)
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            self._discard(connection)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(kind, pool_key, factory):
+    """Returns the `kind` ("connection", "tunnel", ...) pool for `pool_key`, creating it with
+    `factory` if needed. Pools of the same data source built with older options are closed."""
+    data_source_id, current_hash = pool_key
+
+    with _pools_lock:
+        stale = [
+            key
+            for key in _pools
+            if key[0] == kind and key[1] == data_source_id and key[2] != current_hash
+        ]
+        stale_pools = [_pools.pop(key) for key in stale]
+
+        key = (kind, data_source_id, current_hash)
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = factory()
+
+    for stale_pool in stale_pools:
+        stale_pool.close()
+
+    return pool
+
+
+def invalidate(data_source_id):
+    with _pools_lock:
+        keys = [key for key in _pools if key[1] == data_source_id]
+        pools = [_pools.pop(key) for key in keys]
+
+    for pool in pools:
+        pool.close()
+
+
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+
+    for pool in pools:
+        pool.close()
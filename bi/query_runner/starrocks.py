@@ -11,13 +11,14 @@ from bi.query_runner import (
     BaseSQLQueryRunner,
     InterruptException,
     JobTimeoutException,
+    check_interrupted,
     register,
 )
 from bi.settings import parse_boolean
-from bi.utils import json_dumps, json_loads
 
 try:
     import MySQLdb
+    import MySQLdb.cursors
 
     enabled = True
 except ImportError:
@@ -51,6 +52,12 @@ class Result(object):
 
 class StarRocks(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    schema_fingerprint_query = """
+    SELECT COUNT(*),
+           SUM(murmur_hash3_32(CONCAT_WS('.', table_schema, table_name, column_name, column_type, column_comment)))
+    FROM `information_schema`.`columns`
+    WHERE table_schema NOT IN ('information_schema', 'performance_schema', 'mysql', 'sys')
+    """
 
     @classmethod
     def configuration_schema(cls):
@@ -69,6 +76,9 @@ class StarRocks(BaseSQLQueryRunner):
                 "connect_timeout": {"type": "number", "default": 60, "title": "连接超时"},
                 "charset": {"type": "string", "default": "utf8", "title": "字符集"},
                 "use_unicode": {"type": "boolean", "default": True, "title": "使用unicode"},
+                "max_rows": {"type": "number", "title": "最大返回行数"},
+                "max_bytes": {"type": "number", "title": "最大返回字节数"},
+                "connection_pool": {"type": "boolean", "title": "使用连接池"},
             },
             "order": ["host", "port", "user", "passwd", "db", "connect_timeout", "charset", "use_unicode"],
             "required": ["db"],
@@ -125,6 +135,29 @@ class StarRocks(BaseSQLQueryRunner):
 
         return connection
 
+    def _get_table_size_estimates(self):
+        # table_rows comes from the tablet statistics the backends report to the frontend, it
+        # lags behind recent loads.
+        query = """
+        SELECT tab.table_schema as table_schema,
+               tab.table_name as table_name,
+               tab.table_rows as table_rows,
+               COALESCE(tab.update_time, tab.create_time) as updated_at
+        FROM `information_schema`.`tables` tab
+        WHERE tab.table_schema NOT IN ('information_schema', 'performance_schema', 'mysql', 'sys')
+        AND tab.table_rows IS NOT NULL;
+        """
+
+        _, rows = self._run_query_rows(query)
+
+        db = self.configuration["db"]
+        estimates = {}
+        for table_schema, table_name, table_rows, updated_at in rows:
+            if table_schema != db:
+                table_name = "{}.{}".format(table_schema, table_name)
+            estimates[table_name] = (table_rows, updated_at)
+        return estimates
+
     def _get_tables(self, schema):
         query = """
         SELECT col.table_schema as table_schema,
@@ -135,90 +168,163 @@ class StarRocks(BaseSQLQueryRunner):
         WHERE col.table_schema NOT IN ('information_schema', 'performance_schema', 'mysql', 'sys');
         """
 
-        results, error = self.run_query(query, None)
-
-        if error is not None:
-            self._handle_run_query_error(error)
+        _, rows = self._run_query_rows(query)
 
-        results = json_loads(results)
-
-        for row in results["rows"]:
-            if row["table_schema"] != self.configuration["db"]:
-                table_name = "{}.{}".format(row["table_schema"], row["table_name"])
-            else:
-                table_name = row["table_name"]
+        db = self.configuration["db"]
+        for table_schema, table_name, column_name, column_comment in rows:
+            if table_schema != db:
+                table_name = "{}.{}".format(table_schema, table_name)
 
             if table_name not in schema:
                 schema[table_name] = {"name": table_name, "columns": [], 'comment': []}
 
-            schema[table_name]["columns"].append(row["column_name"])
-            schema[table_name]["comment"].append(row["column_comment"])
+            schema[table_name]["columns"].append(column_name)
+            schema[table_name]["comment"].append(column_comment)
 
         return list(schema.values())
 
 
     def run_query(self, query, user):
+        r = self._run_in_thread(self._run_query, query, user)
+
+        return r.json_data, r.error
+
+    def _run_query_rows(self, query):
+        r = self._run_in_thread(self._fetch_rows, query, None)
+
+        if r.error is not None:
+            self._handle_run_query_error(r.error)
+
+        return r.columns, r.rows
+
+    def _run_in_thread(self, target, query, user):
+        """Runs `target` in a thread, so the query can be killed when the job is interrupted."""
         ev = threading.Event()
         thread_id = ""
         r = Result()
         t = None
 
+        connection_pool = self.get_connection_pool()
+
         try:
-            connection = self._connection()
+            if connection_pool is None:
+                connection = self._connection()
+            else:
+                connection = connection_pool.acquire(self._connection)
             thread_id = connection.thread_id()
             t = threading.Thread(
-                target=self._run_query, args=(query, user, connection, r, ev)
+                target=target,
+                args=(query, user, connection, r, ev, connection_pool),
             )
             t.start()
             while not ev.wait(1):
-                pass
+                check_interrupted()
         except (KeyboardInterrupt, InterruptException, JobTimeoutException):
             self._cancel(thread_id)
             t.join()
             raise
 
-        return r.json_data, r.error
+        return r
 
-    def _run_query(self, query, user, connection, r, ev):
+    def _validate_connection(self, connection):
+        connection.ping()
+
+    def _fetch_rows(self, query, user, connection, r, ev, connection_pool=None):
+        cursor = None
+        reusable = False
         try:
+            # Buffered cursor, internal queries are read whole.
             cursor = connection.cursor()
-            logger.debug("Star Rocks running query: %s", query)
+            logger.debug("Star Rocks running internal query: %s", query)
             cursor.execute(query)
 
-            data = cursor.fetchall()
-            desc = cursor.description
+            if cursor.description is not None:
+                r.columns = [column[0] for column in cursor.description]
+                r.rows = cursor.fetchall()
+                r.error = None
+            else:
+                r.error = "No data was returned."
+
+            cursor.close()
+            connection.rollback()
+            reusable = True
+        except MySQLdb.Error as e:
+            if cursor:
+                cursor.close()
+            r.error = e.args[1]
+        finally:
+            ev.set()
+            if connection_pool is not None:
+                connection_pool.release(connection, discard=not reusable)
+            elif connection:
+                connection.close()
 
-            while cursor.nextset():
+    def _close_truncated(self, cursor, connection):
+        """Closes an unbuffered cursor whose result was not read to the end. Closing it reads the
+        remaining rows, so the connection is killed first to stop the server from sending them
+        (the connection is discarded afterwards)."""
+        self._cancel(connection.thread_id())
+        try:
+            cursor.close()
+        except MySQLdb.Error:
+            pass
+
+    def _run_query(self, query, user, connection, r, ev, connection_pool=None):
+        cursor = None
+        truncated = False
+        reusable = False
+        try:
+            # Unbuffered cursor, so rows are streamed from the server in batches instead of
+            # being loaded into memory all at once.
+            cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+            logger.debug("Star Rocks running query: %s", query)
+            cursor.execute(query)
+
+            writer = None
+            while True:
                 if cursor.description is not None:
-                    data = cursor.fetchall()
-                    desc = cursor.description
-
-            # TODO - very similar to pg.py
-            if desc is not None:
-                columns = self.fetch_columns(
-                    [(i[0], types_map.get(i[1], None)) for i in desc]
-                )
-                rows = [
-                    dict(zip((column["name"] for column in columns), row))
-                    for row in data
-                ]
-
-                data = {"columns": columns, "rows": rows}
-                r.json_data = json_dumps(data)
+                    columns = self.fetch_columns(
+                        [(i[0], types_map.get(i[1], None)) for i in cursor.description]
+                    )
+                    writer = self.write_results(cursor, columns)
+                    if writer.truncated:
+                        truncated = True
+                        logger.info(
+                            "Query result truncated at %d rows (%d bytes).",
+                            writer.row_count,
+                            writer.byte_count,
+                        )
+                        break
+
+                if not cursor.nextset():
+                    break
+
+            if writer is not None:
+                r.json_data = writer.getvalue()
                 r.error = None
             else:
                 r.json_data = None
                 r.error = "No data was returned."
 
-            cursor.close()
+            if truncated:
+                self._close_truncated(cursor, connection)
+            else:
+                cursor.close()
+                # End the implicit transaction, like closing the connection would.
+                connection.rollback()
+                reusable = True
         except MySQLdb.Error as e:
-            if cursor:
+            if cursor and truncated:
+                self._close_truncated(cursor, connection)
+            elif cursor:
                 cursor.close()
             r.json_data = None
             r.error = e.args[1]
         finally:
             ev.set()
-            if connection:
+            if connection_pool is not None:
+                connection_pool.release(connection, discard=not reusable)
+            elif connection:
                 connection.close()
 
     def _get_ssl_parameters(self):
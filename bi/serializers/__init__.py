@@ -17,8 +17,8 @@ from bi.models.parameterized_query import ParameterizedQuery
 
 from .query_result import (
     serialize_query_result,
-    serialize_query_result_to_dsv,
-    serialize_query_result_to_xlsx,
+    stream_query_result_to_dsv,
+    stream_query_result_to_xlsx,
 )
 
 
@@ -1,5 +1,7 @@
 import io
 import csv
+import os
+import tempfile
 import xlsxwriter
 from funcy import rpartial, project
 from dateutil.parser import isoparse as parse_date
@@ -7,6 +9,10 @@ from bi.utils import json_loads, UnicodeWriter
 from bi.query_runner import TYPE_BOOLEAN, TYPE_DATE, TYPE_DATETIME
 from bi.authentication.org_resolving import current_org
 
+# Number of rows converted and flushed to the client at a time by the streaming serializers.
+STREAM_CHUNK_ROWS = 1000
+STREAM_CHUNK_BYTES = 64 * 1024
+
 
 def _convert_format(fmt):
     return (
@@ -79,45 +85,81 @@ def serialize_query_result(query_result, is_api_user):
         return query_result.to_dict()
 
 
-def serialize_query_result_to_dsv(query_result, delimiter):
-    s = io.StringIO()
+def _get_row_converters(columns):
+    """Return the field names and a positional list of converters (or None), computed once per result."""
+    fieldnames, special_columns = _get_column_lists(columns)
+    return fieldnames, [special_columns.get(name) for name in fieldnames]
+
+
+def _convert_rows(rows, fieldnames, converters):
+    pairs = list(zip(fieldnames, converters))
+    for row in rows:
+        yield [
+            converter(row[name]) if converter and name in row else row.get(name, "")
+            for name, converter in pairs
+        ]
 
-    query_data = query_result.data
 
-    fieldnames, special_columns = _get_column_lists(query_data["columns"] or [])
+def stream_query_result_to_dsv(query_result, delimiter):
+    """Serializes the result as delimiter separated values, returns a generator of text chunks.
 
-    writer = csv.DictWriter(s, extrasaction="ignore", fieldnames=fieldnames, delimiter=delimiter)
-    writer.writeheader()
+    Column converters are resolved eagerly (they depend on the current org), so the
+    returned generator doesn't need the request context.
+    """
+    fieldnames, converters = _get_row_converters(query_result.result_columns)
 
-    for row in query_data["rows"]:
-        for col_name, converter in special_columns.items():
-            if col_name in row:
-                row[col_name] = converter(row[col_name])
+    def generate():
+        s = io.StringIO()
+        writer = csv.writer(s, delimiter=delimiter)
+        writer.writerow(fieldnames)
 
-        writer.writerow(row)
+        for i, row in enumerate(
+            _convert_rows(query_result.iter_rows(), fieldnames, converters), 1
+        ):
+            writer.writerow(row)
+            if i % STREAM_CHUNK_ROWS == 0:
+                yield s.getvalue()
+                s.seek(0)
+                s.truncate(0)
 
-    return s.getvalue()
+        yield s.getvalue()
 
+    return generate()
 
-def serialize_query_result_to_xlsx(query_result):
-    output = io.BytesIO()
 
-    query_data = query_result.data
-    book = xlsxwriter.Workbook(output, {"constant_memory": True})
-    sheet = book.add_worksheet("result")
+def stream_query_result_to_xlsx(query_result):
+    """Serializes the result as an Excel workbook, spooled to a temporary file. Returns a
+    generator reading it back in chunks."""
+    column_names = [col["name"] for col in query_result.result_columns]
 
-    column_names = []
-    for c, col in enumerate(query_data["columns"]):
-        sheet.write(0, c, col["name"])
-        column_names.append(col["name"])
+    output = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
+    output.close()
+
+    try:
+        book = xlsxwriter.Workbook(output.name, {"constant_memory": True})
+        sheet = book.add_worksheet("result")
 
-    for r, row in enumerate(query_data["rows"]):
         for c, name in enumerate(column_names):
-            v = row.get(name)
-            if isinstance(v, (dict, list)):
-                v = str(v)
-            sheet.write(r + 1, c, v)
+            sheet.write(0, c, name)
 
-    book.close()
+        for r, row in enumerate(query_result.iter_rows()):
+            for c, name in enumerate(column_names):
+                v = row.get(name)
+                if isinstance(v, (dict, list)):
+                    v = str(v)
+                sheet.write(r + 1, c, v)
 
-    return output.getvalue()
+        book.close()
+    except Exception:
+        os.remove(output.name)
+        raise
+
+    def generate():
+        try:
+            with open(output.name, "rb") as f:
+                for chunk in iter(lambda: f.read(STREAM_CHUNK_BYTES), b""):
+                    yield chunk
+        finally:
+            os.remove(output.name)
+
+    return generate()
@@ -64,7 +64,64 @@ QUERY_RESULTS_CLEANUP_MAX_AGE = int(
     os.environ.get("HOLMES_QUERY_RESULTS_CLEANUP_MAX_AGE", "7")
 )
 
+# Store query results as compressed column chunks instead of a single JSON text blob.
+QUERY_RESULTS_COLUMNAR_STORAGE = parse_boolean(
+    os.environ.get("HOLMES_QUERY_RESULTS_COLUMNAR_STORAGE", "false")
+)
+QUERY_RESULTS_COLUMNAR_CHUNK_SIZE = int(
+    os.environ.get("HOLMES_QUERY_RESULTS_COLUMNAR_CHUNK_SIZE", "10000")
+)
+QUERY_RESULTS_COLUMNAR_COMPRESSION_LEVEL = int(
+    os.environ.get("HOLMES_QUERY_RESULTS_COLUMNAR_COMPRESSION_LEVEL", "6")
+)
+
+# Default caps on the size of a query result (0 means unlimited). Data sources can override them
+# with the `max_rows` / `max_bytes` options; results over the cap are truncated and flagged.
+QUERY_RESULTS_MAX_ROWS = int(os.environ.get("HOLMES_QUERY_RESULTS_MAX_ROWS", "0"))
+QUERY_RESULTS_MAX_BYTES = int(os.environ.get("HOLMES_QUERY_RESULTS_MAX_BYTES", "0"))
+# Store result rows as arrays of values (with the column names once in "columns") instead of
+# objects repeating every column name. Rows are expanded back to objects for API consumers.
+QUERY_RESULTS_COMPACT_ROWS = parse_boolean(
+    os.environ.get("HOLMES_QUERY_RESULTS_COMPACT_ROWS", "true")
+)
+# Time limit (seconds) and row cap of the ad-hoc preview queries, run in the web process.
+QUERY_PREVIEW_TIMEOUT = int(os.environ.get("HOLMES_QUERY_PREVIEW_TIMEOUT", "30"))
+QUERY_PREVIEW_MAX_ROWS = int(os.environ.get("HOLMES_QUERY_PREVIEW_MAX_ROWS", "100"))
+# Number of rows query runners fetch from the database cursor at a time.
+QUERY_RUNNER_FETCH_BATCH_SIZE = int(
+    os.environ.get("HOLMES_QUERY_RUNNER_FETCH_BATCH_SIZE", "5000")
+)
+
+# Pooling of data source connections for data sources with the `connection_pool` option enabled.
+QUERY_RUNNER_POOL_SIZE = int(os.environ.get("HOLMES_QUERY_RUNNER_POOL_SIZE", "5"))
+QUERY_RUNNER_POOL_MAX_IDLE_TIME = int(
+    os.environ.get("HOLMES_QUERY_RUNNER_POOL_MAX_IDLE_TIME", "300")
+)
+
+# How long (in seconds) the Redis index of the latest result per query hash keeps an entry.
+QUERY_RESULTS_INDEX_TTL = int(
+    os.environ.get("HOLMES_QUERY_RESULTS_INDEX_TTL", 7 * 24 * 60 * 60)
+)
+# Number of recently used query results kept deserialized in each process (0 disables it).
+QUERY_RESULTS_LRU_SIZE = int(os.environ.get("HOLMES_QUERY_RESULTS_LRU_SIZE", "0"))
+# Number of results stored as JSON kept columnar encoded in each process, to page through them
+# without parsing them again (0 disables it).
+QUERY_RESULTS_SLICE_CACHE_SIZE = int(
+    os.environ.get("HOLMES_QUERY_RESULTS_SLICE_CACHE_SIZE", "16")
+)
+
+# How often (seconds) the scheduler looks for due queries.
+QUERY_SCHEDULER_INTERVAL = int(os.environ.get("HOLMES_QUERY_SCHEDULER_INTERVAL", 30))
+# Due queries are looked at again after this many seconds, until their execution starts.
+QUERY_SCHEDULER_RETRY_DELAY = int(os.environ.get("HOLMES_QUERY_SCHEDULER_RETRY_DELAY", 30))
+# How often (seconds) all scheduled queries are re-evaluated, to catch any missed change.
+QUERY_SCHEDULER_RESYNC_INTERVAL = int(
+    os.environ.get("HOLMES_QUERY_SCHEDULER_RESYNC_INTERVAL", 60 * 60)
+)
+
 SCHEMAS_REFRESH_SCHEDULE = int(os.environ.get("HOLMES_SCHEMAS_REFRESH_SCHEDULE", 30))
+# Schemas whose catalog fingerprint didn't change are still refreshed once older than this (seconds).
+SCHEMAS_REFRESH_MAX_AGE = int(os.environ.get("HOLMES_SCHEMAS_REFRESH_MAX_AGE", 24 * 60 * 60))
 
 AUTH_TYPE = os.environ.get("HOLMES_AUTH_TYPE", "api_key")
 INVITATION_TOKEN_MAX_AGE = int(
@@ -460,6 +517,13 @@ ALLOW_PARAMETERS_IN_EMBEDS = parse_boolean(
 SCHEMA_RUN_TABLE_SIZE_CALCULATIONS = parse_boolean(
     os.environ.get("HOLMES_SCHEMA_RUN_TABLE_SIZE_CALCULATIONS", "false")
 )
+# "estimate" reads table sizes from the catalog statistics where the data source has them,
+# "exact" always counts the rows of every table.
+SCHEMA_TABLE_SIZE_MODE = os.environ.get("HOLMES_SCHEMA_TABLE_SIZE_MODE", "estimate")
+# Number of table size queries run at the same time for a data source.
+SCHEMA_TABLE_STATS_CONCURRENCY = int(
+    os.environ.get("HOLMES_SCHEMA_TABLE_STATS_CONCURRENCY", 4)
+)
 
 # kylin
 KYLIN_OFFSET = int(os.environ.get("HOLMES_KYLIN_OFFSET", 0))
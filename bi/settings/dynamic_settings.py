@@ -26,6 +26,7 @@ def periodic_jobs():
 
 # This provides the ability to override the way we store QueryResult's data column.
 # Reference implementation: bi.models.DBPersistence
+# (set HOLMES_QUERY_RESULTS_COLUMNAR_STORAGE=true to use bi.models.ColumnarPersistence instead)
 QueryResultPersistence = None
 
 
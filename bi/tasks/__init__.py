@@ -13,8 +13,9 @@ from .queries import (
     remove_ghost_locks,
 )
 from .alerts import check_alerts_for_query
+from .data_source_files import convert_data_source_file
 from .failure_report import send_aggregated_errors
-from .worker import Worker, Queue, Job
+from .worker import Worker, SimpleWorker, Queue, Job
 from .schedule import rq_scheduler, schedule_periodic_jobs, periodic_job_definitions
 
 from bi import rq_redis_connection
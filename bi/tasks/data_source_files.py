@@ -0,0 +1,137 @@
+import os
+
+from bi import models, settings
+from bi.worker import job, get_job_logger
+
+try:
+    import chardet
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    enabled = True
+except ImportError:
+    enabled = False
+
+logger = get_job_logger(__name__)
+
+# Rows read from the csv at a time
+CHUNK_ROWS = 100000
+# Bytes read to detect the encoding of a file
+ENCODING_SAMPLE_BYTES = 64 * 1024
+
+# Encodings detected on a sample, replaced by a superset in case the rest of the file uses more characters
+ENCODING_SUPERSETS = {
+    "ascii": "utf-8",
+    "gb2312": "gb18030",
+    "gbk": "gb18030",
+}
+
+
+def detect_encoding(csv_path):
+    """ Detect the encoding of a file from its first bytes """
+    with open(csv_path, "rb") as f:
+        sample = f.read(ENCODING_SAMPLE_BYTES)
+    encoding = chardet.detect(sample)["encoding"] or "utf-8"
+    return ENCODING_SUPERSETS.get(encoding.lower(), encoding)
+
+
+def _read_chunks(csv_path, encoding, dtype=None):
+    return pd.read_csv(csv_path, encoding=encoding, encoding_errors="ignore", chunksize=CHUNK_ROWS, dtype=dtype)
+
+
+def _common_dtype(dtypes):
+    """ The dtype able to hold the values of every chunk of a column """
+    if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in dtypes):
+        return np.result_type(*dtypes)
+    if len(set(dtypes)) == 1:
+        return dtypes[0]
+    return object
+
+
+def _infer_dtypes(csv_path, encoding):
+    """ Pandas infers types chunk by chunk: find the type of each column over the whole file """
+    chunk_dtypes = {}
+    for chunk in _read_chunks(csv_path, encoding):
+        for column, dtype in chunk.dtypes.items():
+            chunk_dtypes.setdefault(column, set()).add(dtype)
+    return {column: _common_dtype(list(dtypes)) for column, dtypes in chunk_dtypes.items()}
+
+
+def _arrow_schema(dtypes):
+    fields = []
+    for column, dtype in dtypes.items():
+        if dtype == object:
+            arrow_type = pa.string()
+        else:
+            arrow_type = pa.from_numpy_dtype(dtype)
+        fields.append(pa.field(str(column), arrow_type))
+    return pa.schema(fields)
+
+
+def _update_stats(stats, chunk):
+    for column in chunk.columns:
+        series = chunk[column]
+        column_stats = stats.setdefault(
+            str(column), {"type": str(series.dtype), "null_count": 0}
+        )
+        column_stats["null_count"] += int(series.isna().sum())
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series) and series.count():
+            low, high = series.min().item(), series.max().item()
+            column_stats["min"] = min(column_stats.get("min", low), low)
+            column_stats["max"] = max(column_stats.get("max", high), high)
+
+
+def convert_csv_to_parquet(csv_path, parquet_path):
+    """ Write a csv file as parquet, with the column types inferred over the whole file.
+
+    Returns (row_count, column_stats).
+    """
+    encoding = detect_encoding(csv_path)
+    dtypes = _infer_dtypes(csv_path, encoding)
+
+    schema = _arrow_schema(dtypes)
+    tmp_path = parquet_path + ".tmp"
+    row_count = 0
+    stats = {}
+    try:
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for chunk in _read_chunks(csv_path, encoding, dtype=dtypes):
+                chunk.columns = [str(column) for column in chunk.columns]
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                row_count += len(chunk)
+                _update_stats(stats, chunk)
+        os.replace(tmp_path, parquet_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return row_count, stats
+
+
+@job("default", timeout=3600)
+def convert_data_source_file(data_source_file_id):
+    """ Store an uploaded csv file as parquet, so the analysis can read columns without parsing text """
+    if not enabled:
+        logger.warning("pandas/pyarrow are not installed, data source file %s is kept as csv only.", data_source_file_id)
+        return
+
+    data_source_file = models.DataSourceFile.query.get(data_source_file_id)
+    if data_source_file is None:
+        return
+
+    csv_path = os.path.join(settings.DATA_SOURCE_FILE_DIR, data_source_file.file_name)
+    parquet_name = os.path.splitext(data_source_file.file_name)[0] + ".parquet"
+    try:
+        row_count, column_stats = convert_csv_to_parquet(
+            csv_path, os.path.join(settings.DATA_SOURCE_FILE_DIR, parquet_name)
+        )
+    except Exception:
+        logger.exception("Failed converting data source file %s to parquet.", data_source_file_id)
+        return
+
+    data_source_file.columnar_file_name = parquet_name
+    data_source_file.row_count = row_count
+    data_source_file.column_stats = column_stats
+    models.db.session.commit()
+    logger.info("Converted data source file %s to parquet: %s rows.", data_source_file_id, row_count)
@@ -1,5 +1,6 @@
 import signal
 import time
+import uuid
 import redis
 
 from rq import get_current_job
@@ -7,7 +8,7 @@ from rq.job import JobStatus
 from rq.timeouts import JobTimeoutException
 from rq.exceptions import NoSuchJobError
 
-from bi import models, redis_connection, settings
+from bi import models, redis_connection, rq_redis_connection, settings
 from bi.query_runner import InterruptException
 from bi.tasks.worker import Queue, Job
 from bi.tasks.alerts import check_alerts_for_query
@@ -27,6 +28,144 @@ def _unlock(query_hash, data_source_id):
     redis_connection.delete(_job_lock_id(query_hash, data_source_id))
 
 
+def _job_options(data_source, user_id, is_api_key, scheduled_query, metadata):
+    if scheduled_query:
+        queue_name = data_source.scheduled_queue_name
+        scheduled_query_id = scheduled_query.id
+    else:
+        queue_name = data_source.queue_name
+        scheduled_query_id = None
+
+    time_limit = settings.dynamic_settings.query_time_limit(
+        scheduled_query, user_id, data_source.org_id
+    )
+    metadata["Queue"] = queue_name
+
+    enqueue_kwargs = {
+        "user_id": user_id,
+        "scheduled_query_id": scheduled_query_id,
+        "is_api_key": is_api_key,
+        "job_timeout": time_limit,
+        "failure_ttl": settings.JOB_DEFAULT_FAILURE_TTL,
+        "meta": {
+            "data_source_id": data_source.id,
+            "org_id": data_source.org_id,
+            "scheduled": scheduled_query_id is not None,
+            "query_id": metadata.get("query_id"),
+            "user_id": user_id,
+        },
+    }
+
+    if not scheduled_query:
+        enqueue_kwargs["result_ttl"] = settings.JOB_EXPIRY_TIME
+
+    return queue_name, enqueue_kwargs
+
+
+# Sets the lock KEYS[1] to ARGV[2] (expiring after ARGV[3] seconds) if it is still ARGV[1],
+# an empty ARGV[1] meaning no lock. Returns 1 if the lock was set.
+_REPLACE_LOCK_SCRIPT = """
+local current = redis.call("get", KEYS[1])
+if (current or "") ~= ARGV[1] then
+    return 0
+end
+redis.call("set", KEYS[1], ARGV[2], "EX", ARGV[3])
+return 1
+"""
+
+
+def _lock_is_irrelevant(job):
+    if job is None:
+        return True
+
+    status = job.get_status(refresh=False)
+    return status in [JobStatus.FINISHED, JobStatus.FAILED] or job.is_cancelled
+
+
+def enqueue_scheduled_queries(queries):
+    """
+    Batch version of `enqueue_query` for the scheduler. `queries` is a list of
+    (query_text, scheduled_query) pairs. Existing locks are read, stale locks replaced and
+    jobs created with a couple of pipelined round trips instead of a few per query.
+
+    Returns the scheduled queries a job was created for.
+    """
+    if not queries:
+        return []
+
+    entries = []
+    for query_text, scheduled_query in queries:
+        query_hash = gen_query_hash(query_text)
+        lock_id = _job_lock_id(query_hash, scheduled_query.data_source.id)
+        entries.append((query_hash, query_text, scheduled_query, lock_id))
+
+    pipe = redis_connection.pipeline(transaction=False)
+    for _, _, _, lock_id in entries:
+        pipe.get(lock_id)
+    locked_job_ids = pipe.execute()
+
+    existing_job_ids = [job_id for job_id in locked_job_ids if job_id]
+    existing_jobs = dict(
+        zip(existing_job_ids, Job.fetch_many(existing_job_ids, connection=rq_redis_connection))
+    )
+
+    # Take the locks for all queries without a running job. A lock is only taken if it still
+    # holds the value read above, so a lock set concurrently by someone else is never
+    # overwritten (or deleted when the one read was stale).
+    replace_lock = redis_connection.register_script(_REPLACE_LOCK_SCRIPT)
+    candidates = []
+    pipe = redis_connection.pipeline()
+    for entry, locked_job_id in zip(entries, locked_job_ids):
+        query_hash, _, scheduled_query, lock_id = entry
+        if locked_job_id and not _lock_is_irrelevant(existing_jobs.get(locked_job_id)):
+            logger.info("[%s] Found existing job: %s", query_hash, locked_job_id)
+            continue
+
+        job_id = str(uuid.uuid4())
+        replace_lock(
+            keys=[lock_id],
+            args=[locked_job_id or "", job_id, settings.JOB_EXPIRY_TIME],
+            client=pipe,
+        )
+        candidates.append((entry, job_id, len(pipe) - 1))
+    lock_results = pipe.execute()
+
+    queues = {}
+    jobs_pipe = rq_redis_connection.pipeline()
+    enqueued = []
+    for (query_hash, query_text, scheduled_query, _), job_id, position in candidates:
+        if not lock_results[position]:
+            continue
+
+        data_source = scheduled_query.data_source
+        metadata = {"query_id": scheduled_query.id, "Username": "Scheduled"}
+        queue_name, enqueue_kwargs = _job_options(
+            data_source, scheduled_query.user_id, False, scheduled_query, metadata
+        )
+        queue = queues.setdefault(queue_name, Queue(queue_name, connection=rq_redis_connection))
+
+        job = queue.create_job(
+            execute_query,
+            args=(query_text, data_source.id, metadata),
+            kwargs={
+                "user_id": enqueue_kwargs["user_id"],
+                "scheduled_query_id": enqueue_kwargs["scheduled_query_id"],
+                "is_api_key": enqueue_kwargs["is_api_key"],
+            },
+            timeout=enqueue_kwargs["job_timeout"],
+            failure_ttl=enqueue_kwargs["failure_ttl"],
+            meta=enqueue_kwargs["meta"],
+            job_id=job_id,
+        )
+        queue.enqueue_job(job, pipeline=jobs_pipe)
+        logger.info("[%s] Created new job: %s", query_hash, job_id)
+        enqueued.append(scheduled_query)
+
+    jobs_pipe.execute()
+
+    return enqueued
+
+
 def enqueue_query(
     query, data_source, user_id, is_api_key=False, scheduled_query=None, metadata={}
 ):
@@ -72,37 +211,11 @@ def enqueue_query(
             if not job:
                 pipe.multi()
 
-                if scheduled_query:
-                    queue_name = data_source.scheduled_queue_name
-                    scheduled_query_id = scheduled_query.id
-                else:
-                    queue_name = data_source.queue_name
-                    scheduled_query_id = None
-
-                time_limit = settings.dynamic_settings.query_time_limit(
-                    scheduled_query, user_id, data_source.org_id
+                queue_name, enqueue_kwargs = _job_options(
+                    data_source, user_id, is_api_key, scheduled_query, metadata
                 )
-                metadata["Queue"] = queue_name
 
                 queue = Queue(queue_name)
-                enqueue_kwargs = {
-                    "user_id": user_id,
-                    "scheduled_query_id": scheduled_query_id,
-                    "is_api_key": is_api_key,
-                    "job_timeout": time_limit,
-                    "failure_ttl": settings.JOB_DEFAULT_FAILURE_TTL,
-                    "meta": {
-                        "data_source_id": data_source.id,
-                        "org_id": data_source.org_id,
-                        "scheduled": scheduled_query_id is not None,
-                        "query_id": metadata.get("query_id"),
-                        "user_id": user_id,
-                    },
-                }
-
-                if not scheduled_query:
-                    enqueue_kwargs["result_ttl"] = settings.JOB_EXPIRY_TIME
-
                 job = queue.enqueue(
                     execute_query, query, data_source.id, metadata, **enqueue_kwargs
                 )
@@ -175,7 +288,14 @@ class QueryExecutor(object):
             models.scheduled_queries_executions.update(self.query_model.id)
 
     def run(self):
-        signal.signal(signal.SIGINT, signal_handler)
+        previous_handler = signal.signal(signal.SIGINT, signal_handler)
+        try:
+            return self._run()
+        finally:
+            # Jobs may run inside the worker process itself (see `BiSimpleWorker`).
+            signal.signal(signal.SIGINT, previous_handler)
+
+    def _run(self):
         started_at = time.time()
 
         logger.debug("Executing query:\n%s", self.query)
@@ -233,6 +353,7 @@ class QueryExecutor(object):
             updated_query_ids = models.Query.update_latest_result(query_result)
 
             models.db.session.commit()  # make sure that alert sees the latest query result
+            models.latest_query_results.update(query_result)
             self._log_progress("checking_alerts")
             for query_id in updated_query_ids:
                 check_alerts_for_query.delay(query_id)
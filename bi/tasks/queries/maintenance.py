@@ -1,4 +1,5 @@
 import logging
+import sys
 import time
 
 from rq.timeouts import JobTimeoutException
@@ -12,7 +13,7 @@ from bi.utils import json_dumps, sentry
 from bi.worker import job, get_job_logger
 from bi.monitor import rq_job_ids
 
-from .execution import enqueue_query
+from .execution import enqueue_scheduled_queries
 
 logger = get_job_logger(__name__)
 
@@ -28,7 +29,7 @@ def empty_schedules():
     logger.info("Deleted %d schedules.", len(queries))
 
 
-def _should_refresh_query(query):
+def _should_refresh_query(query, paused_data_source_ids):
     if settings.FEATURE_DISABLE_REFRESH_QUERIES:
         logger.info("Disabled refresh queries.")
         return False
@@ -38,12 +39,11 @@ def _should_refresh_query(query):
     elif query.data_source is None:
         logger.debug("Skipping refresh of %s because the datasource is none.", query.id)
         return False
-    elif query.data_source.paused:
+    elif query.data_source_id in paused_data_source_ids:
         logger.debug(
-            "Skipping refresh of %s because datasource - %s is paused (%s).",
+            "Skipping refresh of %s because datasource - %s is paused.",
             query.id,
             query.data_source.name,
-            query.data_source.pause_reason,
         )
         return False
     else:
@@ -76,41 +76,62 @@ class RefreshQueriesError(Exception):
     pass
 
 
-def _apply_auto_limit(query_text, query):
+def _apply_auto_limit(query_text, query, query_runner=None):
     should_apply_auto_limit = query.options.get("apply_auto_limit", False)
-    return query.data_source.query_runner.apply_auto_limit(
-        query_text, should_apply_auto_limit
-    )
+    query_runner = query_runner or query.data_source.query_runner
+    return query_runner.apply_auto_limit(query_text, should_apply_auto_limit)
 
 
 def refresh_queries():
     logger.info("Refreshing queries...")
-    enqueued = []
-    for query in models.Query.outdated_queries():
-        if not _should_refresh_query(query):
+    started_at = time.time()
+
+    queries = models.Query.outdated_queries()
+    loaded_at = time.time()
+
+    paused_data_source_ids = models.DataSource.paused_ids(
+        {query.data_source for query in queries if query.data_source is not None}
+    )
+    query_runners = {}
+
+    to_enqueue = []
+    for query in queries:
+        if not _should_refresh_query(query, paused_data_source_ids):
             continue
 
         try:
+            query_runner = query_runners.get(query.data_source_id)
+            if query_runner is None:
+                query_runner = query_runners[query.data_source_id] = query.data_source.query_runner
+
             query_text = _apply_default_parameters(query)
-            query_text = _apply_auto_limit(query_text, query)
-            enqueue_query(
-                query_text,
-                query.data_source,
-                query.user_id,
-                scheduled_query=query,
-                metadata={"query_id": query.id, "Username": "Scheduled"},
-            )
-            enqueued.append(query)
+            query_text = _apply_auto_limit(query_text, query, query_runner)
+            to_enqueue.append((query_text, query))
         except Exception as e:
             message = "Could not enqueue query %d due to %s" % (query.id, repr(e))
             logging.info(message)
             error = RefreshQueriesError(message).with_traceback(e.__traceback__)
             sentry.capture_exception(error)
+    prepared_at = time.time()
+
+    try:
+        enqueued = enqueue_scheduled_queries(to_enqueue)
+    except Exception as e:
+        enqueued = []
+        message = "Could not enqueue %d queries due to %s" % (len(to_enqueue), repr(e))
+        logging.info(message)
+        error = RefreshQueriesError(message).with_traceback(e.__traceback__)
+        sentry.capture_exception(error)
+    finished_at = time.time()
 
     status = {
         "outdated_queries_count": len(enqueued),
-        "last_refresh_at": time.time(),
+        "last_refresh_at": finished_at,
         "query_ids": json_dumps([q.id for q in enqueued]),
+        "refresh_duration": finished_at - started_at,
+        "refresh_load_duration": loaded_at - started_at,
+        "refresh_prepare_duration": prepared_at - loaded_at,
+        "refresh_enqueue_duration": finished_at - prepared_at,
     }
 
     redis_connection.hmset("bi:status", status)
@@ -162,19 +183,55 @@ def remove_ghost_locks():
     logger.info("Locks found: {}, Locks removed: {}".format(len(locks), count))
 
 
+def _schema_fingerprint(ds):
+    try:
+        return ds.query_runner.get_schema_fingerprint()
+    except Exception:
+        logger.warning(
+            u"Failed getting the schema fingerprint of the data source: %s", ds.name, exc_info=1
+        )
+        return None
+
+
+def _schema_unchanged(ds, fingerprint):
+    if fingerprint is None:
+        return False
+
+    cache = ds.schema_cache
+    refreshed_at = cache.refreshed_at()
+    return (
+        refreshed_at is not None
+        and time.time() - refreshed_at < settings.SCHEMAS_REFRESH_MAX_AGE
+        and cache.get_refresh_info().get("fingerprint") == fingerprint
+    )
+
+
 @job("schemas")
 def refresh_schema(data_source_id):
     ds = models.DataSource.get_by_id(data_source_id)
     logger.info(u"task=refresh_schema state=start ds_id=%s", ds.id)
     start_time = time.time()
     try:
+        fingerprint = _schema_fingerprint(ds)
+        if _schema_unchanged(ds, fingerprint):
+            logger.info(
+                u"task=refresh_schema state=skip ds_id=%s reason=unchanged runtime=%.2f",
+                ds.id,
+                time.time() - start_time,
+            )
+            statsd_client.incr("refresh_schema.unchanged")
+            return
+
         ds.get_schema(refresh=True)
+        runtime = time.time() - start_time
+        ds.schema_cache.set_refresh_info(fingerprint=fingerprint or "", runtime=runtime)
         logger.info(
             u"task=refresh_schema state=finished ds_id=%s runtime=%.2f",
             ds.id,
-            time.time() - start_time,
+            runtime,
         )
         statsd_client.incr("refresh_schema.success")
+        statsd_client.timing("refresh_schema.runtime.{}".format(ds.id), runtime * 1000)
     except JobTimeoutException:
         logger.info(
             u"task=refresh_schema state=timeout ds_id=%s runtime=%.2f",
@@ -192,11 +249,28 @@ def refresh_schema(data_source_id):
             ds.id,
             time.time() - start_time,
         )
+    finally:
+        ds.schema_cache.end_refresh()
+
+
+def _refresh_priority(ds, now):
+    """Sort key of the data sources to refresh: the ones most behind their schedule first,
+    then the smaller catalogs, so they don't wait behind the big ones."""
+    cache = ds.schema_cache
+    refreshed_at = cache.refreshed_at()
+    if refreshed_at is None:
+        periods_behind = sys.maxsize
+    else:
+        periods_behind = int((now - refreshed_at) // (settings.SCHEMAS_REFRESH_SCHEDULE * 60))
+    return -periods_behind, cache.table_count()
 
 
 def refresh_schemas():
     """
     Refreshes the data sources schemas.
+
+    Data sources are queued by priority (see `_refresh_priority`), at most one refresh per
+    data source at a time. A data source whose catalog didn't change is skipped by the job.
     """
     blacklist = [
         int(ds_id)
@@ -207,6 +281,7 @@ def refresh_schemas():
 
     logger.info(u"task=refresh_schemas state=start")
 
+    data_sources = []
     for ds in models.DataSource.query:
         if ds.paused:
             logger.info(
@@ -223,7 +298,16 @@ def refresh_schemas():
                 u"task=refresh_schema state=skip ds_id=%s reason=org_disabled", ds.id
             )
         else:
+            data_sources.append(ds)
+
+    data_sources.sort(key=lambda ds: _refresh_priority(ds, global_start_time))
+    for ds in data_sources:
+        if ds.schema_cache.start_refresh(ttl=settings.SCHEMAS_REFRESH_SCHEDULE * 60):
             refresh_schema.delay(ds.id)
+        else:
+            logger.info(
+                u"task=refresh_schema state=skip ds_id=%s reason=in_progress", ds.id
+            )
 
     logger.info(
         u"task=refresh_schemas state=finish total_runtime=%.2f",
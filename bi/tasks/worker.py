@@ -5,6 +5,7 @@ import time
 from bi import statsd_client
 from rq import Queue as BaseQueue, get_current_job
 from rq.worker import HerokuWorker # HerokuWorker implements graceful shutdown on SIGTERM
+from rq.worker import SimpleWorker
 from rq.utils import utcnow
 from rq.timeouts import UnixSignalDeathPenalty, HorseMonitorTimeoutException
 from rq.job import Job as BaseJob, JobStatus
@@ -169,6 +170,18 @@ class BiWorker(StatsdRecordingWorker, HardLimitingWorker):
     queue_class = BiQueue
 
 
+class BiSimpleWorker(StatsdRecordingWorker, SimpleWorker):
+    """
+    Executes jobs in the worker process itself instead of a forked work horse, so process
+    level state (like pooled data source connections) is kept between jobs. Time limits are
+    only enforced by the job's own alarm, there is no hard limit.
+    """
+
+    queue_class = BiQueue
+    job_class = CancellableJob
+
+
 Job = CancellableJob
 Queue = BiQueue
 Worker = BiWorker
+SimpleWorker = BiSimpleWorker
@@ -21,6 +21,8 @@ const Dialogue = (props) => {
   const Holmestable_id = useRef(null);
   const Holmestable_item = useRef({});
   const Dashboard_id = useRef(null);
+  // true while the pieces of a streamed reply are being received
+  const streamingRef = useRef(false);
   const HolmestableD_date = useRef(null);
   const [dashboardId, setDashboardId] = useState(null);
   const [holmestableDate, setHolmestableDate] = useState(null);
@@ -319,7 +321,25 @@ const handleSocketMessage = useCallback(() => {
     try {
       const data = JSON.parse(event.data);
 
+      if (data.receiver === 'user' && (data.data.data_type === 'answer_chunk' || data.data.data_type === 'answer_chunk_end')) {
+        // A streamed reply: show it in the last bot message as it grows, the answer message still ends the question.
+        const isEnd = data.data.data_type === 'answer_chunk_end';
+        const isFirst = !streamingRef.current;
+        streamingRef.current = !isEnd;
+        setState(prevState => ({
+          ...prevState,
+          messages: prevState.messages.map((message, i) =>
+            i === prevState.messages.length - 1 && message.sender === "bot"
+              ? { ...message, content: isEnd || isFirst ? data.data.content : message.content + data.data.content, Cardloading: false }
+              : message
+          ),
+        }));
+        scrollToBottom();
+        return;
+      }
+
       if (data.receiver === 'user') {
+        streamingRef.current = false;
         setState(prevState => ({
           ...prevState,
           messages: prevState.messages.map((message, i) =>